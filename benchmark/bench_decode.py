@@ -0,0 +1,55 @@
+"""
+列表页解析性能对比: YandePostData完整校验 与 YandePostPage延迟解析
+
+    python benchmark/bench_decode.py [--pages 200] [fixture.json ...]
+
+不指定fixture时使用fixtures.make_page生成的数据, 也可以传入保存下来的post.json原始内容
+"""
+import argparse
+import sys
+import tracemalloc
+from pathlib import Path
+from time import perf_counter
+
+sys.path.insert(0, str(Path(__file__).absolute().parent.parent))
+
+from utils.items import YandePostData, YandePostPage
+from fixtures import make_page
+
+
+def bench(name: str, pages: list, decode):
+    posts = 0
+    # 只读取下载需要的字段, 与item_iter_and_down一致
+    start = perf_counter()
+    for content in pages:
+        for i in decode(content).root:
+            posts += 1
+            _ = (i.id, i.file_url, i.file_size, i.md5)
+    elapsed = perf_counter() - start
+
+    tracemalloc.start()
+    kept = [decode(content) for content in pages[:10]]
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del kept
+    print(f'{name:<14} {posts / elapsed:>12,.0f} posts/s  {elapsed * 1000:>8.1f} ms  '
+          f'peak {peak / 1024 / 1024:>6.2f} MB / 10 pages')
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('fixtures', nargs='*', help='post.json原始内容文件')
+    parser.add_argument('--pages', type=int, default=200, help='未指定fixture时生成的页数')
+    args = parser.parse_args()
+    if args.fixtures:
+        pages = [Path(f).read_bytes() for f in args.fixtures]
+    else:
+        pages = [make_page(1_000_000 - n * 40) for n in range(args.pages)]
+    print(f'{len(pages)} pages, {sum(map(len, pages)) / 1024 / 1024:.2f} MB json')
+    bench('full', pages, YandePostData.model_validate_json)
+    bench('slim', pages, YandePostPage.model_validate_json)
+    bench('slim+full', pages, lambda c: YandePostPage.model_validate_json(c).full())
+
+
+if __name__ == '__main__':
+    main()
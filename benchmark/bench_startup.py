@@ -0,0 +1,60 @@
+"""
+启动耗时测试: 在新进程中以 -X importtime 导入模块, 统计总耗时与耗时最多的依赖
+
+    python benchmark/bench_startup.py --module spider.__main__ utils.query --repeat 5 --top 10
+"""
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+from pathlib import Path
+from statistics import median
+
+ROOT = Path(__file__).absolute().parent.parent
+
+
+def import_times(module: str, env: dict) -> dict:
+    """
+    :return: {模块名: (自身耗时us, 累计耗时us)}
+    """
+    proc = subprocess.run([sys.executable, '-X', 'importtime', '-c', f'import {module}' if module else 'pass'],
+                          cwd=str(ROOT), env=env, capture_output=True, text=True)
+    if proc.returncode != 0:
+        raise RuntimeError(proc.stderr[-2000:])
+    ret = {}
+    for line in proc.stderr.splitlines():
+        if not line.startswith('import time:') or 'imported package' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        ret[name.strip()] = (int(self_us), int(cumulative_us))
+    return ret
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--module', nargs='+', default=['spider.__main__'])
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--top', type=int, default=10, help='输出累计耗时最多的依赖数')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        # 使用临时配置, 确认import时不会读写配置文件
+        cfg_path = os.path.join(tmp, 'data.cfg')
+        env = dict(os.environ, YANDE_CONFIG=cfg_path)
+        # 解释器启动(site等)导入的模块不计入
+        baseline = set(import_times('', env))
+        for module in args.module:
+            runs = [import_times(module, env) for _ in range(args.repeat)]
+            total = median(r[module][1] for r in runs if module in r) / 1000
+            print(f'{module}: {total:.1f} ms (median of {args.repeat})')
+            names = set().union(*runs)
+            rows = sorted(((median(r[n][1] for r in runs if n in r), n) for n in names - baseline if n != module),
+                          reverse=True)
+            for cumulative_us, name in rows[:args.top]:
+                print(f'    {cumulative_us / 1000:>8.1f} ms  {name}')
+            print(f'    config file written at import: {os.path.exists(cfg_path)}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,42 @@
+"""
+生成与yande.re post.json结构一致的测试数据
+"""
+import hashlib
+import json
+import random
+from urllib.parse import quote
+
+TAG_POOL = [f'tag_{n}' for n in range(2000)]
+
+
+def make_post(_id: int, file_url: str = None, file_size: int = None, md5: str = None, rng: random.Random = None) -> dict:
+    rng = rng or random.Random(_id)
+    tags = ' '.join(sorted(rng.sample(TAG_POOL, rng.randint(5, 40))))
+    md5 = md5 or hashlib.md5(str(_id).encode()).hexdigest()
+    file_size = file_size if file_size is not None else rng.randint(500_000, 30_000_000)
+    name = quote(f'yande.re {_id} {tags[:120]}.png')
+    file_url = file_url or f'https://files.yande.re/image/{md5}/{name}'
+    width, height = rng.randint(800, 8000), rng.randint(800, 8000)
+    frames = [dict(source_width=width, source_height=height, source_top=0, source_left=0,
+                   post_id=_id, preview_url='', preview_rect=dict(width=150, height=150))
+              for _ in range(rng.choice((0, 0, 0, 1, 2)))]
+    return dict(
+        id=_id, tags=tags, created_at=1600000000 + _id, updated_at=1600000000 + _id, creator_id=rng.randint(1, 9999),
+        author='author', change=_id * 3, source='https://example.com/source', score=rng.randint(0, 300),
+        md5=md5, file_size=file_size, file_ext='png', file_url=file_url, is_shown_in_index=True,
+        preview_url=f'https://assets.yande.re/data/preview/{md5}.jpg', preview_width=150, preview_height=150,
+        actual_preview_width=300, actual_preview_height=300,
+        sample_url=f'https://files.yande.re/sample/{md5}/{name}.jpg', sample_width=1500, sample_height=1500,
+        sample_file_size=file_size // 10,
+        jpeg_url=f'https://files.yande.re/jpeg/{md5}/{name}.jpg', jpeg_width=width, jpeg_height=height,
+        jpeg_file_size=file_size // 3,
+        rating=rng.choice('sqe'), is_rating_locked=False, has_children=False, parent_id=None, status='active',
+        is_pending=False, width=width, height=height, is_held=False, frames_pending_string='', frames_pending=[],
+        frames_string='', frames=frames, is_note_locked=False, last_noted_at=0, last_commented_at=0)
+
+
+def make_page(start_id: int, count: int = 40) -> bytes:
+    """
+    生成从start_id开始id递减的一页数据
+    """
+    return json.dumps([make_post(_id) for _id in range(start_id, max(start_id - count, 0), -1)]).encode()
@@ -0,0 +1,206 @@
+"""
+本地模拟yande.re: post.json分页与支持Range的文件下载, 可设置延迟/带宽/限流
+
+    python benchmark/mock_server.py --files 200 --size 2097152 --port 8000
+"""
+import argparse
+import hashlib
+import json
+import random
+import re
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from time import sleep, monotonic
+from urllib.parse import urlsplit, parse_qsl, quote
+
+from fixtures import make_post
+
+BLOCK_SIZE = 64 * 1024
+
+
+class MockFile:
+    """
+    内容由固定随机块循环生成, 不占用与文件大小相同的内存
+    """
+
+    def __init__(self, seed: int, size: int):
+        self.block = random.Random(seed).randbytes(BLOCK_SIZE)
+        self.size = size
+        hasher = hashlib.md5()
+        for s, data in self.iter_range(0, size - 1):
+            hasher.update(data)
+        self.md5 = hasher.hexdigest()
+
+    def iter_range(self, s: int, e: int):
+        pos = s
+        while pos <= e:
+            offset = pos % BLOCK_SIZE
+            n = min(BLOCK_SIZE - offset, e - pos + 1)
+            yield pos, self.block[offset:offset + n]
+            pos += n
+
+
+class MockYande:
+    def __init__(self, files: int = 200, size: int = 2 * 1024 * 1024, size_jitter: float = 0.5,
+                 latency: float = 0, bandwidth: float = 0, throttle: float = 0, page_size: int = 40,
+                 stall: float = 0):
+        """
+        :param files: 图片数量
+        :param size: 平均文件大小
+        :param size_jitter: 文件大小随机浮动比例
+        :param latency: 每个请求响应前的延迟(秒)
+        :param bandwidth: 单连接带宽(字节/秒), 0为不限制
+        :param throttle: 每秒请求数上限, 超过时返回429, 0为不限制
+        :param page_size: post.json默认每页数量
+        :param stall: 文件响应发送响应头后暂停的时间(秒), 模拟卡住的连接
+        """
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.throttle = throttle
+        self.page_size = page_size
+        self.stall = stall
+        self.lock = threading.Lock()
+        self.window = (monotonic(), 0)
+        self.stats = dict(requests=0, throttled=0, bytes=0)
+        rng = random.Random(0)
+        self.files = {}
+        self.posts = []
+        self.server = None
+        self.sizes = [max(1, int(size * (1 + rng.uniform(-size_jitter, size_jitter)))) for _ in range(files)]
+
+    def start(self, host: str = '127.0.0.1', port: int = 0) -> str:
+        mock = self
+
+        class Handler(MockHandler):
+            yande = mock
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.server.daemon_threads = True
+        base_url = f'http://{host}:{self.server.server_address[1]}'
+        for n, size in enumerate(self.sizes):
+            _id = len(self.sizes) - n
+            f = MockFile(_id, size)
+            name = quote(f'yande.re {_id} mock.png')
+            self.files[f.md5] = f
+            self.posts.append(make_post(_id, file_url=f'{base_url}/image/{f.md5}/{name}', file_size=size, md5=f.md5))
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return base_url
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def allow(self) -> bool:
+        with self.lock:
+            self.stats['requests'] += 1
+            if self.throttle <= 0:
+                return True
+            start, count = self.window
+            now = monotonic()
+            if now - start >= 1:
+                start, count = now, 0
+            self.window = (start, count + 1)
+            if count + 1 > self.throttle:
+                self.stats['throttled'] += 1
+                return False
+            return True
+
+
+class MockHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    yande: MockYande = None
+
+    def log_message(self, *args):
+        pass
+
+    def send_empty(self, status: int, headers: dict = None):
+        self.send_response(status)
+        for k, v in (headers or {}).items():
+            self.send_header(k, v)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def do_GET(self):
+        yande = self.yande
+        if yande.latency:
+            sleep(yande.latency)
+        if not yande.allow():
+            return self.send_empty(429, {'Retry-After': '1'})
+        url = urlsplit(self.path)
+        if url.path.endswith('/post.json'):
+            return self.post_list(dict(parse_qsl(url.query)))
+        md5 = url.path.split('/')[-2] if url.path.count('/') >= 2 else ''
+        f = yande.files.get(md5)
+        if f is None:
+            return self.send_empty(404)
+        s, e = 0, f.size - 1
+        m = re.match(r'bytes=(\d+)-(\d*)', self.headers.get('Range', ''))
+        if m:
+            s, e = int(m[1]), min(int(m[2]) if m[2] else f.size - 1, f.size - 1)
+            if s > e:
+                return self.send_empty(416)
+            self.send_response(206)
+            self.send_header('Content-Range', f'bytes {s}-{e}/{f.size}')
+        else:
+            self.send_response(200)
+        self.send_header('Content-Length', str(e - s + 1))
+        self.end_headers()
+        if yande.stall:
+            self.wfile.flush()
+            sleep(yande.stall)
+        start = monotonic()
+        sent = 0
+        try:
+            for _, data in f.iter_range(s, e):
+                self.wfile.write(data)
+                sent += len(data)
+                if yande.bandwidth:
+                    ahead = sent / yande.bandwidth - (monotonic() - start)
+                    if ahead > 0:
+                        sleep(ahead)
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+        with yande.lock:
+            yande.stats['bytes'] += sent
+
+    def post_list(self, params: dict):
+        yande = self.yande
+        page = max(int(params.get('page', 1)), 1)
+        limit = int(params.get('limit', yande.page_size))
+        posts = yande.posts
+        # 只模拟增量获取与断点继续用到的id:>N, id:<N, order:id
+        if 'order:id' in params.get('tags', '').split():
+            posts = sorted(posts, key=lambda p: p['id'])
+        m = re.search(r'id:>(\d+)', params.get('tags', ''))
+        if m:
+            posts = [p for p in posts if p['id'] > int(m[1])]
+        m = re.search(r'id:<(\d+)', params.get('tags', ''))
+        if m:
+            posts = [p for p in posts if p['id'] < int(m[1])]
+        body = json.dumps(posts[(page - 1) * limit: page * limit]).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--files', type=int, default=200)
+    parser.add_argument('--size', type=int, default=2 * 1024 * 1024)
+    parser.add_argument('--latency', type=float, default=0)
+    parser.add_argument('--bandwidth', type=float, default=0)
+    parser.add_argument('--throttle', type=float, default=0)
+    parser.add_argument('--port', type=int, default=8000)
+    args = parser.parse_args()
+    yande = MockYande(args.files, args.size, latency=args.latency, bandwidth=args.bandwidth, throttle=args.throttle)
+    print(f'serving {yande.start(port=args.port)}/post.json')
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        yande.stop()
+
+
+if __name__ == '__main__':
+    main()
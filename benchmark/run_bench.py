@@ -0,0 +1,135 @@
+"""
+离线下载性能测试: 启动本地模拟服务器, 对不同分段大小/并发数/下载引擎的组合分别在子进程中运行并统计
+
+    python benchmark/run_bench.py --files 100 --size 4194304 --split 1048576 20971520 --transfer 4 8 \\
+        --engine thread async --mode down spider --latency 0.05 --bandwidth 5242880
+
+mode:
+    down    直接把全部文件提交给DownScheduler
+    spider  YandeSpider.get_post_list 端到端(包含列表页获取)
+"""
+import argparse
+import itertools
+import json
+import os
+import subprocess
+import sys
+import tempfile
+from pathlib import Path
+from time import perf_counter, process_time
+
+ROOT = Path(__file__).absolute().parent.parent
+sys.path.insert(0, str(ROOT))
+
+
+def peak_rss_mb() -> float:
+    try:
+        import resource
+    except ImportError:
+        return 0
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # macOS为字节, Linux为KB
+    return rss / 1024 / 1024 if sys.platform == 'darwin' else rss / 1024
+
+
+def run_worker(mode: str, base_url: str, save_dir: str) -> dict:
+    """
+    子进程中执行, 配置由YANDE_CONFIG指定
+    """
+    import requests
+    from spider.yande_api import YandeSpider
+    from utils.items import YandeRunningConfig, YandePostPage
+    from utils.scheduler import DownScheduler
+
+    start, cpu_start = perf_counter(), process_time()
+    if mode == 'spider':
+        spider = YandeSpider()
+        result = spider.get_post_list(YandeRunningConfig(save_dir_path=save_dir))
+        spider.scheduler.shutdown()
+        files, size, failed = result.count, result.bytes, result.failed
+    else:
+        posts = []
+        page = 1
+        while True:
+            root = YandePostPage.model_validate_json(
+                requests.get(f'{base_url}/post.json', params=dict(page=page, limit=100)).content).root
+            if not root:
+                break
+            posts.extend(root)
+            page += 1
+        start, cpu_start = perf_counter(), process_time()
+        scheduler = DownScheduler()
+        futures = [scheduler.submit(i.file_url, save_dir, f'{i.id}.png', i.file_size, i.md5, i.id) for i in posts]
+        results = [f.result() for f in futures]
+        scheduler.shutdown()
+        ok = [r for r in results if r.ok]
+        files, size, failed = len(ok), sum(r.file_size for r in ok), len(results) - len(ok)
+    elapsed = perf_counter() - start
+    return dict(files=files, bytes=size, failed=failed, seconds=elapsed,
+                cpu=process_time() - cpu_start, rss=peak_rss_mb())
+
+
+def run_case(args, base_url: str, engine: str, split: int, transfer: int, mode: str) -> dict:
+    from utils.constant import Config
+    with tempfile.TemporaryDirectory() as tmp:
+        cfg = Config().model_dump()
+        cfg['yande_api'].update(post_api=f'{base_url}/post.json', proxies=None, retry=args.retry, backoff=1)
+        cfg['downloader'].update(engine=engine, split_size=split, transfer_num=transfer,
+                                 host_transfer_num=transfer, thread_num=transfer, pool_size=transfer * 2,
+                                 adaptive=args.adaptive)
+        # 每轮都完整下载, 不使用上一轮的搜索进度
+        cfg['index'].update(checkpoint=False, path=os.path.join(tmp, 'index.db'))
+        cfg_path = os.path.join(tmp, 'bench.cfg')
+        with open(cfg_path, 'w') as f:
+            json.dump(cfg, f)
+        save_dir = os.path.join(tmp, 'pic')
+        os.makedirs(save_dir)
+        env = dict(os.environ, YANDE_CONFIG=cfg_path)
+        proc = subprocess.run([sys.executable, __file__, '--worker', mode, '--base-url', base_url,
+                               '--save-dir', save_dir],
+                              env=env, cwd=str(ROOT), capture_output=True, text=True)
+        if proc.returncode != 0:
+            raise RuntimeError(proc.stderr[-2000:])
+        return json.loads(proc.stdout.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--files', type=int, default=100)
+    parser.add_argument('--size', type=int, default=2 * 1024 * 1024, help='平均文件大小')
+    parser.add_argument('--latency', type=float, default=0, help='模拟服务器每个请求的延迟(秒)')
+    parser.add_argument('--bandwidth', type=float, default=0, help='模拟服务器单连接带宽(字节/秒)')
+    parser.add_argument('--throttle', type=float, default=0, help='模拟服务器每秒请求数上限')
+    parser.add_argument('--engine', nargs='+', default=['thread'])
+    parser.add_argument('--split', nargs='+', type=int, default=[5 * 1024 * 1024])
+    parser.add_argument('--transfer', nargs='+', type=int, default=[8])
+    parser.add_argument('--mode', nargs='+', default=['down'], choices=['down', 'spider'])
+    parser.add_argument('--adaptive', action='store_true')
+    parser.add_argument('--retry', type=int, default=3)
+    parser.add_argument('--worker', help=argparse.SUPPRESS)
+    parser.add_argument('--base-url', help=argparse.SUPPRESS)
+    parser.add_argument('--save-dir', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        print(json.dumps(run_worker(args.worker, args.base_url, args.save_dir)))
+        return
+
+    sys.path.insert(0, str(Path(__file__).absolute().parent))
+    from mock_server import MockYande
+    yande = MockYande(args.files, args.size, latency=args.latency, bandwidth=args.bandwidth, throttle=args.throttle)
+    base_url = yande.start()
+    print(f'{args.files} files, avg {args.size / 1024 / 1024:.2f} MB, latency {args.latency}s, '
+          f'bandwidth {args.bandwidth / 1024 / 1024:.2f} MB/s/conn, throttle {args.throttle} req/s')
+    print(f'{"mode":<7}{"engine":<8}{"split MB":>9}{"transfer":>9}{"files/s":>9}{"MB/s":>9}'
+          f'{"cpu s":>8}{"rss MB":>8}{"failed":>7}')
+    for mode, engine, split, transfer in itertools.product(args.mode, args.engine, args.split, args.transfer):
+        r = run_case(args, base_url, engine, split, transfer, mode)
+        print(f'{mode:<7}{engine:<8}{split / 1024 / 1024:>9.2f}{transfer:>9}{r["files"] / r["seconds"]:>9.1f}'
+              f'{r["bytes"] / 1024 / 1024 / r["seconds"]:>9.2f}{r["cpu"]:>8.2f}{r["rss"]:>8.1f}{r["failed"]:>7}')
+    print(f'server: {yande.stats}')
+    yande.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,101 @@
+import argparse
+import json
+import os
+import sys
+
+from spider.yande_api import YandeSpider
+from utils.audit import ArchiveAuditor, open_sources
+from utils.mirror import MetaMirror
+from utils.query import LocalQuery
+
+
+def main():
+    parser = argparse.ArgumentParser(prog='python -m spider', description='yande.re spider')
+    parser.add_argument('--config', default=None, help='配置文件路径, 默认为环境变量YANDE_CONFIG或config/data.cfg')
+    sub = parser.add_subparsers(dest='command', required=True)
+
+    p = sub.add_parser('reconcile', help='扫描下载目录重建本地下载索引')
+    p.add_argument('b_path', help='下载根目录, 每个tag一个子目录')
+
+    p = sub.add_parser('mirror', help='只获取元数据, 增量写入本地镜像')
+    p.add_argument('--tags', default='', help='搜索条件, 为空时镜像全站')
+    p.add_argument('--db', default=None, help='镜像数据库路径, 默认使用配置mirror.path')
+    p.add_argument('--pages', type=int, default=0, help='最多获取的页数, 0为不限制')
+
+    p = sub.add_parser('query', help='在本地镜像中按标签查询, 可直接下载结果')
+    p.add_argument('expr', help='yande风格搜索条件, 如 "tag_a -tag_b rating:s width:>=1000"')
+    p.add_argument('--db', default=None, help='镜像数据库路径, 默认使用配置mirror.path')
+    p.add_argument('--down', default=None, help='下载到该目录, 不指定时只输出id')
+
+    p = sub.add_parser('audit', help='并行校验已下载文件的md5/大小, 输出需要重新下载的文件')
+    p.add_argument('b_path', help='下载根目录, 每个tag一个子目录')
+    p.add_argument('--tags', nargs='*', default=None, help='只检查这些tag目录')
+    p.add_argument('--out', default=None, help='重新下载队列(JSON lines)输出文件, 默认输出到标准输出')
+    p.add_argument('--index', default=None, help='下载索引路径, 默认在启用索引时使用配置index.path')
+    p.add_argument('--db', default=None, help='镜像数据库路径, 默认使用已存在的配置mirror.path')
+    p.add_argument('--workers', type=int, default=None, help='进程数, 默认为配置audit.workers或CPU数')
+
+    p = sub.add_parser('redownload', help='重新下载audit输出的文件')
+    p.add_argument('queue', help='audit输出的JSON lines文件')
+
+    p = sub.add_parser('queue', help='通过共享任务队列在多个进程/机器上搜索与下载')
+    p.add_argument('--queue', default=None, help='队列数据库路径, 默认使用配置queue.path')
+    queue_sub = p.add_subparsers(dest='action', required=True)
+    q = queue_sub.add_parser('add', help='加入tag搜索任务')
+    q.add_argument('b_path', help='下载根目录, 每个tag一个子目录')
+    q.add_argument('tags', nargs='+')
+    q.add_argument('--pages', type=int, default=0, help='每个tag最多搜索的页数, 0为默认')
+    q = queue_sub.add_parser('worker', help='领取并执行任务, 使用本进程的配置(代理/限速)')
+    q.add_argument('--name', default=None, help='worker名称, 默认为 主机名-进程id')
+    q.add_argument('--kinds', nargs='*', choices=('tag', 'file'), default=None, help='只领取这些类型的任务')
+    q.add_argument('--b-path', default=None, help='覆盖任务中的下载根目录')
+    q.add_argument('--exit-idle', action='store_true', help='队列中没有未结束的任务时退出')
+    q = queue_sub.add_parser('commit', help='汇总结果, 写入下载索引与tag搜索进度')
+    q.add_argument('--watch', action='store_true', help='定时汇总直到队列中没有未结束的任务')
+    q.add_argument('--interval', type=float, default=None, help='定时汇总间隔(秒), 默认为配置queue.poll')
+    queue_sub.add_parser('status', help='输出各状态的任务数')
+
+    args = parser.parse_args()
+    if args.config:
+        # 配置在首次使用时才加载, 此时设置仍然有效
+        os.environ['YANDE_CONFIG'] = args.config
+    if args.command == 'reconcile':
+        YandeSpider().reconcile_index(args.b_path)
+    elif args.command == 'mirror':
+        YandeSpider().mirror_meta(args.tags, MetaMirror(args.db), args.pages)
+    elif args.command == 'query':
+        query = LocalQuery(MetaMirror(args.db))
+        if args.down is None:
+            for _id in query.search(args.expr):
+                print(_id)
+        else:
+            YandeSpider().download_query(args.expr, args.down, query)
+    elif args.command == 'audit':
+        auditor = ArchiveAuditor(*open_sources(args.index, args.db), workers=args.workers)
+        if args.out is None:
+            auditor.run(args.b_path, sys.stdout, args.tags)
+        else:
+            with open(args.out, 'w', encoding='utf-8') as f:
+                auditor.run(args.b_path, f, args.tags)
+    elif args.command == 'redownload':
+        YandeSpider().redownload(args.queue)
+    elif args.command == 'queue':
+        from spider.cluster import Coordinator, QueueWorker
+        from utils.work_queue import WorkQueue
+        queue = WorkQueue(args.queue)
+        if args.action == 'add':
+            Coordinator(queue).add_tags(args.tags, args.b_path, args.pages)
+        elif args.action == 'worker':
+            QueueWorker(queue, args.name, args.kinds, args.b_path).run(args.exit_idle)
+        elif args.action == 'commit':
+            coordinator = Coordinator(queue)
+            if args.watch:
+                coordinator.serve(args.interval, until_idle=True)
+            else:
+                coordinator.commit()
+        elif args.action == 'status':
+            print(json.dumps(queue.stats(), ensure_ascii=False))
+
+
+if __name__ == '__main__':
+    main()
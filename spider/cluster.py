@@ -0,0 +1,270 @@
+import os
+import socket
+from pathlib import Path
+from threading import Thread, Event, Lock
+from time import sleep
+from urllib.parse import unquote
+
+from loguru import logger
+
+from spider.yande_api import YandeApi
+from utils.checkpoint import open_checkpoints
+from utils.constant import config
+from utils.index import open_index, dir_key
+from utils.items import DownResult, TagResult
+from utils.metrics import counter, start_exporter
+from utils.scheduler import DownScheduler
+from utils.variant import select_variant
+from utils.work_queue import WorkQueue, QueueJob, DONE, FAILED, PENDING, LEASED
+
+
+class Coordinator:
+    """
+    向共享队列加入tag搜索任务, 汇总worker的结果
+    worker只读写队列与下载目录, 下载索引与tag搜索进度只由coordinator写入
+    """
+
+    def __init__(self, queue: WorkQueue = None):
+        self.queue = queue or WorkQueue()
+        self.index = open_index()
+        self.checkpoints = open_checkpoints()
+
+    def add_tags(self, tags: list, b_path: str, end_page: int = 0) -> list:
+        """
+        加入tag搜索任务, 按tag的搜索进度设置停止位置, 上次未完成时从中断的位置继续
+        :param tags:
+        :param b_path: 下载根目录, 每个tag一个子目录
+        :param end_page: 每个tag最多搜索的页数, 0为默认的100页
+        :return: 任务id
+        """
+        ret = []
+        for tag in tags:
+            # 任务key包含下载目录, 同一tag下载到不同目录时为不同的任务
+            payload = dict(tag=tag, b_path=str(Path(b_path).absolute()), dir=dir_key(Path(b_path) / tag),
+                           end_page=end_page, stop_id=0, low_id=0, max_id=0)
+            if self.checkpoints is not None:
+                cp = self.checkpoints.get(tag, Path(payload['b_path']) / tag)
+                if cp.running:
+                    payload.update(stop_id=cp.run_stop_id, low_id=cp.low_id, max_id=cp.run_max_id)
+                else:
+                    payload.update(stop_id=cp.high_water)
+            # 已结束的同一tag任务重新加入, 未结束或文件任务未全部汇总的保持不变
+            job_id = self.queue.put('tag', f'tag:{tag}:{payload["dir"]}', payload, reset=(DONE, FAILED))
+            ret.append(job_id)
+            unsettled = self.queue.unsettled(job_id)
+            if unsettled:
+                logger.warning(f'queue tag {tag}: {unsettled} files of the last run not committed, keep it')
+            else:
+                logger.info(f'*queue tag\t{"[" + tag + "]":>20} \tstop id:{payload["stop_id"]}')
+        return ret
+
+    def commit(self) -> list:
+        """
+        写入已完成文件的索引; tag下的文件任务全部结束后更新tag搜索进度
+        :return: 本次结束的tag的TagResult
+        """
+        committed = []
+        for job, status, result in self.queue.uncommitted('file'):
+            if status == DONE and self.index is not None:
+                p = job.payload
+                # worker的下载目录可能挂载在不同位置, 按coordinator的路径记录
+                result['file_path'] = str(Path(p['b_path']) / p['tag'] / p['file_name'])
+                self.index.add(p['tag'], DownResult(**result), p['variant'])
+            committed.append(job.id)
+        self.queue.mark_committed(committed)
+
+        ret = []
+        committed = []
+        for job, status, result in self.queue.uncommitted('tag'):
+            children = self.queue.children(job.id)
+            if children.get(PENDING) or children.get(LEASED):
+                continue
+            tag = job.payload['tag']
+            if status != DONE or children.get(FAILED):
+                # 有失败时不更新进度, 下次从原来的位置重新搜索, 已存在的文件会跳过
+                logger.warning(f'queue tag failed {tag}: {status}, {children.get(FAILED, 0)} files failed')
+            elif self.checkpoints is not None:
+                cp = self.checkpoints.get(tag, Path(job.payload['b_path']) / tag)
+                cp.run_stop_id = job.payload['stop_id']
+                cp.run_max_id = max(cp.run_max_id, result['max_id'])
+                if result['complete']:
+                    self.checkpoints.finish(cp)
+                elif result['low_id']:
+                    # 达到页数上限时记录位置, 下次加入时继续
+                    self.checkpoints.progress(cp, result['low_id'], cp.pages + result['pages'])
+            committed.append(job.id)
+            ret.append(TagResult(tag=tag, max_id=(result or {}).get('max_id', 0),
+                                 count=children.get(DONE, 0), failed=children.get(FAILED, 0)))
+            logger.info(f'**queue finish\t{"[" + tag + "]":>20} \t{ret[-1]}')
+        self.queue.mark_committed(committed)
+        return ret
+
+    def serve(self, interval: float = None, until_idle: bool = False) -> list:
+        """
+        定时汇总结果
+        :param until_idle: 队列中没有未结束的任务时退出
+        :return: 结束的tag的TagResult
+        """
+        ret = []
+        while True:
+            idle = until_idle and self.queue.open_count() == 0
+            ret.extend(self.commit())
+            if idle:
+                return ret
+            sleep(interval or config.queue.poll)
+
+
+class QueueWorker:
+    """
+    从共享队列领取tag搜索与文件下载任务, 可在多个进程或多台机器上运行
+    每个worker使用自己的配置(代理/限速), 用不同的出口分担单个IP的限流
+    """
+
+    def __init__(self, queue: WorkQueue = None, name: str = None, kinds: tuple = None, b_path: str = None):
+        """
+        :param name: 默认为 主机名-进程id
+        :param kinds: 只领取这些类型的任务(tag/file), 默认全部
+        :param b_path: 覆盖任务中的下载根目录, 各机器挂载位置不同时使用
+        """
+        self.queue = queue or WorkQueue()
+        self.name = name or f'{socket.gethostname()}-{os.getpid()}'
+        self.kinds = tuple(kinds) if kinds else None
+        self.b_path = b_path
+        self.y_api = YandeApi()
+        self.scheduler = DownScheduler()
+        self.inflight = set()
+        self.crawling = 0
+        self.lock = Lock()
+        self.stop_event = Event()
+        start_exporter()
+
+    def save_dir(self, payload: dict) -> Path:
+        return Path(self.b_path or payload['b_path']) / payload['tag']
+
+    def run(self, exit_idle: bool = False) -> int:
+        """
+        :param exit_idle: 队列中没有未结束的任务时退出
+        :return: 处理的任务数
+        """
+        Thread(target=self.heartbeat, daemon=True).start()
+        slots = max(1, config.downloader.transfer_num)
+        kinds = self.kinds or ('tag', 'file')
+        count = 0
+        logger.info(f'*queue worker {self.name} start: {self.queue.db_path}')
+        try:
+            while not self.stop_event.is_set():
+                with self.lock:
+                    busy = len(self.inflight)
+                    # 同时搜索的tag数不超过yande_api.tag_num, 其余位置用于下载
+                    lease_kinds = kinds if self.crawling < config.yande_api.tag_num else \
+                        tuple(k for k in kinds if k != 'tag')
+                job = self.queue.lease(self.name, lease_kinds) if busy < slots and lease_kinds else None
+                if job is None:
+                    if exit_idle and busy == 0 and self.queue.open_count(kinds) == 0:
+                        break
+                    self.stop_event.wait(config.queue.poll if busy == 0 else 0.2)
+                    continue
+                count += 1
+                with self.lock:
+                    self.inflight.add(job.id)
+                if job.kind == 'tag':
+                    with self.lock:
+                        self.crawling += 1
+                    # 搜索在单独的线程中进行, 已加入的文件任务可同时下载
+                    Thread(target=self.crawl, args=(job,), daemon=True).start()
+                else:
+                    self.download(job)
+        finally:
+            self.stop_event.set()
+            self.scheduler.shutdown()
+        logger.info(f'**queue worker {self.name} finish: {count} jobs')
+        return count
+
+    def heartbeat(self):
+        """
+        定时续约正在执行的任务
+        """
+        while not self.stop_event.wait(config.queue.heartbeat):
+            with self.lock:
+                job_ids = list(self.inflight)
+            for job_id in self.queue.heartbeat(job_ids, self.name):
+                # 租约已过期并被其他worker领取, 本worker的结果不会被提交
+                logger.warning(f'[{job_id}] queue lease lost')
+
+    def crawl(self, job: QueueJob):
+        """
+        搜索tag并把需要下载的文件加入队列, 每页结束后保存进度, 租约过期后其他worker从该页继续
+        """
+        from pathvalidate import sanitize_filename
+        p = job.payload
+        tag, stop_id = p['tag'], p['stop_id']
+        low_id = job.state.get('low_id', p['low_id'])
+        max_id = job.state.get('max_id', max(p['max_id'], stop_id))
+        pages = job.state.get('pages', 0)
+        query = tag.replace('tag_', '')
+        if low_id:
+            query = f'{query} id:<{low_id}'.strip()
+        save_dir_path = self.save_dir(p)
+        try:
+            complete = False
+            for page in range(1, p['end_page'] or 100):
+                ret = self.y_api.get_ranking(page, tags=query)
+                if ret is None or not ret[0]:
+                    raise RuntimeError(f'get page failed: {page} {query}')
+                root = ret[1].root
+                if len(root) == 0:
+                    complete = True
+                    break
+                for i in root:
+                    if i.id <= stop_id:
+                        complete = True
+                        break
+                    variant = select_variant(i)
+                    fn = sanitize_filename(unquote(variant.url.rsplit("/", maxsplit=1)[-1]))
+                    if (save_dir_path / fn).exists():
+                        continue
+                    self.queue.put('file', f'file:{tag}:{p["dir"]}:{i.id}',
+                                   dict(tag=tag, b_path=p['b_path'], id=i.id, url=variant.url, file_name=fn,
+                                        file_size=variant.file_size, md5=variant.md5, variant=variant.name),
+                                   parent=job.id)
+                max_id = max(max_id, max(i.id for i in root))
+                low_id = min(i.id for i in root)
+                pages += 1
+                self.queue.save_state(job.id, self.name, dict(low_id=low_id, max_id=max_id, pages=pages))
+                if complete:
+                    break
+            self.queue.complete(job.id, self.name, dict(max_id=max_id, low_id=low_id, pages=pages,
+                                                        complete=complete))
+            counter('queue_jobs_total', '执行结束的队列任务数', kind='tag', result='done').inc()
+        except Exception as e:
+            logger.warning(f'[{job.id}] queue crawl error {tag}: {e}')
+            self.queue.fail(job.id, self.name, str(e))
+            counter('queue_jobs_total', '执行结束的队列任务数', kind='tag', result='failed').inc()
+        finally:
+            with self.lock:
+                self.inflight.discard(job.id)
+                self.crawling -= 1
+
+    def download(self, job: QueueJob):
+        p = job.payload
+        save_dir_path = self.save_dir(p)
+        os.makedirs(save_dir_path, exist_ok=True)
+        future = self.scheduler.submit(p['url'], str(save_dir_path), p['file_name'], p['file_size'] or 0,
+                                       p['md5'], p['id'])
+        future.add_done_callback(lambda f, j=job: self.file_done(j, f))
+
+    def file_done(self, job: QueueJob, future):
+        try:
+            result = future.result() if future.exception() is None else None
+            if result is not None and result.ok:
+                self.queue.complete(job.id, self.name, result.model_dump())
+                counter('queue_jobs_total', '执行结束的队列任务数', kind='file', result='done').inc()
+            else:
+                error = str(future.exception()) if result is None else 'download incomplete or md5 mismatch'
+                self.queue.fail(job.id, self.name, error)
+                counter('queue_jobs_total', '执行结束的队列任务数', kind='file', result='failed').inc()
+        except Exception as e:
+            logger.warning(f'[{job.id}] queue update error: {e}')
+        finally:
+            with self.lock:
+                self.inflight.discard(job.id)
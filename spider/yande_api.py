@@ -1,45 +1,82 @@
 import os.path
 from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
 from queue import Queue
+from threading import Thread, Event
 from typing import Union, Tuple
 
-import requests
 from urllib.parse import unquote
 from loguru import logger
-from pathvalidate import sanitize_filename
 
 from utils.constant import config
-from utils.downloader import MultiDown
-from utils.items import YandePostData, YandeSearchTags, YandeRunningConfig, IterStatus
+from utils.checkpoint import TagCheckpoint, open_checkpoints
+from utils.downloader import MultiDown, INCOMPLETE_SUFFIXES
+from utils.index import DownIndex, open_index, parse_file_id
+from utils.mirror import MetaMirror
+from utils.query import LocalQuery
+from utils.scheduler import DownScheduler, DownGroup
+from utils.limiter import api_limiter, THROTTLE_STATUS
+from utils.metrics import counter, gauge, histogram, span, start_exporter
+from utils.session import get_session
+from utils.variant import select_variant
+from utils.items import YandePostData, YandePostPage, YandeSearchTags, YandeRunningConfig, IterStatus, TagResult
+
+
+# post.json默认每页数量, 用于按页数换算未完成的下载数上限
+PAGE_SIZE = 40
+
+API_LATENCY = histogram('api_latency_seconds', '列表api请求耗时(含读取响应)')
+API_RETRIES = counter('api_retries_total', '列表api请求失败/限流重试次数')
+API_THROTTLED = counter('throttled_total', '服务端限流次数', target='api')
 
 
 class YandeApi:
     def __init__(self):
-        self.post_api = 'https://yande.re/post.json'
+        self.post_api = config.yande_api.post_api
         self.proxies = config.yande_api.proxies
         self.headers = config.yande_api.headers
 
-    def get_ranking(self, page: int, tags: str = '') -> Union[tuple[bool, bytes], tuple[bool, YandePostData]]:
+    def get_ranking(self, page: int, tags: str = '',
+                    limit: int = None) -> Union[tuple[bool, bytes], tuple[bool, Union[YandePostData, YandePostPage]]]:
         query_params = dict(
             page=page
         )
         if tags:
             query_params.update(dict(tags=tags))
+        if limit:
+            query_params.update(dict(limit=limit))
         req = None
+        session = get_session(self.post_api, config.yande_api.pool_size)
+        limiter = api_limiter(self.post_api)
         for i in range(config.yande_api.retry):
             req = None
             try:
-                req = requests.get(self.post_api,
-                                   params=query_params,
-                                   proxies=self.proxies,
-                                   headers=self.headers)
+                limiter.acquire_request()
+                with API_LATENCY.time():
+                    req = session.get(self.post_api,
+                                      params=query_params,
+                                      proxies=self.proxies,
+                                      headers=self.headers)
+                counter('api_requests_total', '列表api请求数', status=req.status_code).inc()
+                limiter.acquire_bytes(len(req.content))
+                if req.status_code in THROTTLE_STATUS:
+                    # 被限流时退避后重试
+                    API_THROTTLED.inc()
+                    API_RETRIES.inc()
+                    limiter.on_throttle(req.headers.get('Retry-After'))
+                    logger.info(f'[{i + 1}] api throttled {page} {tags}: {req.status_code}')
+                    continue
+                limiter.on_success()
                 if req.status_code > 300:
                     logger.info(f'get api error {page} {tags}: {req.status_code}')
                     return False, req.content
                 else:
                     # 利用pydantic解析request
+                    if config.yande_api.slim_decode:
+                        return True, YandePostPage.model_validate_json(req.content)
                     return True, YandePostData.model_validate_json(req.content)
             except Exception as e:
+                API_RETRIES.inc()
                 logger.warning(f'[{i + 1}] requests error'
                                f'page: {page} tag: {tags}: {e} {req.content if req is not None else req}')
 
@@ -49,6 +86,14 @@ class YandeSpider:
         self.y_api = YandeApi()
         self.download_queue = Queue()
         self.search_config = search_config
+        self.scheduler = DownScheduler()
+        self.index = open_index()
+        self.checkpoints = open_checkpoints()
+        self.db = None
+        if config.database.enable:
+            from utils.database import MariaDBClient
+            self.db = MariaDBClient()
+        start_exporter()
 
     @staticmethod
     def scan_id_in_dir(save_dir_path) -> set:
@@ -56,48 +101,108 @@ class YandeSpider:
         if not os.path.exists(save_dir_path):
             return ret_set
         for entry_dir in os.scandir(save_dir_path):
-            if not entry_dir.is_file():
+            # 跳过未完成的下载
+            if not entry_dir.is_file() or entry_dir.name.endswith(INCOMPLETE_SUFFIXES):
                 continue
             try:
-                yid = entry_dir.name.split(' ', maxsplit=2)[1]
-                yid = int(yid)
-                ret_set.add(yid)
+                ret_set.add(parse_file_id(entry_dir.name))
             except Exception as e:
                 logger.warning(f'{entry_dir.name}:{e}')
                 continue
         return ret_set
 
     @staticmethod
-    def item_iter_and_down(yande_item, save_dir_path, get_config: YandeRunningConfig):
+    def item_iter_and_down(yande_item, save_dir_path, get_config: YandeRunningConfig, group: DownGroup = None,
+                           index: DownIndex = None):
         """
         遍历及下载
         :param yande_item:
         :param save_dir_path:
         :param get_config:
+        :param group: 下载任务组, 为None时逐个阻塞下载
+        :param index: 下载索引, 启用时以索引中该目录的记录代替文件存在检查, 下载完成后写入索引
         :return:
         """
+        from pathvalidate import sanitize_filename
+        tag = get_config.tags
         for i in yande_item.root:
-            fn = sanitize_filename(unquote(i.file_url.rsplit("/", maxsplit=1)[-1]))
             if i.id <= get_config.stop_id:
                 return IterStatus.stop
+            # 按downloader.variant选择下载原图或jpeg/sample, 文件名与重复检查都使用所选版本
+            variant = select_variant(i)
+            fn = sanitize_filename(unquote(variant.url.rsplit("/", maxsplit=1)[-1]))
 
-            # 检查重复后退出或者跳过
-            if ((save_dir_path / fn).exists() or
+            # 检查重复后退出或者跳过, 索引没有记录时以文件是否存在为准
+            exists = (index is not None and index.contains(i.id, save_dir_path)) or (save_dir_path / fn).exists()
+            if (exists or
                     (get_config.id_check and get_config.id_check_list is not None and
                      i.id in get_config.id_check_list)):
                 if get_config.add_flag:
                     continue
                 else:
                     return IterStatus.stop
-            MultiDown(i.file_url, str(save_dir_path), fn, i.file_size, i.md5, i.id)
+            # 其他tag已下载过同一版本时直接链接
+            if index is not None and index.link(i.id, variant.md5, tag, str(save_dir_path / fn), variant.name):
+                continue
+            # 只有原图有md5, 其他版本不做md5校验
+            if group is None:
+                result = MultiDown(variant.url, str(save_dir_path), fn, variant.file_size, variant.md5, i.id).result
+                if index is not None and result.ok:
+                    index.add(tag, result, variant.name)
+            else:
+                # 下载完成后写入索引
+                group.submit(variant.url, str(save_dir_path), fn, variant.file_size, variant.md5, i.id,
+                             callback=None if index is None else
+                             lambda x, v=variant.name: index.add(tag, x, v) if x.ok else '')
         return IterStatus.next
 
+    def reconcile_index(self, b_path) -> int:
+        """
+        按下载目录重建索引
+        :param b_path:
+        :return:
+        """
+        index = self.index if self.index is not None else DownIndex()
+        return index.reconcile(b_path)
+
+    def redownload(self, queue_path: str) -> TagResult:
+        """
+        重新下载audit输出的异常文件, 下载完成后原子替换原文件
+        :param queue_path: audit输出的JSON lines文件
+        :return:
+        """
+        from utils.audit import load_queue
+        group = self.scheduler.group()
+        skipped = 0
+        try:
+            for item in load_queue(queue_path):
+                if not item.get('file_url'):
+                    # 镜像中没有该图片时无法得知下载地址
+                    logger.warning(f'[{item["id"]}] no file_url, skip: {item["path"]}')
+                    skipped += 1
+                    continue
+                save_dir_path, fn = os.path.split(item['path'])
+                tag, variant = item['tag'], item.get('variant', 'original')
+                group.submit(item['file_url'], save_dir_path, fn, item.get('expected_size') or 0,
+                             item.get('expected_md5'), item['id'],
+                             callback=None if self.index is None else
+                             lambda x, t=tag, v=variant: self.index.add(t, x, v) if x.ok else '')
+        finally:
+            results = group.wait()
+        ok_results = [r for r in results if r.ok]
+        logger.info(f'redownload finish: {len(ok_results)} ok, {len(results) - len(ok_results)} failed, '
+                    f'{skipped} skipped')
+        return TagResult(tag=queue_path, count=len(ok_results), bytes=sum(r.file_size for r in ok_results),
+                         failed=len(results) - len(ok_results) + skipped)
+
     def search_trans(self):
         pass
 
-    def get_post_list(self, get_config: YandeRunningConfig = None):
+    def get_post_list(self, get_config: YandeRunningConfig = None) -> TagResult:
         """
         获取yande搜索列表
+        启用index.checkpoint时按tag与下载目录记录进度, 以上次的high_water为stop_id
+        上次未完成时从已完整下载的位置继续, 继续时总是跳过已存在的文件(add_flag), 以免停在上次已下载的文件上
         :param get_config:
         :return:
         """
@@ -108,39 +213,247 @@ class YandeSpider:
         e_page = get_config.end_page if get_config.end_page > 0 else 100
         s_page, e_page = (e_page, s_page) if s_page > e_page else (s_page, e_page)
         tags = get_config.tags
-
+        query = tags.replace('tag_', '')
+        max_id = get_config.stop_id
         save_dir_path = get_config.save_dir_path
         if save_dir_path is None:
             save_dir_path = Path('.', tags)
         else:
             save_dir_path = Path(save_dir_path)
+        checkpoint = self.checkpoints.get(tags, save_dir_path) if self.checkpoints is not None else None
+        if checkpoint is not None:
+            if checkpoint.running:
+                # 按id而不是页码继续, 期间新增的图片不会使位置偏移
+                query = f'{query} id:<{checkpoint.low_id}'.strip()
+                s_page, e_page = 1, e_page - s_page + 1
+                stop_id = max(get_config.stop_id, checkpoint.run_stop_id)
+                max_id = max(max_id, checkpoint.run_max_id)
+                logger.info(f'*search resume\t{"[" + tags + "]":>20} \tfrom id:{checkpoint.low_id}')
+                # 失败的页面中已下载的文件跳过, 失败的文件重新下载
+                get_config = get_config.model_copy(update=dict(stop_id=stop_id, add_flag=True))
+            else:
+                stop_id = checkpoint.run_stop_id = max(get_config.stop_id, checkpoint.high_water)
+                get_config = get_config.model_copy(update=dict(stop_id=stop_id))
+
         logger.info(f'*search start\t{"[" + tags + "]":>20} \tdown path:{save_dir_path}')
-        for page in range(s_page, e_page):
-
-            if not save_dir_path.exists():
-                os.makedirs(save_dir_path)
-            # status, yande_item = self.y_api.get_ranking(page, tags='rating:e width:>=10000 ext:png')
-            status, yande_item = self.y_api.get_ranking(page, tags=tags.replace('tag_', ''))
-            if len(yande_item.root) == 0:
-                logger.info(f'**search finish\t{"[" + tags + "]":>20}')
+        # 列表页预取, 下载当前页时后台继续获取后续页面
+        page_q = Queue(max(1, config.yande_api.prefetch_pages))
+        stop_event = Event()
+        Thread(target=self.page_producer,
+               args=(query, s_page, e_page, get_config.stop_id, page_q, stop_event),
+               daemon=True).start()
+        # 整个tag的下载任务交给调度器并发执行, 未完成的下载不超过prefetch_pages页, 列表页只领先下载这么多页
+        group = self.scheduler.group(max(1, config.yande_api.prefetch_pages) * PAGE_SIZE)
+        finished = False
+        # 搜索到最后或stop_id时才算完整结束, 页数上限/获取失败/中断时下次继续
+        complete = False
+        # 每页的(最小id, 提交后的任务数), 该页之前的任务全部成功后记录进度
+        page_marks = []
+        queue_depth = gauge('page_queue_depth', '已预取未处理的列表页数', tag=tags)
+        try:
+            while True:
+                yande_item = page_q.get()
+                queue_depth.set(page_q.qsize())
+                if yande_item is None:
+                    finished = True
+                    break
+
+                if not save_dir_path.exists():
+                    os.makedirs(save_dir_path)
+                if len(yande_item.root) == 0:
+                    logger.info(f'**search finish\t{"[" + tags + "]":>20}')
+                    complete = True
+                    break
+                max_id = max(max_id, max(i.id for i in yande_item.root))
+                self.save_meta(yande_item)
+                iter_status = self.item_iter_and_down(yande_item, save_dir_path, get_config, group, self.index)
+                if iter_status == IterStatus.stop:
+                    complete = True
+                    break
+                if checkpoint is not None:
+                    page_marks.append((min(i.id for i in yande_item.root), len(group.futures)))
+                    self.save_checkpoint(checkpoint, page_marks, group, max_id)
+        finally:
+            # 通知预取线程停止, 并清空队列使其退出
+            stop_event.set()
+            while not finished:
+                finished = page_q.get() is None
+            results = group.wait()
+            if checkpoint is not None:
+                self.save_checkpoint(checkpoint, page_marks, group, max_id)
+        ok_results = [r for r in results if r.ok]
+        if checkpoint is not None:
+            checkpoint.run_max_id = max_id
+            if complete and not page_marks and len(ok_results) == len(group.futures):
+                self.checkpoints.finish(checkpoint)
+        return TagResult(tag=tags, max_id=max_id, count=len(ok_results),
+                         bytes=sum(r.file_size for r in ok_results), failed=len(results) - len(ok_results))
+
+    def save_checkpoint(self, checkpoint: TagCheckpoint, page_marks: list, group: DownGroup, max_id: int):
+        """
+        从最早的页面开始, 页面及之前的下载任务全部成功后记录为已完整下载
+        :param page_marks: [(页面最小id, 提交后的任务数), ...], 已记录的页面会被移除
+        """
+        done = checkpoint.pages
+        low_id = 0
+        while page_marks:
+            page_low_id, end = page_marks[0]
+            futures = group.futures[:end]
+            if not all(t.done() for t in futures):
                 break
-            iter_status = self.item_iter_and_down(yande_item, save_dir_path, get_config)
-            if iter_status == IterStatus.stop:
+            if any(t.exception() is not None or not t.result().ok for t in futures):
+                # 有失败的文件时不再前进, 下次从失败的页面继续
                 break
+            page_marks.pop(0)
+            done += 1
+            low_id = page_low_id
+        if low_id:
+            checkpoint.run_max_id = max(checkpoint.run_max_id, max_id)
+            self.checkpoints.progress(checkpoint, low_id, done)
 
-    def update_tags(self, tag_list, b_path, get_config: YandeRunningConfig = YandeRunningConfig()):
+    def save_meta(self, yande_item: Union[YandePostData, YandePostPage]):
         """
-        批量搜索tag
-        :param tag_list:
-        :param b_path:
-        :param get_config:
+        启用数据库时批量写入一页的图片信息
+        """
+        if self.db is None:
+            return
+        try:
+            self.db.insert_page(yande_item.root)
+        except Exception as e:
+            logger.warning(f'save meta error: {e}')
+
+    def page_producer(self, tags: str, s_page: int, e_page: int, stop_id: int, page_q: Queue, stop_event: Event,
+                      limit: int = None):
+        """
+        按顺序获取列表页放入有界队列, 队列结束时放入None
+        :param tags:
+        :param s_page:
+        :param e_page:
+        :param stop_id: 页面内已包含不大于stop_id的图片时不再获取后续页面
+        :param page_q:
+        :param stop_event: 消费端提前结束时设置
+        :param limit: 每页数量
+        :return:
+        """
+        try:
+            for page in range(s_page, e_page):
+                if stop_event.is_set():
+                    break
+                # status, yande_item = self.y_api.get_ranking(page, tags='rating:e width:>=10000 ext:png')
+                with span('list', trace=tags, page=page) as attrs:
+                    ret = self.y_api.get_ranking(page, tags=tags, limit=limit)
+                    attrs['count'] = len(ret[1].root) if ret is not None and ret[0] else None
+                if ret is None or not ret[0]:
+                    logger.warning(f'get page failed, stop search: {page} {tags}')
+                    break
+                yande_item = ret[1]
+                page_q.put(yande_item)
+                if len(yande_item.root) == 0 or yande_item.root[-1].id <= stop_id:
+                    break
+        except Exception as e:
+            logger.warning(f'page producer error {tags}: {e}')
+        finally:
+            page_q.put(None)
+
+    def mirror_meta(self, tags: str = '', mirror: MetaMirror = None, e_page: int = 0) -> int:
+        """
+        只获取元数据写入本地镜像, 按id升序(order:id)从该搜索条件已镜像的最大id之后增量获取(id:>N)
+        每页写入后即更新增量起点, 限制页数或中断后下次从该位置继续
+        :param tags: 搜索条件, 为空时镜像全站
+        :param mirror: 默认使用mirror.path
+        :param e_page: 最多获取的页数, 0为不限制
+        :return: 写入的条数
+        """
+        mirror = mirror or MetaMirror()
+        since_id = max_id = mirror.max_id(tags)
+        logger.info(f'*mirror start\t{"[" + tags + "]":>20} \tsince id:{since_id}')
+        count = 0
+        page = 0
+        # 按id做keyset分页, 每次都取第1页, 深度翻页不会变慢, 期间新增图片也不会造成页面偏移
+        while e_page <= 0 or page < e_page:
+            query = f'{tags} order:id id:>{max_id}'.strip()
+            with span('list', trace=tags, page=page + 1) as attrs:
+                ret = self.y_api.get_ranking(1, tags=query, limit=config.mirror.limit)
+                attrs['count'] = len(ret[1].root) if ret is not None and ret[0] else None
+            if ret is None or not ret[0]:
+                logger.warning(f'get page failed, stop mirror: {query}')
+                break
+            items = ret[1].root
+            if len(items) == 0:
+                break
+            count += mirror.add_page(items)
+            # 升序获取时已写入的页面之前没有遗漏, 可以直接作为下次的起点
+            max_id = max(max_id, max(i.id for i in items))
+            mirror.set_max_id(tags, max_id)
+            page += 1
+        logger.info(f'**mirror finish\t{"[" + tags + "]":>20} \t{count} posts, max id:{max_id}')
+        return count
+
+    def download_query(self, expr: str, save_dir_path=None, query: LocalQuery = None,
+                       get_config: YandeRunningConfig = None) -> TagResult:
+        """
+        在本地镜像中查询并下载结果, 不调用列表api
+        :param expr: yande风格搜索条件
+        :param save_dir_path: 默认为./{expr}
+        :param query: 默认基于mirror.path的镜像
+        :param get_config: 基础配置, 已下载的文件总是跳过
         :return:
         """
-        for tag, stop_id, add_flag in tag_list:
-            get_config.tags = tag
-            get_config.stop_id = stop_id
-            get_config.save_dir_path = Path(b_path) / tag
-            if get_config.id_check:
-                get_config.id_check_list = YandeSpider.scan_id_in_dir(get_config.save_dir_path)
-            get_config.add_flag = add_flag
-            self.get_post_list(get_config)
+        from pathvalidate import sanitize_filename
+        query = query or LocalQuery()
+        ids = query.search(expr)
+        save_dir_path = Path(save_dir_path) if save_dir_path is not None else Path('.', sanitize_filename(expr))
+        get_config = (get_config or YandeRunningConfig()).model_copy(
+            update=dict(tags=expr, save_dir_path=str(save_dir_path), stop_id=0, add_flag=True))
+        if get_config.id_check and get_config.id_check_list is None:
+            get_config.id_check_list = YandeSpider.scan_id_in_dir(save_dir_path)
+        logger.info(f'*local query\t{"[" + expr + "]":>20} \t{len(ids)} posts, down path:{save_dir_path}')
+        if not save_dir_path.exists():
+            os.makedirs(save_dir_path)
+        group = self.scheduler.group()
+        try:
+            for n in range(0, len(ids), 100):
+                self.item_iter_and_down(query.posts(ids[n:n + 100]), save_dir_path, get_config, group, self.index)
+        finally:
+            results = group.wait()
+        ok_results = [r for r in results if r.ok]
+        return TagResult(tag=expr, max_id=ids[0] if ids else 0, count=len(ok_results),
+                         bytes=sum(r.file_size for r in ok_results), failed=len(results) - len(ok_results))
+
+    def update_tags(self, tag_list, b_path, get_config: YandeRunningConfig = None, tag_num: int = None) -> list:
+        """
+        批量搜索tag, 多个tag并行搜索, 下载共用同一个调度器与限速
+        :param tag_list: [(tag, stop_id, add_flag), ...], 启用index.checkpoint时可以只传tag
+        :param b_path:
+        :param get_config: 各tag共用的基础配置, 不会被修改
+        :param tag_num: 同时搜索的tag数, 默认为yande_api.tag_num
+        :return: 与tag_list顺序一致的TagResult列表
+        """
+        if get_config is None:
+            get_config = YandeRunningConfig()
+        # 只有tag时由进度记录决定停止位置
+        tag_list = [(t, 0, False) if isinstance(t, str) else t for t in tag_list]
+        with ThreadPoolExecutor(max_workers=max(1, tag_num or config.yande_api.tag_num),
+                                thread_name_prefix='tag') as executor:
+            futures = [executor.submit(self.update_tag, tag, stop_id, add_flag, b_path, get_config)
+                       for tag, stop_id, add_flag in tag_list]
+        results = []
+        for (tag, stop_id, _), future in zip(tag_list, futures):
+            if future.exception() is not None:
+                logger.warning(f'update tag error {tag}: {future.exception()}')
+                results.append(TagResult(tag=tag, max_id=stop_id))
+            else:
+                results.append(future.result())
+        return results
+
+    def update_tag(self, tag, stop_id, add_flag, b_path, get_config: YandeRunningConfig) -> TagResult:
+        """
+        搜索单个tag, 在基础配置的副本上设置本tag的参数
+        """
+        save_dir_path = Path(b_path) / tag
+        tag_config = get_config.model_copy(update=dict(tags=tag, stop_id=stop_id, add_flag=add_flag,
+                                                       save_dir_path=str(save_dir_path)))
+        if tag_config.id_check:
+            # 索引可能不完整(对已有目录启用索引时), id检查总是扫描目录
+            tag_config.id_check_list = YandeSpider.scan_id_in_dir(save_dir_path)
+        return self.get_post_list(tag_config)
@@ -0,0 +1,77 @@
+"""
+单元测试共用的配置与模拟服务器
+"""
+import sys
+from contextlib import contextmanager
+from datetime import datetime
+
+sys.path.insert(0, '..')
+sys.path.insert(0, '../benchmark')
+
+from utils.constant import config, Config
+from utils.downloader import MultiDown, RangeJournal
+from utils.items import FileInfo
+
+
+@contextmanager
+def local_config(**sections):
+    """
+    测试期间使用不经过代理的配置, 连接本地模拟服务器
+    :param sections: 覆盖的配置项, 如 downloader=dict(split_size=1024)
+    """
+    cfg = Config().model_dump()
+    cfg['yande_api'].update(proxies=None, retry=2, backoff=0.1)
+    cfg['downloader'].update(progress='none')
+    cfg['metrics'].update(path='', trace_path='')
+    for name, update in sections.items():
+        cfg[name].update(update)
+    old = config._config
+    config._config = Config(**cfg)
+    try:
+        yield config
+    finally:
+        config._config = old
+
+
+@contextmanager
+def mock_yande(files: int = 1, size: int = 300000, **kwargs):
+    """
+    启动本地模拟的yande.re
+    """
+    from mock_server import MockYande
+    yande = MockYande(files, size, size_jitter=0, **kwargs)
+    yande.start()
+    try:
+        yield yande
+    finally:
+        yande.stop()
+
+
+def write_part(yande, post: dict, file_path: str, done: list):
+    """
+    按模拟文件的内容写入已完成的区间, 其余部分为0, 并保存下载记录
+    """
+    f = yande.files[post['md5']]
+    journal = RangeJournal(FileInfo(url=post['file_url'], file_path=file_path, file_size=f.size, md5=post['md5']))
+    MultiDown.allocate_file(journal.part_path, f.size)
+    with open(journal.part_path, 'rb+') as fp:
+        for s, e in done:
+            for pos, data in f.iter_range(s, e):
+                fp.seek(pos)
+                fp.write(data)
+    journal.done = list(done)
+    journal.save()
+    return journal
+
+
+def post_item(_id: int) -> dict:
+    return dict(id=_id, tags='tag_a tag_b', created_at=datetime(2023, 1, 1), updated_at=datetime(2023, 1, 1),
+                creator_id=1, author='author', change=1, source='', score=10, md5=f'{_id:032x}',
+                file_size=1024, file_ext='png', file_url=f'https://files.yande.re/image/{_id}.png',
+                is_shown_in_index=True, preview_url='', preview_width=150, preview_height=150,
+                actual_preview_width=300, actual_preview_height=300, sample_url='', sample_width=1500,
+                sample_height=1500, sample_file_size=512, jpeg_url='', jpeg_width=3000, jpeg_height=3000,
+                jpeg_file_size=768, rating='s', is_rating_locked=False, has_children=False, parent_id=None,
+                status='active', is_pending=False, width=3000, height=3000, is_held=False,
+                frames_pending_string='', frames_pending=[], frames_string='', frames=[], is_note_locked=False,
+                last_noted_at=0, last_commented_at=0)
@@ -0,0 +1,52 @@
+import os
+import tempfile
+import unittest
+import sys
+
+sys.path.insert(0, '..')
+
+from utils.adaptive import AdaptiveTuner
+from utils.downloader import MultiDown, RangeTask
+from helpers import local_config, mock_yande
+
+
+class MyTestCase(unittest.TestCase):
+    def test_steal(self):
+        with local_config(downloader=dict(min_split_size=10)):
+            self.assertIsNone(MultiDown.steal([]))
+            slow, fast = RangeTask(0, 99), RangeTask(100, 129)
+            slow.pos = 20
+            # 从剩余最多的分段拆出后半段
+            task = MultiDown.steal([fast, slow])
+            self.assertEqual((task.s, task.e, task.pos), (60, 99, 60))
+            self.assertEqual(slow.e, 59)
+            # 剩余不足两个最小分段时不拆分
+            fast.pos = 115
+            self.assertIsNone(MultiDown.steal([fast]))
+
+    def test_tuner(self):
+        with local_config(downloader=dict(thread_num=2, max_thread_num=4, adaptive_window=0, min_split_size=10,
+                                          max_split_size=1000, adaptive_range_seconds=1)):
+            tuner = AdaptiveTuner('127.0.0.1')
+            self.assertEqual(tuner.concurrency, 2)
+            tuner.on_range_done(100, 1)
+            self.assertEqual(tuner.concurrency, 3)
+            self.assertEqual(tuner.split_size, 100)
+            # 限流时并发减半, 分段加大, 冷却期内不再增加并发
+            tuner.on_throttle()
+            self.assertEqual((tuner.concurrency, tuner.split_size), (1, 200))
+            tuner.on_range_done(10 ** 6, 0.001)
+            self.assertEqual(tuner.concurrency, 1)
+            self.assertEqual(tuner.split_size, 1000)
+
+    def test_adaptive_download(self):
+        with tempfile.TemporaryDirectory() as tmp, mock_yande(size=400000) as yande, \
+                local_config(downloader=dict(adaptive=True, split_size=50000, min_split_size=20000)):
+            post = yande.posts[0]
+            result = MultiDown(post['file_url'], tmp, 'a.png', post['file_size'], post['md5'], post['id']).result
+            self.assertTrue(result.ok)
+            self.assertEqual(os.path.getsize(os.path.join(tmp, 'a.png')), post['file_size'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,76 @@
+import os
+import tempfile
+import unittest
+import sys
+from importlib.util import find_spec
+from time import monotonic
+from unittest import mock
+
+sys.path.insert(0, '..')
+
+from helpers import local_config, mock_yande, write_part
+
+
+@unittest.skipUnless(find_spec('aiohttp'), 'async引擎需要aiohttp')
+class MyTestCase(unittest.TestCase):
+    def test_engine(self):
+        from utils.async_downloader import AsyncDownEngine
+        with tempfile.TemporaryDirectory() as tmp, mock_yande(files=4, size=200000) as yande, \
+                local_config(downloader=dict(split_size=60000, write_size=16384)):
+            engine = AsyncDownEngine(3)
+            done = []
+            futures = [engine.submit(p['file_url'], tmp, f'{p["id"]}.png', p['file_size'], p['md5'], p['id'],
+                                     callback=done.append) for p in yande.posts]
+            results = [f.result() for f in futures]
+            engine.shutdown()
+            self.assertEqual(len(done), 4)
+            self.assertTrue(all(r.ok and r.verified for r in results))
+            for p in yande.posts:
+                self.assertEqual(os.path.getsize(os.path.join(tmp, f'{p["id"]}.png')), p['file_size'])
+
+    def test_resume(self):
+        from utils.async_downloader import AsyncDownEngine
+        with tempfile.TemporaryDirectory() as tmp, mock_yande() as yande, \
+                local_config(downloader=dict(split_size=100000)):
+            post = yande.posts[0]
+            write_part(yande, post, os.path.join(tmp, 'a.png'), [(100000, 199999)])
+            engine = AsyncDownEngine(2)
+            result = engine.submit(post['file_url'], tmp, 'a.png', post['file_size'], post['md5'], post['id']).result()
+            engine.shutdown()
+            self.assertTrue(result.ok)
+            self.assertEqual(yande.stats['bytes'], post['file_size'] - 100000)
+
+    def test_stalled_response(self):
+        import aiohttp
+        from utils.async_downloader import AsyncDownEngine
+        with tempfile.TemporaryDirectory() as tmp, mock_yande(stall=2) as yande, local_config(), \
+                mock.patch('utils.async_downloader.RANGE_TIMEOUT',
+                           aiohttp.ClientTimeout(total=None, connect=30, sock_connect=5, sock_read=0.3)):
+            post = yande.posts[0]
+            engine = AsyncDownEngine(2)
+            begin = monotonic()
+            result = engine.submit(post['file_url'], tmp, 'a.png', post['file_size'], post['md5'], post['id']).result()
+            engine.shutdown()
+            # 响应头之后不再发送数据时按sock_read超时失败, 不会一直占用传输
+            self.assertFalse(result.complete)
+            self.assertLess(monotonic() - begin, 1.5)
+
+    def test_throttle_not_hold_transfer(self):
+        from utils.async_downloader import AsyncDownEngine
+        from utils.limiter import file_limiter
+        with tempfile.TemporaryDirectory() as tmp, mock_yande() as throttled, mock_yande() as yande, local_config():
+            a, b = throttled.posts[0], yande.posts[0]
+            file_limiter(a['file_url']).on_throttle('2')
+            engine = AsyncDownEngine(1)
+            begin = monotonic()
+            future_a = engine.submit(a['file_url'], tmp, 'a.png', a['file_size'], a['md5'], a['id'])
+            result_b = engine.submit(b['file_url'], tmp, 'b.png', b['file_size'], b['md5'], b['id']).result()
+            # 被限流的host等待时其他host的文件可以使用唯一的传输并发
+            self.assertLess(monotonic() - begin, 1.5)
+            self.assertTrue(result_b.ok)
+            self.assertTrue(future_a.result().ok)
+            engine.shutdown()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,104 @@
+import io
+import json
+import os
+import tempfile
+import unittest
+import sys
+from hashlib import md5
+
+sys.path.insert(0, '..')
+
+from utils.audit import audit_file, ArchiveAuditor, load_queue
+from utils.index import DownIndex
+from utils.items import YandePostPage, DownResult
+from utils.mirror import MetaMirror
+from helpers import local_config, mock_yande
+
+
+def write_archive(yande, b_path: str, index: DownIndex):
+    """
+    按模拟文件写入两个tag目录:
+    tag_a: 1正常, 2内容损坏; tag_b: 3末尾为零, 4为索引中记录的jpeg版本且被截断, 99不在镜像中
+    """
+    def content(post: dict) -> bytes:
+        return b''.join(data for _, data in yande.files[post['md5']].iter_range(0, post['file_size'] - 1))
+
+    posts = {p['id']: p for p in yande.posts}
+    files = {('tag_a', 1): content(posts[1]),
+             ('tag_a', 2): b'\x01' * posts[2]['file_size'],
+             ('tag_b', 3): content(posts[3])[:-5000] + b'\x00' * 5000,
+             ('tag_b', 4): content(posts[4])[:-100],
+             ('tag_b', 99): b'\x01' * 1000}
+    for (tag, _id), data in files.items():
+        path = os.path.join(b_path, tag, f'yande.re {_id} mock.png')
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as f:
+            f.write(data)
+    # 未完成的下载记录不参与检查
+    open(os.path.join(b_path, 'tag_b', 'yande.re 5 mock.png.part.json.tmp'), 'w').close()
+    index.add('tag_a', DownResult(id=1, file_path=os.path.join(b_path, 'tag_a', 'yande.re 1 mock.png'),
+                                  file_size=posts[1]['file_size'], md5=posts[1]['md5'], complete=True))
+    index.add('tag_b', DownResult(id=4, file_path=os.path.join(b_path, 'tag_b', 'yande.re 4 mock.png'),
+                                  file_size=posts[4]['file_size'], md5=posts[4]['md5'], complete=True), 'jpeg')
+
+
+class MyTestCase(unittest.TestCase):
+    def test_audit_file(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'yande.re 1 a.png')
+            data = os.urandom(10000) + b'\x01'
+            with open(path, 'wb') as f:
+                f.write(data)
+            file_md5 = md5(data).hexdigest()
+            self.assertEqual(audit_file(path, len(data), file_md5)['status'], 'ok')
+            self.assertEqual(audit_file(path, len(data) + 1, file_md5)['status'], 'size_mismatch')
+            self.assertEqual(audit_file(path, len(data), '0' * 32)['status'], 'md5_mismatch')
+            # 预分配后未写完的文件末尾为零, 无md5时也能发现
+            with open(path, 'r+b') as f:
+                f.seek(-5000, 2)
+                f.write(b'\x00' * 5000)
+            self.assertEqual(audit_file(path, len(data))['status'], 'zero_tail')
+            self.assertEqual(audit_file(os.path.join(tmp, 'missing.png'))['status'], 'unreadable')
+
+    def test_run_and_redownload(self):
+        with tempfile.TemporaryDirectory() as tmp, mock_yande(files=5, size=20000) as yande:
+            base_url = yande.posts[0]['file_url'].split('/image/')[0]
+            b_path = os.path.join(tmp, 'archive')
+            index_path = os.path.join(tmp, 'index.db')
+            with local_config(yande_api=dict(post_api=f'{base_url}/post.json'),
+                              index=dict(enable=True, path=index_path)):
+                index = DownIndex(index_path)
+                mirror = MetaMirror(os.path.join(tmp, 'mirror.db'))
+                mirror.add_page(YandePostPage.model_validate_json(json.dumps(yande.posts)).root)
+                write_archive(yande, b_path, index)
+                out = io.StringIO()
+                summary = ArchiveAuditor(index, mirror, workers=2).run(b_path, out)
+                self.assertEqual(summary, dict(ok=2, md5_mismatch=1, zero_tail=1, size_mismatch=1))
+                queue_path = os.path.join(tmp, 'queue.jsonl')
+                with open(queue_path, 'w', encoding='utf-8') as f:
+                    f.write(out.getvalue())
+                queue = sorted(load_queue(queue_path), key=lambda x: x['id'])
+                posts = {p['id']: p for p in yande.posts}
+                # 原图以镜像为准, 其他版本只有索引中的记录, 没有下载地址
+                self.assertEqual([(i['id'], i['tag'], i['status'], i['variant'], i['file_url']) for i in queue],
+                                 [(2, 'tag_a', 'md5_mismatch', 'original', posts[2]['file_url']),
+                                  (3, 'tag_b', 'zero_tail', 'original', posts[3]['file_url']),
+                                  (4, 'tag_b', 'size_mismatch', 'jpeg', None)])
+                self.assertEqual(queue[0]['expected_md5'], posts[2]['md5'])
+                index.close()
+                mirror.close()
+
+                from spider.yande_api import YandeSpider
+                spider = YandeSpider()
+                result = spider.redownload(queue_path)
+                spider.scheduler.shutdown()
+                # 没有下载地址的文件跳过
+                self.assertEqual((result.count, result.failed), (2, 1))
+                for _id in (2, 3):
+                    path = os.path.join(b_path, queue[_id - 2]['tag'], f'yande.re {_id} mock.png')
+                    self.assertEqual(audit_file(path, posts[_id]['file_size'], posts[_id]['md5'])['status'], 'ok')
+                    self.assertTrue(spider.index.contains(_id, os.path.dirname(path)))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,63 @@
+import os
+import tempfile
+import unittest
+import sys
+
+sys.path.insert(0, '..')
+
+from utils.checkpoint import CheckpointStore
+from utils.items import YandeRunningConfig
+from helpers import local_config, mock_yande
+
+
+class MyTestCase(unittest.TestCase):
+    def test_progress_and_finish(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            db_path = os.path.join(tmp, 'index.db')
+            store = CheckpointStore(db_path)
+            cp = store.get('tag_a', os.path.join(tmp, 'tag_a'))
+            self.assertFalse(cp.running)
+            cp.run_max_id, cp.run_stop_id = 100, 10
+            store.progress(cp, 60, 2)
+            store.close()
+
+            # 重新打开后从中断的位置继续
+            store = CheckpointStore(db_path)
+            cp = store.get('tag_a', os.path.join(tmp, 'tag_a'))
+            self.assertTrue(cp.running)
+            self.assertEqual((cp.low_id, cp.pages, cp.run_max_id, cp.run_stop_id), (60, 2, 100, 10))
+            store.finish(cp)
+            cp = store.get('tag_a', os.path.join(tmp, 'tag_a'))
+            self.assertFalse(cp.running)
+            self.assertEqual(cp.high_water, 100)
+            self.assertEqual(store.get('tag_b', os.path.join(tmp, 'tag_b')).high_water, 0)
+            store.close()
+
+    def test_save_dir(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            store = CheckpointStore(os.path.join(tmp, 'index.db'))
+            cp = store.get('tag_a', os.path.join(tmp, 'a', 'tag_a'))
+            cp.run_max_id = 100
+            store.finish(cp)
+            # 同一tag下载到其他目录时从头搜索
+            self.assertEqual(store.get('tag_a', os.path.join(tmp, 'b', 'tag_a')).high_water, 0)
+            self.assertEqual(store.get('tag_a', os.path.join(tmp, 'a', '.', 'tag_a')).high_water, 100)
+            store.close()
+
+    def test_spider_save_dir(self):
+        with tempfile.TemporaryDirectory() as tmp, mock_yande(files=4, size=1000) as yande:
+            base_url = yande.posts[0]['file_url'].split('/image/')[0]
+            with local_config(yande_api=dict(post_api=f'{base_url}/post.json'),
+                              index=dict(path=os.path.join(tmp, 'index.db'), checkpoint=True)):
+                from spider.yande_api import YandeSpider
+                spider = YandeSpider()
+                # 默认的空tag下载到不同目录时各自完整下载, 同一目录再次搜索时没有新图片
+                for save_dir, count in (('a', 4), ('b', 4), ('a', 0)):
+                    ret = spider.get_post_list(YandeRunningConfig(tags='', save_dir_path=os.path.join(tmp, save_dir)))
+                    self.assertEqual((ret.count, ret.max_id), (count, 4))
+                    self.assertEqual(len(os.listdir(os.path.join(tmp, save_dir))), 4)
+                spider.scheduler.shutdown()
+
+
+if __name__ == '__main__':
+    unittest.main()
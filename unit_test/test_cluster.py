@@ -0,0 +1,45 @@
+import os
+import tempfile
+import unittest
+import sys
+
+sys.path.insert(0, '..')
+
+from utils.work_queue import WorkQueue
+from helpers import local_config, mock_yande
+
+
+class MyTestCase(unittest.TestCase):
+    def test_coordinator_worker(self):
+        with tempfile.TemporaryDirectory() as tmp, mock_yande(files=5, size=1000) as yande:
+            base_url = yande.posts[0]['file_url'].split('/image/')[0]
+            with local_config(yande_api=dict(post_api=f'{base_url}/post.json'), queue=dict(poll=0.1, heartbeat=0.5),
+                              index=dict(enable=True, checkpoint=True, path=os.path.join(tmp, 'index.db'))):
+                from spider.cluster import Coordinator, QueueWorker
+                queue = WorkQueue(os.path.join(tmp, 'queue.db'))
+                coordinator = Coordinator(queue)
+                first, = coordinator.add_tags(['tag_a'], os.path.join(tmp, 'a'))
+                # 1个tag任务与5个文件任务
+                self.assertEqual(QueueWorker(queue, name='w1').run(exit_idle=True), 6)
+                ret = coordinator.commit()
+                self.assertEqual([(r.tag, r.max_id, r.count, r.failed) for r in ret], [('tag_a', 5, 5, 0)])
+                self.assertEqual(len(os.listdir(os.path.join(tmp, 'a', 'tag_a'))), 5)
+                self.assertEqual(coordinator.index.ids(os.path.join(tmp, 'a', 'tag_a')), {1, 2, 3, 4, 5})
+                self.assertEqual(coordinator.checkpoints.get('tag_a', os.path.join(tmp, 'a', 'tag_a')).high_water, 5)
+
+                # 同一tag下载到其他目录时为新的任务, 全部重新下载
+                second, = coordinator.add_tags(['tag_a'], os.path.join(tmp, 'b'))
+                self.assertNotEqual(first, second)
+                self.assertEqual(QueueWorker(queue, name='w2').run(exit_idle=True), 6)
+                self.assertEqual([(r.tag, r.count) for r in coordinator.commit()], [('tag_a', 5)])
+                self.assertEqual(len(os.listdir(os.path.join(tmp, 'b', 'tag_a'))), 5)
+
+                # 原目录没有新图片
+                self.assertEqual(coordinator.add_tags(['tag_a'], os.path.join(tmp, 'a')), [first])
+                self.assertEqual(QueueWorker(queue, name='w3').run(exit_idle=True), 1)
+                self.assertEqual([(r.tag, r.count) for r in coordinator.commit()], [('tag_a', 0)])
+                queue.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,39 @@
+import os
+import tempfile
+import unittest
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, '..')
+
+from utils.database import MariaDBClient
+from utils.items import YandePostData
+from helpers import post_item
+
+
+class MyTestCase(unittest.TestCase):
+    def test_insert_page(self):
+        sql_cli = MariaDBClient('sqlite://')
+        page = YandePostData.model_validate([post_item(i) for i in (3, 2, 1, 1)])
+        self.assertEqual(sql_cli.insert_page(page.root, batch_size=2), 3)
+        page = YandePostData.model_validate([post_item(i) for i in (5, 4, 3)])
+        self.assertEqual(sql_cli.insert_pages([page]), 2)
+        self.assertEqual(sql_cli.session.query(MariaDBClient.YandeData).count(), 5)
+        sql_cli.close()
+
+    def test_insert_page_concurrent(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            sql_cli = MariaDBClient(f'sqlite:///{os.path.join(tmp, "yande.db")}')
+            # 并行的tag搜索写入互相重叠的页面
+            pages = [YandePostData.model_validate([post_item(i) for i in range(n * 10, n * 10 + 40)])
+                     for n in range(8)]
+            with ThreadPoolExecutor(max_workers=8) as executor:
+                inserted = sum(executor.map(lambda page: sql_cli.insert_page(page.root, batch_size=15), pages))
+            self.assertEqual(sql_cli.session.query(MariaDBClient.YandeData).count(), 110)
+            self.assertEqual(inserted, 110)
+            sql_cli.close()
+            sql_cli.session.bind.dispose()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,90 @@
+import os
+import tempfile
+import unittest
+import sys
+
+sys.path.insert(0, '..')
+
+from utils.index import DownIndex
+from utils.items import DownResult, YandeRunningConfig
+from helpers import local_config, mock_yande
+
+
+class MyTestCase(unittest.TestCase):
+    def test_add_and_reconcile(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            index = DownIndex(os.path.join(tmp, 'index.db'))
+            other = os.path.join(tmp, 'other', 'tag_a')
+            os.makedirs(other)
+            with open(os.path.join(other, 'x'), 'wb') as f:
+                f.write(b'123')
+            index.add('tag_a', DownResult(id=1, file_path=os.path.join(other, 'x'), file_size=3, md5='abc',
+                                          complete=True))
+            self.assertTrue(index.contains(1, other))
+            # 同一tag的其他下载目录不算已下载
+            self.assertFalse(index.contains(1, os.path.join(tmp, 'pic', 'tag_a')))
+
+            b_path = os.path.join(tmp, 'pic')
+            os.makedirs(os.path.join(b_path, 'tag_b'))
+            for name in ('yande.re 2 tag_b.png', 'yande.re 3 tag_b.png.part', 'yande.re 3 tag_b.png.part.json.tmp',
+                         'readme.txt'):
+                with open(os.path.join(b_path, 'tag_b', name), 'wb') as f:
+                    f.write(b'123')
+            index.add('tag_a', DownResult(id=4, file_path=os.path.join(b_path, 'tag_a', 'y'), complete=True))
+            self.assertEqual(index.reconcile(b_path), 1)
+            self.assertEqual(index.ids(os.path.join(b_path, 'tag_b')), {2})
+            # b_path下已不存在的记录被删除, 其他下载根目录的记录保留
+            self.assertEqual(index.ids(os.path.join(b_path, 'tag_a')), set())
+            self.assertEqual(index.ids(other), {1})
+            index.close()
+
+    def test_link_other_tag(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            index = DownIndex(os.path.join(tmp, 'index.db'))
+            src = os.path.join(tmp, 'yande.re 5 a.png')
+            with open(src, 'wb') as f:
+                f.write(b'123')
+            index.add('tag_a', DownResult(id=5, file_path=src, file_size=3, md5='abc', complete=True))
+            dst_dir = os.path.join(tmp, 'b')
+            os.makedirs(dst_dir)
+            dst = os.path.join(dst_dir, 'b.png')
+            self.assertFalse(index.link(5, 'other', 'tag_b', dst))
+            # 不同版本不链接
+            self.assertFalse(index.link(5, None, 'tag_b', dst, 'sample'))
+            self.assertTrue(index.link(5, 'abc', 'tag_b', dst))
+            self.assertTrue(os.path.samefile(src, dst))
+            self.assertTrue(index.contains(5, dst_dir))
+            self.assertFalse(index.link(6, None, 'tag_b', dst))
+            # 文件被删除后不再算已下载
+            os.remove(dst)
+            self.assertFalse(index.contains(5, dst_dir))
+            self.assertEqual(index.ids(dst_dir), set())
+            index.close()
+
+    def test_spider_fallback(self):
+        with tempfile.TemporaryDirectory() as tmp, mock_yande(files=3, size=1000) as yande:
+            base_url = yande.posts[0]['file_url'].split('/image/')[0]
+            save_dir = os.path.join(tmp, 'pic')
+            get_config = YandeRunningConfig(tags='', save_dir_path=save_dir)
+            with local_config(yande_api=dict(post_api=f'{base_url}/post.json')):
+                from spider.yande_api import YandeSpider
+                spider = YandeSpider()
+                self.assertEqual(spider.get_post_list(get_config).count, 3)
+                spider.scheduler.shutdown()
+            with local_config(yande_api=dict(post_api=f'{base_url}/post.json'),
+                              index=dict(enable=True, path=os.path.join(tmp, 'index.db'))):
+                spider = YandeSpider()
+                # 对已有目录启用索引时, 已存在的文件不重新下载
+                self.assertEqual(spider.get_post_list(get_config).count, 0)
+                self.assertEqual(spider.get_post_list(get_config.model_copy(update=dict(id_check=True))).count, 0)
+                os.remove(os.path.join(save_dir, sorted(os.listdir(save_dir))[0]))
+                self.assertEqual(spider.get_post_list(get_config.model_copy(update=dict(add_flag=True))).count, 1)
+                # 索引中的文件被删除后重新下载
+                os.remove(os.path.join(save_dir, sorted(os.listdir(save_dir))[0]))
+                self.assertEqual(spider.get_post_list(get_config.model_copy(update=dict(add_flag=True))).count, 1)
+                self.assertEqual(len(os.listdir(save_dir)), 3)
+                spider.scheduler.shutdown()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,25 @@
+import json
+import unittest
+import sys
+
+sys.path.insert(0, '..')
+
+from utils.items import YandePostData, YandePostPage, Rating
+from helpers import post_item
+
+
+class MyTestCase(unittest.TestCase):
+    def test_slim_page(self):
+        content = json.dumps([dict(post_item(i), created_at=1600000000, updated_at=1600000000)
+                              for i in (2, 1)]).encode()
+        page = YandePostPage.model_validate_json(content)
+        self.assertEqual([i.id for i in page.root], [2, 1])
+        self.assertIsNone(page.root[0]._item)
+        # 非下载字段访问时才完整校验
+        self.assertEqual(page.root[0].rating, Rating.S)
+        self.assertIsNotNone(page.root[0]._item)
+        self.assertEqual(page.full(), YandePostData.model_validate_json(content))
+
+
+if __name__ == '__main__':
+    unittest.main()
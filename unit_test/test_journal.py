@@ -0,0 +1,134 @@
+import os
+import tempfile
+import unittest
+import sys
+
+sys.path.insert(0, '..')
+
+from utils.downloader import MultiDown, RangeJournal, PART_SUFFIX, JOURNAL_SUFFIX
+from utils.items import FileInfo
+from utils.progress import FileProgress
+from helpers import local_config, mock_yande, write_part
+
+
+def file_info(tmp: str, size: int = 100, md5: str = None) -> FileInfo:
+    return FileInfo(url='http://127.0.0.1/a.png', file_path=os.path.join(tmp, 'a.png'), file_size=size, md5=md5)
+
+
+class Interrupt(BaseException):
+    pass
+
+
+class InterruptProgress(FileProgress):
+    """
+    下载到stop字节后中断, 模拟进程退出
+    """
+    __slots__ = ('stop',)
+
+    def __init__(self, stop: int):
+        super().__init__('', 0)
+        self.stop = stop
+
+    def advance(self, n: int):
+        super().advance(n)
+        if self.done >= self.stop:
+            raise Interrupt()
+
+
+class MyTestCase(unittest.TestCase):
+    def test_missing_and_split(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            journal = RangeJournal(file_info(tmp))
+            # 未下载且不需拆分时整个文件一个分段, 不带Range
+            self.assertEqual(journal.split_ranges(60), [(0, '')])
+            self.assertEqual(journal.split_ranges(30), [(0, 29), (30, 59), (60, 89), (90, 99)])
+            journal.add(10, 19)
+            journal.add(0, 4)
+            journal.add(50, '')
+            self.assertEqual(journal.missing(), [(5, 9), (20, 49)])
+            self.assertEqual(journal.done_size(), 65)
+            self.assertEqual(journal.split_ranges(20), [(5, 9), (20, 39), (40, 49)])
+            journal.add(5, 49)
+            self.assertEqual(journal.missing(), [])
+            self.assertEqual(journal.split_ranges(20), [])
+
+    def test_partial_progress(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            journal = RangeJournal(file_info(tmp, md5='abc'))
+            MultiDown.allocate_file(journal.part_path, 100)
+            journal.progress(0, 30)
+            # 位置不回退
+            journal.progress(0, 20)
+            self.assertEqual(journal.missing(), [(30, 99)])
+            # 有已写入的部分时按Range续传
+            self.assertEqual(journal.split_ranges(60), [(30, 89), (90, 99)])
+            loaded = RangeJournal(file_info(tmp, md5='abc'))
+            self.assertTrue(loaded.load())
+            self.assertEqual((loaded.partial, loaded.done_size()), ({0: 30}, 30))
+            loaded.add(0, 99)
+            self.assertEqual((loaded.partial, loaded.missing()), ({}, []))
+
+    def test_resume_interrupted_range(self):
+        with tempfile.TemporaryDirectory() as tmp, mock_yande() as yande, \
+                local_config(downloader=dict(journal_interval=0)):
+            post = yande.posts[0]
+            file_path = os.path.join(tmp, 'a.png')
+            journal = RangeJournal(FileInfo(url=post['file_url'], file_path=file_path, file_size=post['file_size'],
+                                            md5=post['md5']))
+            MultiDown.allocate_file(journal.part_path, post['file_size'])
+            journal.save()
+            # 小文件整个一个分段, 中断时已写入的部分也会保存
+            self.assertEqual(journal.split_ranges(1024 * 1024), [(0, '')])
+            with self.assertRaises(Interrupt):
+                MultiDown.get_content(post['file_url'], post['id'], journal.part_path, 0, '',
+                                      InterruptProgress(100000), journal)
+            self.assertGreater(journal.partial[0], 50000)
+            yande.stats['bytes'] = 0
+            result = MultiDown(post['file_url'], tmp, 'a.png', post['file_size'], post['md5'], post['id']).result
+            self.assertTrue(result.verified)
+            self.assertEqual(yande.stats['bytes'], post['file_size'] - journal.partial[0])
+            self.assertFalse(os.path.exists(file_path + JOURNAL_SUFFIX))
+
+    def test_load_rejects_mismatch(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            journal = RangeJournal(file_info(tmp, md5='abc'))
+            MultiDown.allocate_file(journal.part_path, 100)
+            journal.add(0, 49)
+            loaded = RangeJournal(file_info(tmp, md5='abc'))
+            self.assertTrue(loaded.load())
+            self.assertEqual(loaded.done, [(0, 49)])
+            self.assertFalse(RangeJournal(file_info(tmp, md5='other')).load())
+            self.assertFalse(RangeJournal(file_info(tmp, size=101, md5='abc')).load())
+            # .part大小与记录不一致
+            with open(journal.part_path, 'rb+') as f:
+                f.truncate(50)
+            self.assertFalse(RangeJournal(file_info(tmp, md5='abc')).load())
+            journal.remove()
+            self.assertFalse(os.path.exists(journal.path))
+
+    def test_resume_missing_ranges(self):
+        with tempfile.TemporaryDirectory() as tmp, mock_yande() as yande, \
+                local_config(downloader=dict(split_size=100000)):
+            post = yande.posts[0]
+            file_path = os.path.join(tmp, 'a.png')
+            write_part(yande, post, file_path, [(0, 99999), (200000, 249999)])
+            result = MultiDown(post['file_url'], tmp, 'a.png', post['file_size'], post['md5'], post['id']).result
+            self.assertTrue(result.ok)
+            self.assertTrue(result.verified)
+            # 只下载缺失的区间
+            self.assertEqual(yande.stats['bytes'], post['file_size'] - 150000)
+            self.assertTrue(os.path.exists(file_path))
+            self.assertFalse(os.path.exists(file_path + PART_SUFFIX))
+            self.assertFalse(os.path.exists(file_path + JOURNAL_SUFFIX))
+
+    def test_md5_mismatch_not_renamed(self):
+        with tempfile.TemporaryDirectory() as tmp, mock_yande() as yande, local_config():
+            post = yande.posts[0]
+            result = MultiDown(post['file_url'], tmp, 'a.png', post['file_size'], '0' * 32, post['id']).result
+            self.assertTrue(result.complete)
+            self.assertFalse(result.ok)
+            self.assertEqual(os.listdir(tmp), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,53 @@
+import tempfile
+import unittest
+import sys
+from time import monotonic
+from unittest import mock
+
+sys.path.insert(0, '..')
+
+from utils.limiter import TokenBucket, HostLimiter, api_limiter, file_limiter
+from helpers import local_config, mock_yande
+
+
+class MyTestCase(unittest.TestCase):
+    def test_token_bucket(self):
+        bucket = TokenBucket(100, capacity=100)
+        self.assertEqual(bucket.reserve(100), 0)
+        # 令牌用完后按速率计算等待时间
+        self.assertAlmostEqual(bucket.reserve(50), 0.5, delta=0.05)
+        self.assertEqual(TokenBucket(0).reserve(10 ** 9), 0)
+
+    def test_throttle_backoff(self):
+        limiter = HostLimiter('files.yande.re', 0, 0)
+        self.assertEqual(limiter.request_delay(), 0)
+        limiter.on_throttle('20')
+        self.assertGreater(limiter.request_delay(), 19)
+        first = limiter.backoff
+        limiter.on_throttle()
+        self.assertEqual(limiter.backoff, first * 2)
+
+    def test_role_key(self):
+        with local_config(yande_api=dict(rate_requests=1), downloader=dict(rate_requests=5)):
+            url = 'http://127.0.0.1:1/limiter_role'
+            # api与文件下载在同一host时分别限速
+            self.assertIsNot(api_limiter(url), file_limiter(url))
+            self.assertEqual((api_limiter(url).requests.rate, file_limiter(url).requests.rate), (1, 5))
+
+    def test_throttle_no_double_backoff(self):
+        with tempfile.TemporaryDirectory() as tmp, mock_yande(throttle=1) as yande, \
+                local_config(yande_api=dict(backoff=0.123)):
+            from utils.downloader import MultiDown
+            post = yande.posts[0]
+            # 本秒内已有一次请求, 下一次请求返回429
+            yande.window = (monotonic(), 1)
+            with mock.patch('utils.downloader.sleep') as sleep:
+                result = MultiDown(post['file_url'], tmp, 'a.png', post['file_size'], post['md5'], post['id']).result
+            self.assertTrue(result.ok)
+            self.assertEqual(yande.stats['throttled'], 1)
+            # 限流的等待只由limiter处理, 不再固定等待backoff
+            self.assertNotIn(mock.call(0.123), sleep.call_args_list)
+
+
+if __name__ == '__main__':
+    unittest.main()
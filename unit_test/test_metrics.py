@@ -0,0 +1,37 @@
+import json
+import unittest
+import sys
+
+sys.path.insert(0, '..')
+
+from utils.metrics import Registry
+
+
+class MyTestCase(unittest.TestCase):
+    def test_label_escape(self):
+        registry = Registry()
+        registry.gauge('page_queue_depth', tag='a\\b "c"\nd').set(1)
+        self.assertIn('page_queue_depth{tag="a\\\\b \\"c\\"\\nd"} 1', registry.prometheus_text())
+
+    def test_prometheus_text(self):
+        registry = Registry()
+        registry.counter('files_total', result='ok').inc(3)
+        self.assertIs(registry.counter('files_total', result='ok'), registry.counter('files_total', result='ok'))
+        h = registry.histogram('range_ttfb_seconds', buckets=(0.1, 1))
+        for v in (0.05, 0.5, 5):
+            h.observe(v)
+        text = registry.prometheus_text()
+        self.assertIn('files_total{result="ok"} 3', text)
+        # 分桶为累计值
+        self.assertIn('range_ttfb_seconds_bucket{le="0.1"} 1', text)
+        self.assertIn('range_ttfb_seconds_bucket{le="1"} 2', text)
+        self.assertIn('range_ttfb_seconds_bucket{le="+Inf"} 3', text)
+        self.assertIn('range_ttfb_seconds_count 3', text)
+
+        snapshot = json.loads(registry.json_line())['metrics']
+        self.assertEqual(snapshot['files_total'][0], dict(labels=dict(result='ok'), value=3))
+        self.assertEqual(snapshot['range_ttfb_seconds'][0]['count'], 3)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,52 @@
+import json
+import os
+import tempfile
+import unittest
+import sys
+from unittest import mock
+
+sys.path.insert(0, '..')
+
+from utils.items import YandePostPage
+from utils.mirror import MetaMirror
+from helpers import local_config, mock_yande
+
+
+class MyTestCase(unittest.TestCase):
+    def test_mirror_resume(self):
+        with tempfile.TemporaryDirectory() as tmp, mock_yande(files=12, size=1000) as yande:
+            base_url = yande.posts[0]['file_url'].split('/image/')[0]
+            with local_config(yande_api=dict(post_api=f'{base_url}/post.json'), mirror=dict(limit=5),
+                              index=dict(path=os.path.join(tmp, 'index.db'))):
+                from spider.yande_api import YandeSpider
+                spider = YandeSpider()
+                mirror = MetaMirror(os.path.join(tmp, 'mirror.db'))
+                # 每次只获取一页, 按id升序从上次的位置继续
+                self.assertEqual(spider.mirror_meta('', mirror, 1), 5)
+                self.assertEqual(mirror.max_id(''), 5)
+                self.assertEqual(spider.mirror_meta('', mirror, 1), 5)
+                self.assertEqual(mirror.max_id(''), 10)
+                with mock.patch.object(spider.y_api, 'get_ranking', wraps=spider.y_api.get_ranking) as get_ranking:
+                    self.assertEqual(spider.mirror_meta('', mirror), 2)
+                # keyset分页, 总是请求第1页
+                self.assertEqual([(c.args[0], c.kwargs['tags']) for c in get_ranking.call_args_list],
+                                 [(1, 'order:id id:>10'), (1, 'order:id id:>12')])
+                self.assertEqual((mirror.count(), mirror.max_id('')), (12, 12))
+                self.assertEqual(spider.mirror_meta('', mirror), 0)
+                spider.scheduler.shutdown()
+                mirror.close()
+
+    def test_add_page_raw(self):
+        with tempfile.TemporaryDirectory() as tmp, mock_yande(files=3, size=1000) as yande:
+            page = YandePostPage.model_validate_json(json.dumps(yande.posts))
+            mirror = MetaMirror(os.path.join(tmp, 'mirror.db'))
+            self.assertEqual(mirror.add_page(page.root), 3)
+            # 直接读取原始dict写入, 不触发完整校验
+            self.assertTrue(all(i._item is None for i in page.root))
+            post = yande.posts[0]
+            self.assertEqual(mirror.files([post['id']]), [(post['id'], post['file_size'], post['md5'], post['file_url'])])
+            mirror.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
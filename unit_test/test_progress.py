@@ -0,0 +1,31 @@
+import unittest
+import sys
+
+sys.path.insert(0, '..')
+
+from pydantic import ValidationError
+
+from utils.constant import Config
+from utils.progress import ProgressManager, new_progress
+
+
+class MyTestCase(unittest.TestCase):
+    def test_headless(self):
+        manager = ProgressManager(mode='none')
+        item = manager.add_file('[1] a.png', 100, 10)
+        item.advance(60)
+        item.advance(-20)
+        self.assertEqual(item.done, 50)
+        manager.remove_file(item)
+        self.assertEqual((manager.finished_count, manager.finished_done, manager.finished_total), (1, 50, 100))
+        # headless模式不启动刷新线程
+        self.assertIsNone(manager.thread)
+
+    def test_mode(self):
+        with self.assertRaises(ValidationError):
+            Config(downloader=dict(progress='off'))
+        self.assertIsNotNone(new_progress(auto_refresh=False))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,67 @@
+import os
+import random
+import tempfile
+import unittest
+import sys
+
+sys.path.insert(0, '..')
+
+from utils.items import YandePostData
+from utils.mirror import MetaMirror
+from utils.query import LocalQuery, parse_query, bitmap_from_ids, ids_from_bitmap
+from helpers import post_item
+
+
+def mirror_post(_id: int, tags: str, rating: str = 's', width: int = 1000, ext: str = 'png') -> dict:
+    return dict(post_item(_id), tags=tags, rating=rating, width=width, file_ext=ext)
+
+
+class MyTestCase(unittest.TestCase):
+    def test_parse(self):
+        q = parse_query('tag_a -tag_b rating:e -rating:s ext:png width:>=1000 score:10..20')
+        self.assertEqual(q.include, ['tag_a'])
+        self.assertEqual(q.exclude, ['tag_b'])
+        self.assertEqual([r.value for r in q.ratings], ['e'])
+        self.assertEqual(q.conditions, [('width', '>=', 1000), ('score', '>=', 10), ('score', '<=', 20)])
+        # 本地无法查询的条件不作为tag
+        for expr in ('tag_a order:score', 'user:abc', '-pool:1'):
+            with self.assertRaises(ValueError):
+                parse_query(expr)
+        self.assertEqual(parse_query('re:zero').include, ['re:zero'])
+
+    def test_bitmap(self):
+        rng = random.Random(0)
+        ids = sorted(rng.sample(range(200000), 3000), reverse=True)
+        self.assertEqual(list(ids_from_bitmap(bitmap_from_ids(ids))), ids)
+        self.assertEqual(list(ids_from_bitmap(bitmap_from_ids([0, 63, 64, 127]))), [127, 64, 63, 0])
+        self.assertEqual(list(ids_from_bitmap(0)), [])
+
+    def test_search(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            mirror = MetaMirror(os.path.join(tmp, 'mirror.db'))
+            mirror.add_page(YandePostData.model_validate([
+                mirror_post(1, 'tag_a', width=500),
+                mirror_post(2, 'tag_a tag_b'),
+                mirror_post(3, 'tag_a', rating='e', ext='jpg'),
+                mirror_post(4, 'tag_c'),
+            ]).root)
+            query = LocalQuery(mirror)
+            self.assertEqual(query.search('tag_a'), [3, 2, 1])
+            self.assertEqual(query.search('tag_a -tag_b'), [3, 1])
+            self.assertEqual(query.search('tag_a width:>=1000 ext:png'), [2])
+            self.assertEqual(query.search('-rating:e'), [4, 2, 1])
+            self.assertEqual(query.search('tag_missing'), [])
+            self.assertEqual(query.search('id:2..3'), [3, 2])
+            self.assertEqual(query.search('id:>1 id:<4 rating:s'), [2])
+            self.assertEqual(query.search('id:9'), [])
+            self.assertEqual(query.search('width:>=1000', limit=2), [4, 3])
+            # 候选较多时扫描整个posts表
+            query.in_limit = 0
+            self.assertEqual(query.search('tag_a width:>=1000 ext:png'), [2])
+            self.assertEqual(query.search('width:<1000'), [1])
+            self.assertEqual([i.id for i in query.posts([3, 1]).root], [3, 1])
+            mirror.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
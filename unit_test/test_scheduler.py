@@ -0,0 +1,64 @@
+import os
+import tempfile
+import unittest
+import sys
+from concurrent.futures import Future
+from threading import Thread
+
+sys.path.insert(0, '..')
+
+from utils.scheduler import DownScheduler, DownGroup
+from helpers import local_config, mock_yande
+
+
+class PendingScheduler:
+    """
+    只返回未完成的Future, 由测试控制任务结束
+    """
+
+    def __init__(self):
+        self.futures = []
+
+    def submit(self, *args, **kwargs) -> Future:
+        future = Future()
+        self.futures.append(future)
+        return future
+
+
+class MyTestCase(unittest.TestCase):
+    def test_scheduler_group(self):
+        with tempfile.TemporaryDirectory() as tmp, mock_yande(files=6, size=150000) as yande, \
+                local_config(downloader=dict(split_size=50000, transfer_num=3)):
+            scheduler = DownScheduler(engine='thread')
+            group = scheduler.group()
+            done = []
+            for post in yande.posts:
+                group.submit(post['file_url'], tmp, f'{post["id"]}.png', post['file_size'], post['md5'], post['id'],
+                             callback=done.append)
+            results = group.wait()
+            scheduler.shutdown()
+            # 回调在任务结束前执行
+            self.assertEqual(len(done), 6)
+            self.assertEqual(sorted(r.id for r in results), [p['id'] for p in reversed(yande.posts)])
+            self.assertTrue(all(r.ok for r in results))
+            self.assertEqual(sorted(os.listdir(tmp)), sorted(f'{p["id"]}.png' for p in yande.posts))
+
+    def test_group_limit(self):
+        scheduler = PendingScheduler()
+        group = DownGroup(scheduler, limit=2)
+        group.submit('a')
+        group.submit('b')
+        t = Thread(target=group.submit, args=('c',), daemon=True)
+        t.start()
+        t.join(0.2)
+        # 达到上限时阻塞, 直到有任务结束
+        self.assertTrue(t.is_alive())
+        self.assertEqual(len(scheduler.futures), 2)
+        scheduler.futures[0].set_result(None)
+        t.join(1)
+        self.assertFalse(t.is_alive())
+        self.assertEqual(len(group.futures), 3)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,40 @@
+import unittest
+import sys
+
+sys.path.insert(0, '..')
+
+from utils.items import YandePostPage, YandePostData
+from utils.variant import select_variant
+from helpers import post_item
+
+
+class MyTestCase(unittest.TestCase):
+    def test_select_variant(self):
+        raw = post_item(7)
+        raw.update(file_size=8000000, width=4000, height=3000,
+                   jpeg_url='https://files.yande.re/jpeg/7.jpg', jpeg_file_size=2000000, jpeg_width=4000,
+                   jpeg_height=3000, sample_url='https://files.yande.re/sample/7.jpg', sample_file_size=300000,
+                   sample_width=1500, sample_height=1125)
+        item = YandePostData.model_validate([raw]).root[0]
+        view = YandePostPage.model_validate_json(YandePostData([item]).model_dump_json()).root[0]
+        for i in (item, view):
+            self.assertEqual(select_variant(i, 'original').url, raw['file_url'])
+            self.assertEqual(select_variant(i, 'jpeg').name, 'jpeg')
+            sample = select_variant(i, 'sample')
+            self.assertEqual((sample.name, sample.file_size, sample.md5), ('sample', 300000, None))
+            self.assertEqual(select_variant(i, 'smallest', 1000, 1000).name, 'sample')
+            self.assertEqual(select_variant(i, 'smallest', 2000, 0).name, 'jpeg')
+            self.assertEqual(select_variant(i, 'smallest', 5000, 0).name, 'original')
+            self.assertEqual(select_variant(i, 'original_under', max_size=10000000).name, 'original')
+            self.assertEqual(select_variant(i, 'original_under', max_size=5000000).name, 'jpeg')
+            self.assertEqual(select_variant(i, 'original_under', max_size=100).name, 'sample')
+        # 原图为jpg时jpeg地址与原图相同
+        raw.update(jpeg_url=raw['file_url'])
+        item = YandePostData.model_validate([raw]).root[0]
+        self.assertEqual(select_variant(item, 'jpeg').md5, raw['md5'])
+        # 未经完整校验的视图不会因选择版本而解析全部字段
+        self.assertIsNone(view._item)
+
+
+if __name__ == '__main__':
+    unittest.main()
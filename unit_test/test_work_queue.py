@@ -0,0 +1,98 @@
+import os
+import tempfile
+import unittest
+import sys
+
+sys.path.insert(0, '..')
+
+from utils.work_queue import WorkQueue, DONE, FAILED, PENDING
+from helpers import local_config
+
+
+class MyTestCase(unittest.TestCase):
+    def test_lease_and_retry(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            queue = WorkQueue(os.path.join(tmp, 'queue.db'))
+            tag_id = queue.put('tag', 'tag:a', dict(tag='a'))
+            file_id = queue.put('file', 'file:a:1', dict(id=1), parent=tag_id)
+            # 同一key只保留一个任务
+            self.assertEqual(queue.put('file', 'file:a:1', dict(id=1), parent=tag_id), file_id)
+
+            job = queue.lease('w1', ('file',))
+            self.assertEqual((job.id, job.payload, job.attempts), (file_id, dict(id=1), 1))
+            self.assertIsNone(queue.lease('w2', ('file',)))
+            self.assertEqual(queue.heartbeat([file_id], 'w2'), [file_id])
+            self.assertEqual(queue.heartbeat([file_id], 'w1'), [])
+
+            # 失败后延迟重试, 其他worker不能提交
+            queue.conn.execute('UPDATE jobs SET not_before = 0')
+            self.assertTrue(queue.fail(file_id, 'w1', 'error'))
+            queue.conn.execute('UPDATE jobs SET not_before = 0')
+            job = queue.lease('w2', ('file',))
+            self.assertEqual(job.attempts, 2)
+            self.assertFalse(queue.complete(file_id, 'w1', dict(ok=True)))
+            self.assertTrue(queue.complete(file_id, 'w2', dict(ok=True)))
+            self.assertEqual(queue.children(tag_id), {DONE: 1})
+
+            # 租约过期后由其他worker继续
+            job = queue.lease('w1', ('tag',))
+            queue.save_state(job.id, 'w1', dict(low_id=5))
+            queue.conn.execute('UPDATE jobs SET lease_until = 0')
+            job = queue.lease('w2')
+            self.assertEqual((job.id, job.state), (tag_id, dict(low_id=5)))
+            self.assertFalse(queue.complete(tag_id, 'w1'))
+            self.assertTrue(queue.complete(tag_id, 'w2', dict(max_id=9)))
+            self.assertEqual(queue.open_count(), 0)
+            self.assertEqual([(j.id, s, r) for j, s, r in queue.uncommitted('tag')], [(tag_id, DONE, dict(max_id=9))])
+            queue.mark_committed([tag_id])
+            self.assertEqual(queue.uncommitted('tag'), [])
+            queue.close()
+
+    def test_max_attempts(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            queue = WorkQueue(os.path.join(tmp, 'queue.db'))
+            job_id = queue.put('file', 'file:a:1', dict(id=1))
+            for _ in range(5):
+                queue.conn.execute('UPDATE jobs SET not_before = 0')
+                self.assertIsNotNone(queue.lease('w1'))
+                queue.fail(job_id, 'w1', 'error')
+            self.assertEqual(queue.stats(), dict(file={FAILED: 1}))
+            # 重新加入后从头开始
+            queue.put('file', 'file:a:1', dict(id=1))
+            self.assertEqual(queue.lease('w1').attempts, 1)
+            queue.close()
+
+    def test_reset_unsettled(self):
+        with tempfile.TemporaryDirectory() as tmp, \
+                local_config(index=dict(enable=True, checkpoint=True, path=os.path.join(tmp, 'index.db'))):
+            from spider.cluster import Coordinator
+            queue = WorkQueue(os.path.join(tmp, 'queue.db'))
+            coordinator = Coordinator(queue)
+            b_path = os.path.join(tmp, 'down')
+            tag_id, = coordinator.add_tags(['a'], b_path)
+            queue.lease('w1', ('tag',))
+            file_id = queue.put('file', 'file:a:1', dict(id=1), parent=tag_id)
+            queue.complete(tag_id, 'w1', dict(max_id=9, low_id=1, pages=1, complete=True))
+
+            # 文件任务未结束时重新加入tag不会重置, 文件任务仍计入该tag
+            self.assertEqual(coordinator.add_tags(['a'], b_path), [tag_id])
+            self.assertEqual(queue.stats()['tag'], {DONE: 1})
+            self.assertEqual(queue.children(tag_id), {PENDING: 1})
+            self.assertEqual(coordinator.commit(), [])
+
+            # 文件失败时不更新进度
+            queue.conn.execute('UPDATE jobs SET attempts = 5')
+            queue.lease('w1', ('file',))
+            queue.fail(file_id, 'w1', 'error')
+            self.assertEqual([(r.tag, r.failed) for r in coordinator.commit()], [('a', 1)])
+            self.assertEqual(coordinator.checkpoints.get('a', os.path.join(b_path, 'a')).high_water, 0)
+
+            # 结果汇总后重新加入, 上一次的文件任务不再计入
+            coordinator.add_tags(['a'], b_path)
+            self.assertEqual(queue.stats()['tag'], {PENDING: 1})
+            self.assertEqual(queue.children(tag_id), {})
+            queue.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
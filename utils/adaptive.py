@@ -0,0 +1,84 @@
+from threading import Lock
+from time import monotonic
+from urllib.parse import urlsplit
+
+from loguru import logger
+
+from utils.constant import config
+
+
+class AdaptiveTuner:
+    """
+    按host统计分段吞吐与限流情况, 动态调整同时进行的分段数与分段大小
+    吞吐未下降时逐步增加并发, 吞吐下降时回退, 遇到限流时并发减半并加大分段
+    """
+
+    def __init__(self, host: str):
+        self.host = host
+        self.min_concurrency = 1
+        self.max_concurrency = max(config.downloader.max_thread_num, 1)
+        self.concurrency = min(max(config.downloader.thread_num, 1), self.max_concurrency)
+        self.split_size = config.downloader.split_size
+        self.lock = Lock()
+        self.window_start = monotonic()
+        self.window_bytes = 0
+        self.last_rate = 0.0
+        # 单连接吞吐 bytes/s 的滑动平均
+        self.conn_rate = 0.0
+        # 限流后的冷却时间内不再增加并发
+        self.cooldown_until = 0.0
+
+    def clamp_split(self, size: float) -> int:
+        return int(min(max(size, config.downloader.min_split_size), config.downloader.max_split_size))
+
+    def on_range_done(self, nbytes: int, seconds: float):
+        """
+        记录一个分段(或分段的一部分)的传输量与耗时
+        """
+        if nbytes <= 0:
+            return
+        with self.lock:
+            rate = nbytes / max(seconds, 1e-3)
+            self.conn_rate = rate if self.conn_rate == 0 else self.conn_rate * 0.7 + rate * 0.3
+            self.window_bytes += nbytes
+            now = monotonic()
+            elapsed = now - self.window_start
+            if elapsed < config.downloader.adaptive_window:
+                return
+            total_rate = self.window_bytes / elapsed
+            if total_rate < self.last_rate * 0.95:
+                # 并发过高导致总吞吐下降, 回退
+                self.concurrency = max(self.concurrency - 1, self.min_concurrency)
+            elif now >= self.cooldown_until:
+                # 吞吐未下降时继续尝试增加并发
+                self.concurrency = min(self.concurrency + 1, self.max_concurrency)
+            # 分段大小按单连接速度取固定的传输时长
+            self.split_size = self.clamp_split(self.conn_rate * config.downloader.adaptive_range_seconds)
+            self.last_rate = total_rate
+            self.window_start = now
+            self.window_bytes = 0
+            logger.debug(f'adaptive {self.host}: {total_rate / 1024 / 1024:.03f} MB/s '
+                         f'concurrency {self.concurrency} split {self.split_size}')
+
+    def on_throttle(self):
+        """
+        服务端限流(429/503)或连接被重置
+        """
+        with self.lock:
+            self.concurrency = max(self.concurrency // 2, self.min_concurrency)
+            self.split_size = self.clamp_split(self.split_size * 2)
+            self.cooldown_until = monotonic() + config.downloader.adaptive_cooldown
+            logger.info(f'adaptive {self.host} throttled: concurrency {self.concurrency} split {self.split_size}')
+
+
+_tuners: dict = {}
+_tuner_lock = Lock()
+
+
+def get_tuner(url: str) -> AdaptiveTuner:
+    host = urlsplit(url).netloc
+    with _tuner_lock:
+        tuner = _tuners.get(host)
+        if tuner is None:
+            tuner = _tuners[host] = AdaptiveTuner(host)
+    return tuner
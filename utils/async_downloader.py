@@ -0,0 +1,240 @@
+import asyncio
+import os.path
+from concurrent.futures import Future, ThreadPoolExecutor
+from hashlib import md5
+from threading import Thread
+from time import perf_counter
+from typing import Tuple, Optional
+
+import aiohttp
+from loguru import logger
+
+from utils.constant import config
+from utils.downloader import (MultiDown, RangeJournal, file_md5_hex, file_done, RANGE_TTFB, RANGE_RATE, RANGE_WRITE,
+                              RANGE_RETRIES, RANGES_QUEUED, RANGES_ACTIVE, BYTES_WRITTEN, FILE_THROTTLED,
+                              MD5_FAILURES)
+from utils.items import FileInfo, DownResult
+from utils.limiter import file_limiter, THROTTLE_STATUS
+from utils.metrics import span
+from utils.progress import FileProgress, get_progress
+
+# 与thread引擎的timeout=5一致, 连接与读取都有超时, 避免卡住的socks连接一直占用transfer_sem
+# connect包含等待连接池空位与代理握手, 分段整体传输时间不限制
+RANGE_TIMEOUT = aiohttp.ClientTimeout(total=None, connect=30, sock_connect=5, sock_read=5)
+
+
+class AsyncMultiDown:
+    """
+    asyncio实现的分段下载, 输入与MultiDown一致, 由AsyncDownEngine调度
+    """
+
+    def __init__(self, url: str, file_path: str, file_name: str,
+                 file_size: int = 0, _md5: str = None, _id: int = None) -> None:
+        # 排除文件名特殊字符
+        from pathvalidate import sanitize_filename
+        file_name = sanitize_filename(file_name)
+        self.file_info = FileInfo(url=url, id=_id,
+                                  file_path=os.path.join(file_path, file_name), file_size=file_size, md5=_md5)
+
+    async def get_content(self, engine: 'AsyncDownEngine', journal: RangeJournal,
+                          s: int, e, file_progress: FileProgress) -> Tuple[bool, Optional[str]]:
+        """
+        下载一个分段, 数据攒够write_size后交给线程池写入文件对应位置
+        :return: 分段是否下载完成, 整文件单段下载时附带边下边算的md5
+        """
+        url, _id = self.file_info.url, self.file_info.id
+        headers = {
+            "authority": "files.yande.re",
+            'Referer': 'https://yande.re/'
+        }
+        whole_file = s == 0 and e == ''
+        if not whole_file:
+            headers.update({"Range": f"bytes={s}-{e}"})
+        headers.update(config.yande_api.headers)
+        limiter = file_limiter(url)
+        RANGES_QUEUED.inc(-1)
+        for retry in range(config.yande_api.retry):
+            chunk_sum = 0
+            hasher = md5() if whole_file else None
+            throttled = False
+            try:
+                # 限流等待不占用传输并发, 其他host的分段可以继续
+                await asyncio.sleep(limiter.request_delay())
+                async with engine.transfer_sem:
+                    RANGES_ACTIVE.inc()
+                    try:
+                        begin = perf_counter()
+                        async with engine.session.get(url, headers=headers, proxy=engine.proxy,
+                                                      timeout=RANGE_TIMEOUT) as res:
+                            RANGE_TTFB.observe(perf_counter() - begin)
+                            if res.status in THROTTLE_STATUS:
+                                FILE_THROTTLED.inc()
+                                throttled = True
+                                limiter.on_throttle(res.headers.get('Retry-After'))
+                            res.raise_for_status()
+                            f = await engine.run_io(open, journal.part_path, 'rb+')
+                            try:
+                                offset = s
+                                buffer = []
+                                buffer_size = 0
+                                write_time = 0
+                                async for chunk in res.content.iter_chunked(config.downloader.chunk_size):
+                                    if hasher is not None:
+                                        hasher.update(chunk)
+                                    wait = limiter.bytes_delay(len(chunk))
+                                    if wait > 0:
+                                        await asyncio.sleep(wait)
+                                    buffer.append(chunk)
+                                    buffer_size += len(chunk)
+                                    if buffer_size >= config.downloader.write_size:
+                                        write_time += await engine.run_io(write_at, f, offset, b''.join(buffer))
+                                        file_progress.advance(buffer_size)
+                                        offset += buffer_size
+                                        chunk_sum += buffer_size
+                                        buffer, buffer_size = [], 0
+                                        if journal.due():
+                                            # 先写入文件再记录位置, 中断后从该位置续传
+                                            await engine.run_io(f.flush)
+                                            await engine.run_io(journal.progress, s, offset)
+                                if buffer:
+                                    write_time += await engine.run_io(write_at, f, offset, b''.join(buffer))
+                                    file_progress.advance(buffer_size)
+                                    chunk_sum += buffer_size
+                            finally:
+                                await engine.run_io(f.close)
+                    finally:
+                        RANGES_ACTIVE.inc(-1)
+                        BYTES_WRITTEN.inc(chunk_sum)
+                RANGE_RATE.observe(chunk_sum / max(perf_counter() - begin, 1e-6))
+                RANGE_WRITE.observe(write_time)
+                limiter.on_success()
+                await engine.run_io(journal.add, s, e)
+                return True, hasher.hexdigest() if hasher is not None else None
+            except Exception as err:
+                RANGE_RETRIES.inc()
+                logger.warning(f'[{_id}] down error {retry} {url} {s}-{e}: {err!r}')
+                file_progress.advance(-chunk_sum)
+                if chunk_sum:
+                    await engine.run_io(journal.progress, s, s + chunk_sum)
+                # 限流时的等待由limiter在下次请求前统一处理
+                if not throttled:
+                    await asyncio.sleep(config.yande_api.backoff)
+        return False, None
+
+    async def start(self, engine: 'AsyncDownEngine') -> DownResult:
+        if self.file_info.file_size == 0:
+            with span('size_probe', trace=self.file_info.id):
+                file_size = await engine.run_io(MultiDown.get_file_size, self.file_info.url)
+            self.file_info = self.file_info.model_copy(update=dict(file_size=file_size))
+        file_size = self.file_info.file_size
+        file_path = self.file_info.file_path
+        description = file_path if len(file_path) < 21 else f'{file_path[:10]}...{file_path[-10:]}'
+        # 已有匹配的下载记录时只续传缺失的分段
+        journal = RangeJournal(self.file_info)
+        if not await engine.run_io(journal.load):
+            await engine.run_io(MultiDown.allocate_file, journal.part_path, file_size)
+            await engine.run_io(journal.save)
+        progress = get_progress()
+        file_progress = progress.add_file(f'[{self.file_info.id}] {description}', file_size, journal.done_size())
+        ranges = journal.split_ranges(config.downloader.split_size)
+        RANGES_QUEUED.inc(len(ranges))
+        with span('ranges', trace=self.file_info.id, size=file_size, resumed=journal.done_size(),
+                  adaptive=False) as attrs:
+            rets = await asyncio.gather(*[self.get_content(engine, journal, s, e, file_progress) for s, e in ranges],
+                                        return_exceptions=True)
+            complete = attrs['complete'] = all(not isinstance(ret, BaseException) and ret[0] for ret in rets)
+        # 多分段或续传时md5无法边下边算, 由校验时分块读取计算
+        file_md5 = rets[0][1] if complete and len(rets) == 1 else None
+
+        result = DownResult(id=self.file_info.id, file_path=file_path, file_size=file_size, complete=complete)
+        if not complete:
+            # 保留.part文件与下载记录, 下次运行时续传
+            logger.warning(f'[{self.file_info.id}] down incomplete, keep for resume: {journal.part_path}')
+        else:
+            with span('verify', trace=self.file_info.id, inline=file_md5 is not None) as attrs:
+                if file_md5 is None and self.file_info.md5:
+                    file_md5 = await engine.run_io(file_md5_hex, journal.part_path)
+                result.md5 = file_md5
+                if self.file_info.md5:
+                    result.verified = self.file_info.md5 == file_md5
+                attrs['ok'] = result.verified is not False
+            with span('write', trace=self.file_info.id):
+                if result.verified is False:
+                    MD5_FAILURES.inc()
+                    logger.warning(f'md5 check err: {file_path}')
+                    await engine.run_io(os.remove, journal.part_path)
+                else:
+                    # 校验通过后才原子重命名为目标文件
+                    await engine.run_io(os.replace, journal.part_path, file_path)
+                await engine.run_io(journal.remove)
+        progress.remove_file(file_progress)
+        file_done(result)
+        return result
+
+
+class AsyncDownEngine:
+    """
+    在后台线程运行事件循环, 所有文件的分段共用一个aiohttp会话与并发上限
+    """
+
+    def __init__(self, transfer_num: int = None):
+        self.transfer_num = transfer_num or config.downloader.transfer_num
+        # 文件读写放在少量线程中执行, 避免阻塞事件循环
+        self.io_executor = ThreadPoolExecutor(max_workers=config.downloader.thread_num,
+                                              thread_name_prefix='async-io')
+        self.loop = asyncio.new_event_loop()
+        self.thread = Thread(target=self.loop.run_forever, daemon=True, name='async-engine')
+        self.thread.start()
+        self.session: aiohttp.ClientSession = None
+        self.proxy: Optional[str] = None
+        self.transfer_sem: asyncio.Semaphore = None
+        asyncio.run_coroutine_threadsafe(self._init(), self.loop).result()
+
+    async def _init(self):
+        proxy = (config.yande_api.proxies or {}).get('https') or None
+        limit_per_host = config.downloader.host_transfer_num
+        if proxy and proxy.startswith('socks'):
+            # aiohttp本身不支持socks代理
+            from aiohttp_socks import ProxyConnector
+            connector = ProxyConnector.from_url(proxy.replace('socks5h://', 'socks5://'), rdns=True,
+                                                limit=self.transfer_num, limit_per_host=limit_per_host)
+            proxy = None
+        else:
+            connector = aiohttp.TCPConnector(limit=self.transfer_num, limit_per_host=limit_per_host)
+        self.proxy = proxy
+        self.session = aiohttp.ClientSession(connector=connector)
+        self.transfer_sem = asyncio.Semaphore(self.transfer_num)
+
+    async def run_io(self, func, *args):
+        return await self.loop.run_in_executor(self.io_executor, func, *args)
+
+    def submit(self, url: str, file_path: str, file_name: str,
+               file_size: int = 0, _md5: str = None, _id: int = None, callback=None) -> Future:
+        """
+        提交一个文件下载任务, 返回结果为DownResult
+        :param callback: 下载结束后在io线程中以DownResult调用
+        """
+        down = AsyncMultiDown(url, file_path, file_name, file_size, _md5, _id)
+        return asyncio.run_coroutine_threadsafe(self._run(down, callback), self.loop)
+
+    async def _run(self, down: AsyncMultiDown, callback) -> DownResult:
+        result = await down.start(self)
+        if callback is not None:
+            await self.run_io(callback, result)
+        return result
+
+    def shutdown(self):
+        asyncio.run_coroutine_threadsafe(self.session.close(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.io_executor.shutdown()
+
+
+def write_at(f, offset: int, data: bytes) -> float:
+    """
+    :return: 写入耗时(秒)
+    """
+    begin = perf_counter()
+    f.seek(offset)
+    f.write(data)
+    return perf_counter() - begin
@@ -0,0 +1,170 @@
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from hashlib import md5
+from typing import Optional
+
+from loguru import logger
+
+from utils.constant import config
+from utils.downloader import INCOMPLETE_SUFFIXES
+from utils.index import DownIndex, parse_file_id
+from utils.mirror import MetaMirror
+
+# 文件末尾用于判断是否为预分配后未写入的零字节的长度
+TAIL_SIZE = 4096
+
+
+def iter_archive(b_path: str, tags: list = None):
+    """
+    遍历下载目录(每个tag一个子目录), 文件名规则与YandeSpider.scan_id_in_dir一致
+    :return: (tag, id, path)
+    """
+    for tag_dir in sorted(os.scandir(b_path), key=lambda x: x.name):
+        if not tag_dir.is_dir() or (tags and tag_dir.name not in tags):
+            continue
+        for entry in os.scandir(tag_dir.path):
+            if not entry.is_file() or entry.name.endswith(INCOMPLETE_SUFFIXES):
+                continue
+            try:
+                _id = parse_file_id(entry.name)
+            except Exception as e:
+                logger.warning(f'{entry.name}:{e}')
+                continue
+            yield tag_dir.name, _id, entry.path
+
+
+def audit_file(path: str, file_size: int = None, file_md5: str = None, block_size: int = 1024 * 1024) -> dict:
+    """
+    在子进程中检查单个文件, 有期望md5时分块流式计算md5, 否则只检查大小与末尾
+    图片文件不会以零字节结尾, 末尾全为零说明是稀疏预分配后未写完的文件
+    :return: 包含status的检查结果, status为 ok/size_mismatch/zero_tail/md5_mismatch/unreadable
+    """
+    ret = dict(path=path, size=None, md5=None, status='ok')
+    try:
+        size = os.path.getsize(path)
+        ret['size'] = size
+        if file_size and size != file_size:
+            ret['status'] = 'size_mismatch'
+            return ret
+        with open(path, 'rb') as f:
+            if file_md5:
+                hasher = md5()
+                tail = b''
+                while block := f.read(block_size):
+                    hasher.update(block)
+                    tail = block
+                ret['md5'] = hasher.hexdigest()
+            else:
+                f.seek(max(size - TAIL_SIZE, 0))
+                tail = f.read()
+        tail = tail[-TAIL_SIZE:]
+        if size == 0 or not tail.strip(b'\x00'):
+            ret['status'] = 'zero_tail'
+        elif file_md5 and ret['md5'] != file_md5:
+            ret['status'] = 'md5_mismatch'
+    except OSError as e:
+        ret['status'] = 'unreadable'
+        ret['error'] = str(e)
+    return ret
+
+
+class ArchiveAuditor:
+    """
+    按索引与镜像中的md5/file_size并行校验已下载的文件, 异常文件写入JSON lines格式的重新下载队列
+    """
+
+    def __init__(self, index: DownIndex = None, mirror: MetaMirror = None, workers: int = None):
+        """
+        :param index: 提供下载时记录的md5与大小
+        :param mirror: 提供服务端的md5/file_size/file_url, 优先于索引
+        :param workers: 计算md5的进程数, 默认为audit.workers或CPU数
+        """
+        self.index = index
+        self.mirror = mirror
+        self.workers = workers or config.audit.workers or os.cpu_count() or 1
+
+    def expected(self, save_dir: str, ids: list) -> dict:
+        """
+        查询一个tag目录下文件的期望信息
+        :return: {id: (file_size, md5, file_url, variant)}
+        """
+        ret = {}
+        if self.index is not None:
+            for _id, size, _md5, variant in self.index.files(save_dir):
+                ret[_id] = (size, _md5, None, variant)
+        if self.mirror is not None:
+            for _id, size, _md5, url in self.mirror.files(ids):
+                # 镜像中只有原图的大小与md5, 其他版本只按索引检查
+                if ret.get(_id, (None, None, None, 'original'))[3] == 'original':
+                    ret[_id] = (size, _md5, url, 'original')
+        return ret
+
+    def run(self, b_path: str, out, tags: list = None) -> dict:
+        """
+        :param b_path: 下载根目录
+        :param out: 重新下载队列的输出(文本文件对象)
+        :param tags: 只检查这些tag目录, 默认全部
+        :return: 各status的文件数
+        """
+        summary = {}
+        window = self.workers * 4
+        with ProcessPoolExecutor(max_workers=self.workers) as executor:
+            running = {}
+            for tag, entries in self.group_by_tag(iter_archive(b_path, tags)):
+                expected = self.expected(os.path.join(b_path, tag), [_id for _id, _ in entries])
+                for _id, path in entries:
+                    size, _md5, url, variant = expected.get(_id, (None, None, None, 'original'))
+                    future = executor.submit(audit_file, path, size, _md5, config.audit.block_size)
+                    running[future] = dict(id=_id, tag=tag, variant=variant, file_url=url,
+                                           expected_size=size, expected_md5=_md5)
+                    # 限制同时提交的任务数, 避免大目录占用过多内存
+                    while len(running) >= window:
+                        self.collect(running, out, summary)
+            while running:
+                self.collect(running, out, summary)
+        logger.info(f'audit finish {b_path}: {summary}')
+        return summary
+
+    @staticmethod
+    def group_by_tag(entries):
+        tag, group = None, []
+        for entry_tag, _id, path in entries:
+            if entry_tag != tag and group:
+                yield tag, group
+                group = []
+            tag = entry_tag
+            group.append((_id, path))
+        if group:
+            yield tag, group
+
+    @staticmethod
+    def collect(running: dict, out, summary: dict):
+        done, _ = wait(running, return_when=FIRST_COMPLETED)
+        for future in done:
+            item = running.pop(future)
+            item.update(future.result())
+            status = item['status']
+            summary[status] = summary.get(status, 0) + 1
+            if status != 'ok':
+                logger.warning(f'[{item["id"]}] audit {status}: {item["path"]}')
+                out.write(json.dumps(item, ensure_ascii=False) + '\n')
+
+
+def load_queue(queue_path: str) -> list:
+    """
+    读取audit输出的重新下载队列
+    """
+    with open(queue_path, 'r', encoding='utf-8') as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def open_sources(index_path: Optional[str] = None, mirror_path: Optional[str] = None):
+    """
+    打开已存在的索引与镜像, 不存在时为None
+    """
+    index = mirror = None
+    if index_path or config.index.enable:
+        index = DownIndex(index_path)
+    mirror = MetaMirror(mirror_path) if mirror_path or MetaMirror.exists() else None
+    return index, mirror
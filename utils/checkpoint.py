@@ -0,0 +1,97 @@
+import sqlite3
+from pathlib import Path
+from threading import Lock
+from time import time
+from typing import Optional
+
+from pydantic import BaseModel
+
+from utils.constant import config, CONFIG_DIR
+from utils.index import dir_key
+
+
+class TagCheckpoint(BaseModel):
+    """
+    单个tag下载到单个目录的搜索进度
+    high_water以上的图片为新图片; 未完成的搜索记录已完整下载到的最小id, 下次从该id之后继续
+    """
+    tag: str
+    save_dir: str  # 下载目录, 同一tag下载到不同目录时分别记录
+    high_water: int = 0  # 已完整下载的最大id, 下次搜索到此为止
+    run_max_id: int = 0  # 未完成的搜索开始时的最大id, 完成后成为high_water
+    run_stop_id: int = 0  # 未完成的搜索使用的stop_id
+    low_id: int = 0  # 未完成的搜索已完整下载到的最小id, 0为没有未完成的搜索
+    pages: int = 0  # 未完成的搜索已完整下载的页数
+
+    @property
+    def running(self) -> bool:
+        return self.low_id > 0
+
+
+class CheckpointStore:
+    """
+    tag搜索进度, 与下载索引保存在同一个SQLite文件中
+    """
+
+    def __init__(self, db_path: str = None):
+        db_path = Path(db_path or config.index.path)
+        if not db_path.is_absolute():
+            db_path = CONFIG_DIR / db_path
+        self.db_path = db_path
+        self.lock = Lock()
+        self.conn = sqlite3.connect(str(db_path), check_same_thread=False)
+        self.conn.execute('CREATE TABLE IF NOT EXISTS tag_checkpoints ('
+                          'tag TEXT NOT NULL, save_dir TEXT NOT NULL, high_water INTEGER NOT NULL, '
+                          'run_max_id INTEGER NOT NULL, run_stop_id INTEGER NOT NULL, low_id INTEGER NOT NULL, '
+                          'pages INTEGER NOT NULL, updated_at REAL NOT NULL, PRIMARY KEY (tag, save_dir))')
+        self.conn.commit()
+
+    def get(self, tag: str, save_dir) -> TagCheckpoint:
+        """
+        :param save_dir: 下载目录
+        """
+        save_dir = dir_key(save_dir)
+        with self.lock:
+            row = self.conn.execute('SELECT high_water, run_max_id, run_stop_id, low_id, pages FROM tag_checkpoints '
+                                    'WHERE tag = ? AND save_dir = ?', (tag, save_dir)).fetchone()
+        if row is None:
+            return TagCheckpoint(tag=tag, save_dir=save_dir)
+        return TagCheckpoint(tag=tag, save_dir=save_dir,
+                             **dict(zip(('high_water', 'run_max_id', 'run_stop_id', 'low_id', 'pages'), row)))
+
+    def save(self, cp: TagCheckpoint):
+        with self.lock:
+            self.conn.execute('INSERT OR REPLACE INTO tag_checkpoints '
+                              '(tag, save_dir, high_water, run_max_id, run_stop_id, low_id, pages, updated_at) '
+                              'VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                              (cp.tag, cp.save_dir, cp.high_water, cp.run_max_id, cp.run_stop_id, cp.low_id,
+                               cp.pages, time()))
+            self.conn.commit()
+
+    def progress(self, cp: TagCheckpoint, low_id: int, pages: int):
+        """
+        记录已完整下载的页面
+        """
+        cp.low_id = low_id
+        cp.pages = pages
+        self.save(cp)
+
+    def finish(self, cp: TagCheckpoint):
+        """
+        搜索完整结束, 本次的最大id成为新的high_water
+        """
+        cp.high_water = max(cp.high_water, cp.run_max_id)
+        cp.run_max_id = cp.run_stop_id = cp.low_id = cp.pages = 0
+        self.save(cp)
+
+    def close(self):
+        self.conn.close()
+
+
+def open_checkpoints() -> Optional[CheckpointStore]:
+    """
+    启用tag进度记录时打开默认的进度库
+    """
+    if not config.index.checkpoint:
+        return None
+    return CheckpointStore()
@@ -1,6 +1,7 @@
 import os
 from pathlib import Path
-from typing import Optional
+from threading import Lock
+from typing import Optional, Literal
 
 from loguru import logger
 from pydantic import BaseModel
@@ -19,15 +20,46 @@ class ApiConfig(ConfigModel):
     """
     api访问相关配置
     """
+    post_api: str = 'https://yande.re/post.json'
     retry: int = 3
     proxies: Optional[dict] = None
     headers: dict = {}
+    prefetch_pages: int = 2  # 列表页预取数量
+    pool_size: int = 4  # api连接池大小
+    rate_requests: float = 0  # api每秒请求数上限, 0为不限制
+    rate_bytes: float = 0  # api每秒流量上限(字节), 0为不限制
+    backoff: float = 6  # 请求失败/限流后的基础等待时间(秒)
+    max_backoff: float = 300  # 限流指数退避的最长等待时间(秒)
+    tag_num: int = 4  # 批量更新时同时搜索的tag数
+    slim_decode: bool = True  # 列表页只解析下载需要的字段, 其余字段按需校验
 
 
 class DownloaderConfig(ConfigModel):
     thread_num: int = 4
     chunk_size: int = 10 * 1024
     split_size: int = 5 * 1024 * 1024
+    transfer_num: int = 8  # 全局同时进行的传输(分段)数
+    host_transfer_num: int = 4  # 单个host同时进行的传输数上限
+    pool_size: int = 16  # 文件下载连接池大小, 不应小于transfer_num
+    engine: str = 'thread'  # 下载引擎: thread 线程池, async asyncio(需要aiohttp)
+    write_size: int = 256 * 1024  # async引擎每次写入文件的数据量
+    journal_interval: float = 2  # 分段下载中已写入位置的保存间隔(秒), 中断后从该位置续传
+    rate_requests: float = 0  # 文件host每秒请求数上限, 0为不限制
+    rate_bytes: float = 0  # 文件host每秒下载流量上限(字节), 0为不限制
+    adaptive: bool = False  # 根据吞吐与限流自动调整分段大小与并发数(仅thread引擎)
+    max_thread_num: int = 16  # 自适应模式单文件最大并发分段数
+    min_split_size: int = 1024 * 1024  # 自适应模式最小分段, 过小容易被限速
+    max_split_size: int = 64 * 1024 * 1024
+    adaptive_window: float = 5  # 吞吐统计窗口(秒)
+    adaptive_range_seconds: float = 8  # 期望单个分段的传输时长(秒)
+    adaptive_cooldown: float = 30  # 限流后暂停增加并发的时间(秒)
+    # 下载的版本: original 原图, jpeg, sample, smallest 满足最小宽高的最小版本, original_under 原图不超过variant_max_size时下载原图
+    variant: str = 'original'
+    variant_min_width: int = 0  # smallest使用的最小宽度
+    variant_min_height: int = 0  # smallest使用的最小高度
+    variant_max_size: int = 0  # original_under使用的原图大小上限(字节)
+    progress: Literal['rich', 'none', 'auto'] = 'auto'  # 进度显示: rich 进度条, none 不显示(定时任务), auto 标准输出为终端时显示
+    progress_refresh: float = 4  # 进度条每秒刷新次数
 
 
 class MariaDBConfig(ConfigModel):
@@ -38,12 +70,69 @@ class MariaDBConfig(ConfigModel):
     password: str = ''
     schema_name: str = 'Pictures'
     datatable: str = 'YandeRE'
+    url: str = ''  # SQLAlchemy连接地址, 不为空时代替上面的MariaDB配置(如 sqlite:///yande.db)
+    batch_size: int = 500  # 批量写入每个事务的行数
+
+
+class IndexConfig(ConfigModel):
+    """
+    已下载文件的本地索引
+    """
+    enable: bool = False
+    path: str = 'index.db'  # 相对路径时位于config目录下
+    link_mode: str = 'hardlink'  # 其他tag已下载的图片: hardlink 硬链接, symlink 软链接, none 重新下载
+    checkpoint: bool = False  # 按tag与下载目录记录搜索进度, 下次搜索到上次的最大id为止, 中断后从中断的位置继续
+
+
+class MirrorConfig(ConfigModel):
+    """
+    元数据本地镜像
+    """
+    path: str = 'mirror.db'  # 相对路径时位于config目录下
+    limit: int = 100  # 镜像时每页获取的数量
+
+
+class AuditConfig(ConfigModel):
+    """
+    已下载文件的完整性检查
+    """
+    workers: int = 0  # 计算md5的进程数, 0为CPU数
+    block_size: int = 1024 * 1024  # 分块读取大小
+
+
+class MetricsConfig(ConfigModel):
+    """
+    指标与trace输出
+    """
+    enable: bool = True
+    path: str = ''  # 指标输出文件, 为空时不输出
+    format: str = 'prometheus'  # prometheus 覆盖写入文本格式, json 每次追加一行
+    interval: float = 15  # 定时输出间隔(秒), 0为只在退出时输出
+    trace_path: str = ''  # 每个文件各阶段耗时的JSON lines输出文件, 为空时不记录
+
+
+class QueueConfig(ConfigModel):
+    """
+    多进程/多台机器分布式下载的共享任务队列
+    """
+    path: str = 'queue.db'  # 相对路径时位于config目录下, 多台机器时为共享目录中的同一文件
+    wal: bool = True  # 队列文件位于网络共享目录时需关闭, WAL只支持同一台机器上的多个进程
+    lease: float = 120  # 任务租约(秒), 超时未续约的任务由其他worker重新领取
+    heartbeat: float = 30  # worker续约间隔(秒)
+    max_attempts: int = 5  # 单个任务最多领取次数
+    retry_delay: float = 30  # 失败后重新领取前的等待(秒), 按失败次数递增
+    poll: float = 2  # 队列为空时worker的轮询间隔(秒)
 
 
 class Config(ConfigModel):
     database: MariaDBConfig = MariaDBConfig()
     yande_api: ApiConfig = ApiConfig()
     downloader: DownloaderConfig = DownloaderConfig()
+    index: IndexConfig = IndexConfig()
+    mirror: MirrorConfig = MirrorConfig()
+    metrics: MetricsConfig = MetricsConfig()
+    audit: AuditConfig = AuditConfig()
+    queue: QueueConfig = QueueConfig()
 
 
 def load_config(config_path: str = 'data.cfg'):
@@ -60,11 +149,34 @@ def load_config(config_path: str = 'data.cfg'):
                 logger.warning(f'load cfg err: {e}')
 
     if _config is None:
-        _config = Config().model_dump_json(indent=4)
+        _config = Config()
         with open(config_path, 'w') as f:
-            f.write(_config)
+            f.write(_config.model_dump_json(indent=4))
 
     return _config
 
 
-config = load_config(str(Path(__file__).absolute().parent.parent / 'config' / 'data.cfg'))
+class LazyConfig:
+    """
+    首次访问配置项时才读取配置文件, import时不做文件读写
+    """
+
+    def __init__(self, loader):
+        self._loader = loader
+        self._config = None
+        self._lock = Lock()
+
+    def load(self) -> Config:
+        if self._config is None:
+            with self._lock:
+                if self._config is None:
+                    self._config = self._loader()
+        return self._config
+
+    def __getattr__(self, name):
+        return getattr(self.load(), name)
+
+
+CONFIG_DIR = Path(__file__).absolute().parent.parent / 'config'
+# 可通过环境变量YANDE_CONFIG指定其他配置文件
+config: Config = LazyConfig(lambda: load_config(os.environ.get('YANDE_CONFIG') or str(CONFIG_DIR / 'data.cfg')))
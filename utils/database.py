@@ -1,17 +1,25 @@
-from sqlalchemy import Column, Integer, Text, DateTime, String, create_engine, Boolean, Enum, JSON
+from functools import lru_cache
+
+from sqlalchemy import Column, Integer, Text, DateTime, String, create_engine, Boolean, Enum, JSON, select, insert
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.orm import DeclarativeBase, sessionmaker, Session
 
 from utils.constant import config
 from utils.items import Rating
 
 
-class MariaDBClient:
+@lru_cache(maxsize=None)
+def build_model(datatable: str = None):
+    """
+    按配置的表名创建ORM模型, 首次使用时才读取配置
+    :return: (Base, YandeData)
+    """
 
     class Base(DeclarativeBase):
         pass
 
     class YandeData(Base):
-        __tablename__ = config.database.datatable
+        __tablename__ = datatable or config.database.datatable
         id = Column(Integer,unique=True, primary_key=True, comment='yande picture ID')
         down_flag = Column(Boolean, default=True, primary_key=True, comment='yande picture down status')
         tags = Column(String(918), comment='picture tag', nullable=True)
@@ -62,17 +70,42 @@ class MariaDBClient:
         last_noted_at = Column(Integer)
         last_commented_at = Column(Integer)
 
-    def __init__(self):
-        engine = create_engine('mariadb+mariadbconnector://'
-                               f'{config.database.user}:'
-                               f'{config.database.password}@'
-                               f'{config.database.host}:{config.database.port}/'
-                               f'{config.database.schema_name}?charset=utf8')
+    return Base, YandeData
+
+
+class LazyModel:
+    """
+    类属性访问时才创建模型, 保持MariaDBClient.YandeData的用法
+    """
+
+    def __init__(self, n: int):
+        self.n = n
+
+    def __get__(self, obj, owner):
+        return build_model()[self.n]
+
+
+class MariaDBClient:
+    Base = LazyModel(0)
+    YandeData = LazyModel(1)
+
+    def __init__(self, url: str = None):
+        """
+        :param url: SQLAlchemy连接地址, 默认使用database.url, 为空时按配置连接MariaDB
+        """
+        url = url or config.database.url or ('mariadb+mariadbconnector://'
+                                             f'{config.database.user}:'
+                                             f'{config.database.password}@'
+                                             f'{config.database.host}:{config.database.port}/'
+                                             f'{config.database.schema_name}?charset=utf8')
+        engine = create_engine(url)
+        self.engine = engine
         self.Base.metadata.create_all(bind=engine)
-        # self.session = sessionmaker(engine)()
+        # 批量写入每次使用独立session, 可在多线程中调用
+        self.session_maker = sessionmaker(engine)
         self.session = Session(bind=engine)
 
-    def insert_data(self, sql_data: YandeData):
+    def insert_data(self, sql_data: 'YandeData'):
         self.session.add(sql_data)
         self.session.commit()
 
@@ -82,10 +115,77 @@ class MariaDBClient:
             return True
         return False
 
-    def insert_by_id(self, _id, sql_data: YandeData):
+    def insert_by_id(self, _id, sql_data: 'YandeData'):
         if self.insert_check_by_id(_id):
             self.insert_data(sql_data)
 
+    def insert_ignore(self, session: Session, rows: list) -> int:
+        """
+        写入一批行, 已存在的id跳过, 多线程同时写入同一id时不会使整批失败
+        :return: 新写入的行数, MariaDB并发写入同一id时可能偏大
+        """
+        table = self.YandeData.__table__
+        dialect = self.engine.dialect.name
+        if dialect in ('mysql', 'mariadb'):
+            from sqlalchemy.dialects.mysql import insert as mysql_insert
+            stmt = mysql_insert(table)
+            stmt = stmt.on_duplicate_key_update(id=stmt.inserted.id)
+        elif dialect in ('sqlite', 'postgresql'):
+            dialect_insert = __import__(f'sqlalchemy.dialects.{dialect}', fromlist=['insert']).insert
+            stmt = dialect_insert(table).on_conflict_do_nothing()
+        else:
+            # 不支持upsert的数据库, 冲突时逐行写入
+            try:
+                ret = session.execute(insert(table), rows).rowcount
+                session.commit()
+                return ret
+            except IntegrityError:
+                session.rollback()
+            ret = 0
+            for row in rows:
+                try:
+                    session.execute(insert(table), [row])
+                    session.commit()
+                    ret += 1
+                except IntegrityError:
+                    session.rollback()
+            return ret
+        ret = session.execute(stmt, rows).rowcount
+        session.commit()
+        return ret
+
+    def insert_page(self, items, batch_size: int = None) -> int:
+        """
+        批量写入一页(或任意多个)YandePostItem, 一次IN查询排除已存在的id, 分批以upsert提交
+        :param items:
+        :param batch_size: 每个事务写入的行数, 默认为database.batch_size
+        :return: 新写入的行数
+        """
+        batch_size = batch_size or config.database.batch_size
+        # 同一批内重复的id只保留第一个
+        unique_items = {}
+        for i in items:
+            unique_items.setdefault(i.id, i)
+        items = list(unique_items.values())
+        inserted = 0
+        with self.session_maker() as session:
+            existing = set()
+            ids = [i.id for i in items]
+            for n in range(0, len(ids), batch_size):
+                existing.update(session.scalars(select(self.YandeData.id).where(
+                    self.YandeData.id.in_(ids[n:n + batch_size]))))
+            new_items = [i for i in items if i.id not in existing]
+            for n in range(0, len(new_items), batch_size):
+                # 查询之后其他线程可能已写入同一id, 由upsert跳过
+                inserted += self.insert_ignore(session, [i.model_dump() for i in new_items[n:n + batch_size]])
+        return inserted
+
+    def insert_pages(self, pages, batch_size: int = None) -> int:
+        """
+        按页流式写入, pages为YandePostData的迭代器
+        """
+        return sum(self.insert_page(page.root, batch_size) for page in pages)
+
     def close(self):
         self.session.close()
 
@@ -1,19 +1,40 @@
+import json
 import os.path
-from contextlib import closing
+from contextlib import closing, contextmanager
 from hashlib import md5
-from multiprocessing import Queue
-from threading import Thread
-from time import sleep
+from threading import Lock, BoundedSemaphore
+from time import sleep, monotonic, perf_counter
+from typing import Tuple, Optional
+from urllib.parse import urlsplit
 
-import requests
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait, FIRST_COMPLETED
 
 from loguru import logger
-from rich.progress import Progress, TextColumn, BarColumn, TimeRemainingColumn, TimeElapsedColumn, TaskID
-from pathvalidate import sanitize_filename
 
+from utils.adaptive import AdaptiveTuner, get_tuner
 from utils.constant import config
-from utils.items import FileInfo
+from utils.items import FileInfo, DownResult
+from utils.limiter import file_limiter, THROTTLE_STATUS
+from utils.metrics import counter, gauge, histogram, span, RATE_BUCKETS
+from utils.progress import FileProgress, get_progress
+from utils.session import get_session
+
+
+PART_SUFFIX = '.part'
+JOURNAL_SUFFIX = '.part.json'
+JOURNAL_TMP_SUFFIX = '.part.json.tmp'
+# 扫描下载目录时跳过的未完成文件
+INCOMPLETE_SUFFIXES = (PART_SUFFIX, JOURNAL_SUFFIX, JOURNAL_TMP_SUFFIX)
+
+RANGE_TTFB = histogram('range_ttfb_seconds', '分段请求到收到响应头的耗时')
+RANGE_RATE = histogram('range_bytes_per_second', '单个分段的平均传输速度', RATE_BUCKETS)
+RANGE_WRITE = histogram('range_write_seconds', '单个分段写入文件的累计耗时')
+RANGE_RETRIES = counter('range_retries_total', '分段下载失败次数')
+RANGES_QUEUED = gauge('ranges_queued', '已提交等待传输的分段数')
+RANGES_ACTIVE = gauge('ranges_active', '正在传输的分段数')
+BYTES_WRITTEN = counter('bytes_written_total', '写入文件的字节数')
+FILE_THROTTLED = counter('throttled_total', '服务端限流次数', target='file')
+MD5_FAILURES = counter('md5_failures_total', 'md5校验失败的文件数')
 
 
 class MultiDown:
@@ -22,156 +43,472 @@ class MultiDown:
     """
 
     def __init__(self, url: str, file_path: str, file_name: str,
-                 file_size: int = 0, _md5: str = None, _id: int = None) -> None:
+                 file_size: int = 0, _md5: str = None, _id: int = None,
+                 executor: ThreadPoolExecutor = None) -> None:
+        """
+        :param executor: 共享的传输线程池, 为None时使用单文件独立线程池
+        """
         self.thread_num = config.downloader.thread_num
-        self.data_q: Queue = Queue()
-        self.progress_q: Queue = Queue()
-        self.close_q: Queue = Queue(1)
+        self.executor = executor
+        self.result: DownResult = None
+        self.file_progress: FileProgress = None
         if file_size == 0:
-            file_size = self.get_file_size(url)
+            with span('size_probe', trace=_id):
+                file_size = self.get_file_size(url)
         # 排除文件名特殊字符
+        from pathvalidate import sanitize_filename
         file_name = sanitize_filename(file_name)
         self.file_info = FileInfo(url=url, id=_id,
                                   file_path=os.path.join(file_path, file_name), file_size=file_size, md5=_md5)
-        self.progress = Progress(TextColumn('down file [progress.description] {task.description}'),
-                                 BarColumn(),
-                                 TextColumn("[progress.percentage]{task.percentage:>3.0f}%"),
-                                 SpeedColumn(" {task.speed}"),
-                                 TextColumn("{task.completed:>.03f}/{task.total:>.03f} MB"),
-                                 TimeRemainingColumn(),
-                                 TimeElapsedColumn()
-                                 )
-        self.progress.start()
         self.start()
 
     @staticmethod
     def get_file_size(_url):
-        with closing(requests.get(_url, stream=True,
-                                  proxies=config.yande_api.proxies,
-                                  headers=config.yande_api.headers)) as res:
+        session = get_session(_url, config.downloader.pool_size)
+        file_limiter(_url).acquire_request()
+        with host_slot(_url), closing(session.get(_url, stream=True,
+                                                  proxies=config.yande_api.proxies,
+                                                  headers=config.yande_api.headers)) as res:
             file_size = int(res.headers.get('Content-Length', '0'))
         return file_size
 
     @staticmethod
-    def get_content(url: str, _id: int, s: int, e: int, rx_q: Queue, data_q: Queue):
+    def get_content(url: str, _id: int, file_path: str, s: int, e, file_progress: FileProgress,
+                    journal: 'RangeJournal' = None) -> Tuple[bool, Optional[str]]:
+        """
+        下载一个分段, 数据块直接写入文件对应偏移位置
+        :param file_progress: 累加已下载的字节数
+        :param journal: 定时记录分段已写入的位置, 分段完成后记录到下载记录
+        :return: 分段是否下载完成, 整文件单段下载时附带边下边算的md5
+        """
         headers = {
             "authority": "files.yande.re",
             'Referer': 'https://yande.re/'
         }
-        if s != 0 or e != '':
+        whole_file = s == 0 and e == ''
+        if not whole_file:
             headers.update({"Range": f"bytes={s}-{e}"})
         headers.update(config.yande_api.headers)
+        session = get_session(url, config.downloader.pool_size)
+        limiter = file_limiter(url)
+        RANGES_QUEUED.inc(-1)
         for retry in range(config.yande_api.retry):
-            content_data = []
             chunk_sum = 0
+            hasher = md5() if whole_file else None
+            throttled = False
             try:
-                with closing(requests.get(url, stream=True,
-                                          proxies=config.yande_api.proxies,
-                                          headers=headers,
-                                          timeout=5)) as res:
-                    for chunk in res.iter_content(chunk_size=config.downloader.chunk_size):
-                        if chunk:
-                            rx_q.put(len(chunk) / 1024 / 1024)
-                            chunk_sum += len(chunk) / 1024 / 1024
-                            content_data.append(chunk)
-                data_q.put([s, e, b''.join(content_data)])
-                return
+                limiter.acquire_request()
+                with host_slot(url):
+                    RANGES_ACTIVE.inc()
+                    try:
+                        begin = perf_counter()
+                        with closing(session.get(url, stream=True,
+                                                 proxies=config.yande_api.proxies,
+                                                 headers=headers,
+                                                 timeout=5)) as res, open(file_path, 'rb+') as f:
+                            RANGE_TTFB.observe(perf_counter() - begin)
+                            if res.status_code in THROTTLE_STATUS:
+                                FILE_THROTTLED.inc()
+                                throttled = True
+                                limiter.on_throttle(res.headers.get('Retry-After'))
+                            res.raise_for_status()
+                            f.seek(s)
+                            write_time = 0
+                            for chunk in res.iter_content(chunk_size=config.downloader.chunk_size):
+                                if chunk:
+                                    limiter.acquire_bytes(len(chunk))
+                                    w = perf_counter()
+                                    f.write(chunk)
+                                    write_time += perf_counter() - w
+                                    if hasher is not None:
+                                        hasher.update(chunk)
+                                    file_progress.advance(len(chunk))
+                                    chunk_sum += len(chunk)
+                                    if journal is not None and journal.due():
+                                        # 先写入文件再记录位置, 中断后从该位置续传
+                                        f.flush()
+                                        journal.progress(s, s + chunk_sum)
+                    finally:
+                        RANGES_ACTIVE.inc(-1)
+                        BYTES_WRITTEN.inc(chunk_sum)
+                RANGE_RATE.observe(chunk_sum / max(perf_counter() - begin, 1e-6))
+                RANGE_WRITE.observe(write_time)
+                limiter.on_success()
+                if journal is not None:
+                    journal.add(s, e)
+                return True, hasher.hexdigest() if hasher is not None else None
             except Exception as err:
+                RANGE_RETRIES.inc()
                 logger.warning(f'[{_id}] down error {retry} {url} {s}-{e}: {err}')
-                if s != 0 or e != '':
-                    rx_q.put(-chunk_sum)
-                sleep(6)
+                file_progress.advance(-chunk_sum)
+                if journal is not None and chunk_sum:
+                    # 文件已关闭, 已写入的部分下次运行时不再下载
+                    journal.progress(s, s + chunk_sum)
+                # 限流时的等待由limiter在下次请求前统一处理
+                if not throttled:
+                    sleep(config.yande_api.backoff)
+        return False, None
 
     @staticmethod
-    def progress_update(rx_q: Queue, msg_q: Queue, progress: Progress, task: TaskID):
+    def allocate_file(file_path: str, file_size: int):
         """
-        刷新进度条
+        预先创建与目标大小一致的稀疏文件, 各分段直接写入对应位置
         """
-        # add = 0
-        while queue_wait(rx_q, msg_q):
-            down_length = rx_q.get()
-            # add += down_length
-            progress.advance(task, down_length)
+        with open(file_path, 'wb') as f:
+            if file_size > 0:
+                f.seek(file_size - 1)
+                f.write(b'\x00')
 
-    @staticmethod
-    def file_writer(file_info: FileInfo, data_q: Queue, msg_q: Queue):
-        f_size = file_info.file_size
-        f_path = file_info.file_path
-        with open(f_path, 'w') as f:
-            f.seek(f_size - 1)
-            f.write('\x00')
-
-        file = open(f_path, 'rb+')
-        while queue_wait(data_q, msg_q):
-            s, e, data = data_q.get()
-            file.seek(s)
-            file.write(data)
-
-        file.close()
-
-        if file_info.md5:
-            file = open(f_path, 'rb+')
-            file_md5 = md5(file.read()).hexdigest()
-            file.close()
-            # print(file_md5, file_info.md5)
-            if file_info.md5 != file_md5:
-                logger.warning(f'md5 check err: {f_path}')
-                os.remove(f_path)
-
-    def down_file_in_range(self, file_size):
-        executor = ThreadPoolExecutor(max_workers=self.thread_num)
-        split_size = config.downloader.split_size
+    def down_file_in_range(self, journal: 'RangeJournal') -> Tuple[bool, Optional[str]]:
+        executor = self.executor
+        if executor is None:
+            executor = ThreadPoolExecutor(max_workers=self.thread_num)
         executor_pool = []
-        if (file_size // split_size) < 2:
-            split_size = file_size + 1
-
-        for s_offset in range(0, file_size + 1, split_size):
-            e_offset = s_offset + split_size - 1
-            if e_offset >= file_size:
-                e_offset = ''
+        for s_offset, e_offset in journal.split_ranges(config.downloader.split_size):
+            RANGES_QUEUED.inc()
             t = executor.submit(self.get_content,
-                                self.file_info.url, self.file_info.id,
-                                s_offset, e_offset, self.progress_q, self.data_q)
+                                self.file_info.url, self.file_info.id, journal.part_path,
+                                s_offset, e_offset, self.file_progress, journal)
             t.add_done_callback(lambda x: logger.warning(x.exception()) if x.exception() else '')
             executor_pool.append(t)
-            # self.get_content(self.file_info.url, s_offset, e_offset, self.progress_q, self.data_q)
 
+        complete = True
+        file_md5 = None
         for t in as_completed(executor_pool):
-            t.result()
+            if t.exception() is not None:
+                complete = False
+                continue
+            ok, file_md5 = t.result()
+            complete = complete and ok
+        if self.executor is None:
+            executor.shutdown()
+        # 多分段或续传时md5无法边下边算, 由校验时分块读取计算
+        return complete, file_md5 if len(executor_pool) == 1 else None
+
+    def get_range(self, task: 'RangeTask', journal: 'RangeJournal', tuner: AdaptiveTuner) -> bool:
+        """
+        自适应模式下载一个分段, 分段尾部可能被空闲线程拆走
+        :return: 分段是否下载完成
+        """
+        url = self.file_info.url
+        headers = {
+            "authority": "files.yande.re",
+            'Referer': 'https://yande.re/'
+        }
+        headers.update(config.yande_api.headers)
+        session = get_session(url, config.downloader.pool_size)
+        limiter = file_limiter(url)
+        RANGES_QUEUED.inc(-1)
+        for retry in range(config.yande_api.retry):
+            headers.update({"Range": f"bytes={task.pos}-{task.e}"})
+            got = 0
+            throttled = False
+            limiter.acquire_request()
+            begin = monotonic()
+            try:
+                with host_slot(url):
+                    RANGES_ACTIVE.inc()
+                    try:
+                        with closing(session.get(url, stream=True,
+                                                 proxies=config.yande_api.proxies,
+                                                 headers=headers,
+                                                 timeout=5)) as res, open(journal.part_path, 'rb+') as f:
+                            RANGE_TTFB.observe(monotonic() - begin)
+                            if res.status_code in THROTTLE_STATUS:
+                                FILE_THROTTLED.inc()
+                                throttled = True
+                                tuner.on_throttle()
+                                limiter.on_throttle(res.headers.get('Retry-After'))
+                            res.raise_for_status()
+                            write_time = 0
+                            for chunk in res.iter_content(chunk_size=config.downloader.chunk_size):
+                                with task.lock:
+                                    offset = task.pos
+                                    n = min(len(chunk), task.e - offset + 1)
+                                    task.pos += max(n, 0)
+                                if n <= 0:
+                                    break
+                                limiter.acquire_bytes(n)
+                                w = perf_counter()
+                                f.seek(offset)
+                                f.write(memoryview(chunk)[:n])
+                                write_time += perf_counter() - w
+                                got += n
+                                self.file_progress.advance(n)
+                                if journal.due():
+                                    f.flush()
+                                    journal.progress(task.s, task.pos)
+                    finally:
+                        RANGES_ACTIVE.inc(-1)
+                        BYTES_WRITTEN.inc(got)
+                tuner.on_range_done(got, monotonic() - begin)
+                RANGE_RATE.observe(got / max(monotonic() - begin, 1e-6))
+                RANGE_WRITE.observe(write_time)
+                limiter.on_success()
+                if task.pos > task.e:
+                    journal.add(task.s, task.e)
+                    return True
+            except Exception as err:
+                RANGE_RETRIES.inc()
+                tuner.on_range_done(got, monotonic() - begin)
+                import requests
+                if isinstance(err, requests.ConnectionError):
+                    tuner.on_throttle()
+                logger.warning(f'[{self.file_info.id}] down error {retry} {url} {task.pos}-{task.e}: {err}')
+                if not throttled:
+                    sleep(config.yande_api.backoff)
+        # 记录已完成的前半段, 剩余部分下次续传
+        if task.pos > task.s:
+            journal.add(task.s, task.pos - 1)
+        return False
+
+    @staticmethod
+    def steal(tasks) -> Optional['RangeTask']:
+        """
+        从剩余最多的进行中分段拆出后半段
+        """
+        if not tasks:
+            return None
+        task = max(tasks, key=lambda x: x.e - x.pos)
+        with task.lock:
+            remain = task.e - task.pos + 1
+            if remain < 2 * config.downloader.min_split_size:
+                return None
+            mid = task.pos + remain // 2
+            new_task = RangeTask(mid, task.e)
+            task.e = mid - 1
+        return new_task
+
+    def down_file_adaptive(self, journal: 'RangeJournal') -> bool:
+        """
+        自适应分段下载: 并发数与分段大小由AdaptiveTuner决定, 队列取空后拆分慢分段
+        """
+        tuner = get_tuner(self.file_info.url)
+        executor = self.executor
+        if executor is None:
+            executor = ThreadPoolExecutor(max_workers=tuner.max_concurrency)
+        last = self.file_info.file_size - 1
+        pending = [RangeTask(s_offset, last if e_offset == '' else e_offset)
+                   for s_offset, e_offset in journal.split_ranges(tuner.split_size)
+                   if s_offset <= last]
+        running = {}
+        complete = True
+        while pending or running:
+            while len(running) < tuner.concurrency:
+                task = pending.pop(0) if pending else self.steal(list(running.values()))
+                if task is None:
+                    break
+                RANGES_QUEUED.inc()
+                running[executor.submit(self.get_range, task, journal, tuner)] = task
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for t in done:
+                running.pop(t)
+                if t.exception() is not None:
+                    logger.warning(t.exception())
+                    complete = False
+                elif not t.result():
+                    complete = False
+        if self.executor is None:
+            executor.shutdown()
+        return complete
+
+    def verify(self, file_path: str, file_md5: str = None) -> bool:
+        """
+        校验md5, 未边下边算时按块流式读取文件计算
+        """
+        if file_md5 is None and self.file_info.md5:
+            file_md5 = file_md5_hex(file_path)
+        self.result.md5 = file_md5
+        if self.file_info.md5:
+            self.result.verified = self.file_info.md5 == file_md5
+            if not self.result.verified:
+                MD5_FAILURES.inc()
+                logger.warning(f'md5 check err: {self.file_info.file_path}')
+        return self.result.verified is not False
 
     def start(self):
         file_size = self.file_info.file_size
         file_path = self.file_info.file_path
         description = file_path if len(file_path) < 21 else f'{file_path[:10]}...{file_path[-10:]}'
-        # 启动进度条
-        task_id = self.progress.add_task(f'[{self.file_info.id}] {description}',
-                                         total=file_size / 1024 / 1024)
-        progress_t = Thread(target=self.progress_update, args=(self.progress_q, self.close_q, self.progress, task_id))
-        progress_t.start()
-        # 启动文件写
-        writer_t = Thread(target=self.file_writer, args=(self.file_info, self.data_q, self.close_q))
-        writer_t.start()
-        # 启动下载分割
-        self.down_file_in_range(file_size)
-        self.close_q.put('1')
-        writer_t.join()
-        progress_t.join()
-        self.progress.stop()
-
-
-class SpeedColumn(TextColumn):
-    def render(self, task: "Task") -> str:
-        if task.speed is None:
-            return 'NA'
-        elif task.speed is not None:
-            return f'{task.speed:.03f} MB/s'
-
-
-def queue_wait(data_q: Queue, close_q: Queue):
-    while True:
-        if data_q.empty():
-            if close_q.full():
-                return False
-            sleep(1)
+        # 已有匹配的下载记录时只续传缺失的分段
+        journal = RangeJournal(self.file_info)
+        if not journal.load():
+            self.allocate_file(journal.part_path, file_size)
+            journal.save()
+        progress = get_progress()
+        self.file_progress = progress.add_file(f'[{self.file_info.id}] {description}', file_size,
+                                               journal.done_size())
+        with span('ranges', trace=self.file_info.id, size=file_size,
+                  resumed=journal.done_size(), adaptive=config.downloader.adaptive) as attrs:
+            if config.downloader.adaptive:
+                complete, file_md5 = self.down_file_adaptive(journal), None
+            else:
+                complete, file_md5 = self.down_file_in_range(journal)
+            attrs['complete'] = complete
+        progress.remove_file(self.file_progress)
+        self.result = DownResult(id=self.file_info.id, file_path=file_path, file_size=file_size, complete=complete)
+        if not complete:
+            # 保留.part文件与下载记录, 下次运行时续传
+            logger.warning(f'[{self.file_info.id}] down incomplete, keep for resume: {journal.part_path}')
         else:
-            return True
+            with span('verify', trace=self.file_info.id, inline=file_md5 is not None) as attrs:
+                verified = attrs['ok'] = self.verify(journal.part_path, file_md5)
+            with span('write', trace=self.file_info.id):
+                if verified:
+                    # 校验通过后才原子重命名为目标文件
+                    os.replace(journal.part_path, file_path)
+                else:
+                    os.remove(journal.part_path)
+                journal.remove()
+        file_done(self.result)
+
+
+class RangeTask:
+    """
+    自适应模式的分段, pos为下一个写入位置, e可能被缩短
+    """
+
+    def __init__(self, s: int, e: int):
+        self.s = s
+        self.e = e
+        self.pos = s
+        self.lock = Lock()
+
+
+class RangeJournal:
+    """
+    分段下载记录, 未完成的文件以.part保存, 已完成的区间与进行中分段已写入的位置记录在.part.json中
+    """
+
+    def __init__(self, file_info: FileInfo):
+        self.file_info = file_info
+        self.part_path = file_info.file_path + PART_SUFFIX
+        self.path = file_info.file_path + JOURNAL_SUFFIX
+        self.done: list = []
+        # 进行中的分段 起点 -> 已写入到的位置(不含)
+        self.partial: dict = {}
+        self.lock = Lock()
+        self.saved_at = monotonic()
+
+    def load(self) -> bool:
+        """
+        读取下载记录, 与当前文件信息不一致时视为无效
+        """
+        if not (os.path.exists(self.part_path) and os.path.exists(self.path)):
+            return False
+        try:
+            with open(self.path, 'r') as f:
+                data = json.load(f)
+        except Exception as e:
+            logger.warning(f'load journal err {self.path}: {e}')
+            return False
+        if (data.get('file_size') != self.file_info.file_size or data.get('md5') != self.file_info.md5 or
+                os.path.getsize(self.part_path) != self.file_info.file_size):
+            return False
+        self.done = [tuple(i) for i in data.get('done', [])]
+        self.partial = {s: pos for s, pos in data.get('partial', [])}
+        return True
+
+    def save(self):
+        tmp_path = self.file_info.file_path + JOURNAL_TMP_SUFFIX
+        with open(tmp_path, 'w') as f:
+            json.dump(dict(file_size=self.file_info.file_size, md5=self.file_info.md5, done=self.done,
+                           partial=list(self.partial.items())), f)
+        os.replace(tmp_path, self.path)
+        self.saved_at = monotonic()
+
+    def add(self, s: int, e):
+        """
+        记录一个已完成的区间
+        """
+        if e == '':
+            e = self.file_info.file_size - 1
+        with self.lock:
+            self.done.append((s, e))
+            self.partial.pop(s, None)
+            self.save()
+
+    def due(self) -> bool:
+        """
+        距上次保存超过downloader.journal_interval
+        """
+        return monotonic() - self.saved_at >= config.downloader.journal_interval
+
+    def progress(self, s: int, pos: int):
+        """
+        记录分段已连续写入到pos(不含), 重试时位置不回退
+        """
+        with self.lock:
+            if pos > self.partial.get(s, s):
+                self.partial[s] = pos
+                self.save()
+
+    def missing(self) -> list:
+        """
+        计算尚未完成的区间(闭区间)
+        """
+        ret = []
+        pos = 0
+        for s, e in sorted(self.done + [(s, p - 1) for s, p in self.partial.items()]):
+            if s > pos:
+                ret.append((pos, s - 1))
+            pos = max(pos, e + 1)
+        if pos < self.file_info.file_size:
+            ret.append((pos, self.file_info.file_size - 1))
+        return ret
+
+    def split_ranges(self, split_size: int) -> list:
+        """
+        按split_size拆分尚未完成的区间, 整个文件未下载且不需拆分时返回单个不带Range的分段
+        """
+        if not self.done and not self.partial and (self.file_info.file_size // split_size) < 2:
+            return [(0, '')]
+        ranges = []
+        for m_s, m_e in self.missing():
+            for s_offset in range(m_s, m_e + 1, split_size):
+                ranges.append((s_offset, min(s_offset + split_size - 1, m_e)))
+        return ranges
+
+    def done_size(self) -> int:
+        return self.file_info.file_size - sum(e - s + 1 for s, e in self.missing())
+
+    def remove(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+def file_done(result: DownResult):
+    """
+    按结果统计完成的文件数
+    """
+    status = 'incomplete' if not result.complete else 'md5_error' if result.verified is False else 'ok'
+    counter('files_total', '结束的文件数', result=status).inc()
+
+
+def file_md5_hex(file_path: str, block_size: int = 1024 * 1024) -> str:
+    """
+    分块流式计算文件md5
+    """
+    hasher = md5()
+    with open(file_path, 'rb') as f:
+        while block := f.read(block_size):
+            hasher.update(block)
+    return hasher.hexdigest()
+
+
+_host_slots: dict = {}
+_host_lock = Lock()
+
+
+@contextmanager
+def host_slot(url: str):
+    """
+    限制单个host的并发传输数
+    """
+    host = urlsplit(url).netloc
+    with _host_lock:
+        slot = _host_slots.get(host)
+        if slot is None:
+            slot = _host_slots[host] = BoundedSemaphore(config.downloader.host_transfer_num)
+    with slot:
+        yield
@@ -0,0 +1,189 @@
+import os
+import sqlite3
+from pathlib import Path
+from threading import Lock
+from typing import Optional
+
+from loguru import logger
+
+from utils.constant import config, CONFIG_DIR
+from utils.downloader import INCOMPLETE_SUFFIXES
+from utils.items import DownResult
+
+
+def parse_file_id(file_name: str) -> int:
+    """
+    从"yande.re {id} {tags}.ext"格式的文件名中解析id
+    """
+    return int(file_name.split(' ', maxsplit=2)[1])
+
+
+def dir_key(save_dir) -> str:
+    """
+    下载目录在索引中的键, 同一tag下载到不同目录时分别记录
+    """
+    return os.path.normcase(os.path.abspath(str(save_dir)))
+
+
+class DownIndex:
+    """
+    已下载图片的本地索引(SQLite), 启动时将 下载目录 -> {id: 文件路径} 加载到内存
+    只作为已下载的快速判断, 没有记录时仍以下载目录中的文件为准
+    """
+
+    def __init__(self, db_path: str = None):
+        db_path = Path(db_path or config.index.path)
+        if not db_path.is_absolute():
+            db_path = CONFIG_DIR / db_path
+        self.db_path = db_path
+        self.lock = Lock()
+        self.conn = sqlite3.connect(str(db_path), check_same_thread=False)
+        self.conn.execute('CREATE TABLE IF NOT EXISTS downloads ('
+                          'id INTEGER NOT NULL, dir TEXT NOT NULL, tag TEXT NOT NULL, path TEXT NOT NULL, '
+                          'size INTEGER, md5 TEXT, variant TEXT NOT NULL DEFAULT \'original\', '
+                          'PRIMARY KEY (id, dir))')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS downloads_id ON downloads (id)')
+        self.conn.commit()
+        self.dir_files: dict = {}
+        self.load()
+
+    def load(self):
+        dir_files = {}
+        with self.lock:
+            for _id, _dir, path in self.conn.execute('SELECT id, dir, path FROM downloads'):
+                dir_files.setdefault(_dir, {})[_id] = path
+            self.dir_files = dir_files
+
+    def ids(self, save_dir) -> set:
+        """
+        下载目录中已记录的id集合
+        """
+        with self.lock:
+            return set(self.dir_files.get(dir_key(save_dir), ()))
+
+    def contains(self, _id: int, save_dir) -> bool:
+        """
+        已记录且文件仍存在, 文件已被删除时移除记录
+        """
+        _dir = dir_key(save_dir)
+        path = self.dir_files.get(_dir, {}).get(_id)
+        if path is None:
+            return False
+        if os.path.isfile(path):
+            return True
+        with self.lock:
+            self.conn.execute('DELETE FROM downloads WHERE id = ? AND dir = ?', (_id, _dir))
+            self.conn.commit()
+            self.dir_files.get(_dir, {}).pop(_id, None)
+        return False
+
+    def add(self, tag: str, result: DownResult, variant: str = 'original'):
+        """
+        记录一个已完成的下载, 按文件所在目录区分
+        :param variant: 下载的版本 original/jpeg/sample
+        """
+        _dir = dir_key(os.path.dirname(result.file_path))
+        with self.lock:
+            self.conn.execute('INSERT OR REPLACE INTO downloads (id, dir, tag, path, size, md5, variant) '
+                              'VALUES (?, ?, ?, ?, ?, ?, ?)',
+                              (result.id, _dir, tag, result.file_path, result.file_size, result.md5, variant))
+            self.conn.commit()
+            self.dir_files.setdefault(_dir, {})[result.id] = result.file_path
+
+    def files(self, save_dir) -> list:
+        """
+        下载目录中已记录的文件
+        :return: [(id, size, md5, variant), ...]
+        """
+        with self.lock:
+            return self.conn.execute('SELECT id, size, md5, variant FROM downloads WHERE dir = ?',
+                                     (dir_key(save_dir),)).fetchall()
+
+    def find(self, _id: int, _md5: str = None, variant: str = 'original') -> Optional[DownResult]:
+        """
+        查找任意tag下已下载且文件仍存在的同一图片的同一版本
+        """
+        with self.lock:
+            rows = self.conn.execute('SELECT path, size, md5 FROM downloads WHERE id = ? AND variant = ?',
+                                     (_id, variant)).fetchall()
+        for path, size, row_md5 in rows:
+            if _md5 and row_md5 and _md5 != row_md5:
+                continue
+            if os.path.isfile(path):
+                return DownResult(id=_id, file_path=path, file_size=size, md5=row_md5, complete=True)
+        return None
+
+    def link(self, _id: int, _md5: str, tag: str, file_path: str, variant: str = 'original') -> bool:
+        """
+        已在其他tag下载过的图片按link_mode链接到file_path, 并记录到tag下
+        :param variant: 只链接同一版本
+        :return: 是否链接成功
+        """
+        link_mode = config.index.link_mode
+        if link_mode not in ('hardlink', 'symlink'):
+            return False
+        src = self.find(_id, _md5, variant)
+        if src is None:
+            return False
+        try:
+            if os.path.lexists(file_path):
+                os.remove(file_path)
+            if link_mode == 'hardlink':
+                os.link(src.file_path, file_path)
+            else:
+                os.symlink(os.path.abspath(src.file_path), file_path)
+        except OSError as e:
+            logger.warning(f'[{_id}] {link_mode} failed {src.file_path} -> {file_path}: {e}')
+            return False
+        self.add(tag, src.model_copy(update=dict(file_path=file_path)), variant)
+        return True
+
+    def reconcile(self, b_path: str) -> int:
+        """
+        扫描下载目录(每个tag一个子目录)重建索引, 只替换b_path下的记录
+        :param b_path:
+        :return: 索引的文件数
+        """
+        root = dir_key(b_path)
+        rows = []
+        for tag_dir in os.scandir(b_path):
+            if not tag_dir.is_dir():
+                continue
+            _dir = dir_key(tag_dir.path)
+            for entry in os.scandir(tag_dir.path):
+                if not entry.is_file() or entry.name.endswith(INCOMPLETE_SUFFIXES):
+                    continue
+                try:
+                    _id = parse_file_id(entry.name)
+                except Exception as e:
+                    logger.warning(f'{entry.name}:{e}')
+                    continue
+                rows.append((_id, _dir, tag_dir.name, entry.path, entry.stat().st_size))
+        with self.lock:
+            # 其他下载根目录的记录不受影响
+            dirs = [(d,) for d, in self.conn.execute('SELECT DISTINCT dir FROM downloads')
+                    if d == root or d.startswith(os.path.join(root, ''))]
+            # 保留已有记录中的md5与版本
+            known = {(_id, _dir): (_md5, variant) for _id, _dir, _md5, variant in
+                     self.conn.execute('SELECT id, dir, md5, variant FROM downloads')}
+            rows = [(_id, _dir, tag, path, size, *known.get((_id, _dir), (None, 'original')))
+                    for _id, _dir, tag, path, size in rows]
+            self.conn.executemany('DELETE FROM downloads WHERE dir = ?', dirs)
+            self.conn.executemany('INSERT OR REPLACE INTO downloads (id, dir, tag, path, size, md5, variant) '
+                                  'VALUES (?, ?, ?, ?, ?, ?, ?)', rows)
+            self.conn.commit()
+        self.load()
+        logger.info(f'index reconciled: {len(rows)} files in {b_path}')
+        return len(rows)
+
+    def close(self):
+        self.conn.close()
+
+
+def open_index() -> Optional[DownIndex]:
+    """
+    启用索引时打开默认索引
+    """
+    if not config.index.enable:
+        return None
+    return DownIndex()
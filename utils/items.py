@@ -1,8 +1,9 @@
 from datetime import datetime
 from enum import Enum
-from typing import Optional, List
+from typing import Optional, List, Tuple
 
 from pydantic import BaseModel, RootModel
+from pydantic_core import from_json
 
 
 class SearchRating(Enum):
@@ -79,6 +80,51 @@ class YandePostData(RootModel):
     root: List[YandePostItem]
 
 
+class YandePostView:
+    """
+    列表中单个图片的延迟解析视图
+    下载需要的id/file_url/file_size/md5直接读取, 其余字段首次访问时才完整校验为YandePostItem
+    """
+    __slots__ = ('raw', 'id', 'file_url', 'file_size', 'md5', '_item')
+
+    def __init__(self, raw: dict):
+        self.raw = raw
+        self.id = int(raw['id'])
+        self.file_url = str(raw['file_url'])
+        self.file_size = int(raw['file_size'])
+        self.md5 = str(raw['md5'])
+        self._item = None
+
+    @property
+    def item(self) -> YandePostData.YandePostItem:
+        if self._item is None:
+            self._item = YandePostData.YandePostItem.model_validate(self.raw)
+        return self._item
+
+    def __getattr__(self, name):
+        return getattr(self.item, name)
+
+
+class YandePostPage:
+    """
+    YandePostData的快速解析版本, root为YandePostView列表
+    """
+    __slots__ = ('root',)
+
+    def __init__(self, root: List[YandePostView]):
+        self.root = root
+
+    @classmethod
+    def model_validate_json(cls, content) -> 'YandePostPage':
+        return cls([YandePostView(raw) for raw in from_json(content)])
+
+    def full(self) -> YandePostData:
+        """
+        完整校验为YandePostData
+        """
+        return YandePostData([i.item for i in self.root])
+
+
 class YandeSearchTags(BaseModel):
     width: str = None
     rating: Rating = None
@@ -96,7 +142,47 @@ class YandeRunningConfig(BaseModel):
 
 
 class YandeFilterTags(BaseModel):
-    pass
+    """
+    解析后的yande标签搜索条件, 用于本地查询
+    """
+    include: List[str] = []
+    exclude: List[str] = []
+    ratings: List[Rating] = []
+    exclude_ratings: List[Rating] = []
+    exts: List[str] = []
+    exclude_exts: List[str] = []
+    # (字段, 运算符, 值), 如 ('width', '>=', 1000)
+    conditions: List[Tuple[str, str, int]] = []
+
+
+class LocalPostData(RootModel):
+    """
+    本地镜像中的图片信息, 字段与YandePostItem同名, 可直接用于下载
+    """
+
+    class LocalPostItem(BaseModel):
+        id: int
+        created_at: int
+        score: int
+        md5: str
+        file_size: int
+        file_ext: str
+        file_url: str
+        rating: Rating
+        width: int
+        height: int
+        sample_url: str
+        sample_width: int
+        sample_height: int
+        sample_file_size: int
+        jpeg_url: str
+        jpeg_width: int
+        jpeg_height: int
+        jpeg_file_size: int
+        parent_id: Optional[int] = None
+        status: str
+
+    root: List[LocalPostItem]
 
 
 class FileInfo(BaseModel):
@@ -110,6 +196,45 @@ class FileInfo(BaseModel):
     url: str
 
 
+class FileVariant(BaseModel):
+    """
+    图片的一个可下载版本: original 原图, jpeg 原图为png时的jpg版本, sample 缩小的预览图
+    """
+    name: str = 'original'
+    url: str
+    file_size: int = 0  # 0为未知
+    width: int = 0
+    height: int = 0
+    md5: Optional[str] = None  # 只有原图有md5
+
+
+class DownResult(BaseModel):
+    """
+    文件下载结果
+    """
+    id: Optional[int] = None
+    file_path: str
+    file_size: int = 0
+    md5: Optional[str] = None  # 下载内容实际的md5
+    complete: bool = False  # 所有分段是否下载完成
+    verified: Optional[bool] = None  # md5校验结果, 无期望md5时为None
+
+    @property
+    def ok(self) -> bool:
+        return self.complete and self.verified is not False
+
+
+class TagResult(BaseModel):
+    """
+    单个tag的搜索下载结果
+    """
+    tag: str
+    max_id: int = 0  # 本次搜索到的最大id, 可作为下次的stop_id
+    count: int = 0  # 下载成功的文件数
+    bytes: int = 0  # 下载成功的文件大小
+    failed: int = 0  # 下载失败的文件数
+
+
 class IterStatus(Enum):
     next = 'continue'
     stop = 'stop'
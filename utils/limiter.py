@@ -0,0 +1,120 @@
+from threading import Lock
+from time import monotonic, sleep
+from typing import Optional
+from urllib.parse import urlsplit
+
+from loguru import logger
+
+from utils.constant import config
+
+# 服务端限流时返回的状态码
+THROTTLE_STATUS = (429, 503)
+
+
+class TokenBucket:
+    """
+    令牌桶, rate<=0时不限制
+    """
+
+    def __init__(self, rate: float, capacity: float = None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(rate, 1)
+        self.tokens = self.capacity
+        self.last = monotonic()
+        self.lock = Lock()
+
+    def reserve(self, n: float) -> float:
+        """
+        预占n个令牌, 返回需要等待的秒数
+        """
+        if self.rate <= 0:
+            return 0
+        with self.lock:
+            now = monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.last) * self.rate)
+            self.last = now
+            self.tokens -= n
+            return -self.tokens / self.rate if self.tokens < 0 else 0
+
+    def acquire(self, n: float):
+        wait = self.reserve(n)
+        if wait > 0:
+            sleep(wait)
+
+
+class HostLimiter:
+    """
+    单个host的请求数/流量限制, 服务端限流后该host的所有请求一起退避
+    """
+
+    def __init__(self, host: str, rate_requests: float, rate_bytes: float):
+        self.host = host
+        self.requests = TokenBucket(rate_requests)
+        self.bytes = TokenBucket(rate_bytes)
+        self.lock = Lock()
+        self.backoff = 0.0
+        self.backoff_until = 0.0
+
+    def request_delay(self) -> float:
+        """
+        发起一次请求前需要等待的秒数
+        """
+        with self.lock:
+            wait = max(self.backoff_until - monotonic(), 0)
+        return wait + self.requests.reserve(1)
+
+    def acquire_request(self):
+        wait = self.request_delay()
+        if wait > 0:
+            sleep(wait)
+
+    def bytes_delay(self, n: int) -> float:
+        return self.bytes.reserve(n)
+
+    def acquire_bytes(self, n: int):
+        self.bytes.acquire(n)
+
+    def on_throttle(self, retry_after: Optional[str] = None):
+        """
+        服务端返回429/503, 按Retry-After或指数退避暂停该host的请求
+        """
+        with self.lock:
+            self.backoff = min(max(self.backoff * 2, config.yande_api.backoff), config.yande_api.max_backoff)
+            wait = self.backoff
+            if retry_after is not None and retry_after.strip().isdigit():
+                wait = min(max(float(retry_after), wait), config.yande_api.max_backoff)
+            self.backoff_until = max(self.backoff_until, monotonic() + wait)
+        logger.info(f'{self.host} throttled, back off {wait:.01f}s')
+
+    def on_success(self):
+        with self.lock:
+            self.backoff /= 2
+
+
+_limiters: dict = {}
+_limiter_lock = Lock()
+
+
+def get_limiter(role: str, url: str, rate_requests: float = 0, rate_bytes: float = 0) -> HostLimiter:
+    """
+    按(用途, host)获取进程内共享的限速器, api与文件下载在同一host时分别限速
+    :param role: api 或 file
+    :param url:
+    :param rate_requests: 首次创建时的每秒请求数, 0为不限制
+    :param rate_bytes: 首次创建时的每秒字节数, 0为不限制
+    :return:
+    """
+    host = urlsplit(url).netloc
+    with _limiter_lock:
+        limiter = _limiters.get((role, host))
+        if limiter is None:
+            limiter = _limiters[role, host] = HostLimiter(host, rate_requests, rate_bytes)
+    return limiter
+
+
+def file_limiter(url: str) -> HostLimiter:
+    return get_limiter('file', url, config.downloader.rate_requests, config.downloader.rate_bytes)
+
+
+def api_limiter(url: str) -> HostLimiter:
+    return get_limiter('api', url, config.yande_api.rate_requests, config.yande_api.rate_bytes)
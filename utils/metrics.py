@@ -0,0 +1,286 @@
+import atexit
+import json
+import os
+from bisect import bisect_left
+from contextlib import contextmanager
+from threading import Lock, Thread, Event
+from time import perf_counter, time
+
+from loguru import logger
+
+from utils.constant import config
+
+# 默认的耗时分桶(秒)
+TIME_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+# 吞吐分桶(字节/秒)
+RATE_BUCKETS = tuple(2 ** n * 1024 for n in range(4, 17, 2))
+
+
+class Counter:
+    def __init__(self):
+        self.value = 0
+        self.lock = Lock()
+
+    def inc(self, n: float = 1):
+        with self.lock:
+            self.value += n
+
+
+class Gauge(Counter):
+    def set(self, value: float):
+        self.value = value
+
+
+class Histogram:
+    def __init__(self, buckets=TIME_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self.lock = Lock()
+
+    def observe(self, value: float):
+        n = bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[n] += 1
+            self.sum += value
+            self.count += 1
+
+    @contextmanager
+    def time(self):
+        begin = perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(perf_counter() - begin)
+
+
+class Registry:
+    """
+    指标注册表, 同名同标签的指标只创建一次
+    """
+
+    def __init__(self):
+        self.lock = Lock()
+        # name -> (类型, 说明, {labels: metric})
+        self.families: dict = {}
+
+    def get(self, kind: str, cls, name: str, help_text: str, labels: dict, *args):
+        key = tuple(sorted(labels.items()))
+        family = self.families.get(name)
+        if family is not None:
+            metric = family[2].get(key)
+            if metric is not None:
+                return metric
+        with self.lock:
+            family = self.families.setdefault(name, (kind, help_text, {}))
+            metric = family[2].get(key)
+            if metric is None:
+                metric = family[2][key] = cls(*args)
+        return metric
+
+    def counter(self, name: str, help_text: str = '', **labels) -> Counter:
+        return self.get('counter', Counter, name, help_text, labels)
+
+    def gauge(self, name: str, help_text: str = '', **labels) -> Gauge:
+        return self.get('gauge', Gauge, name, help_text, labels)
+
+    def histogram(self, name: str, help_text: str = '', buckets=TIME_BUCKETS, **labels) -> Histogram:
+        return self.get('histogram', Histogram, name, help_text, labels, buckets)
+
+    def items(self):
+        with self.lock:
+            families = [(name, kind, help_text, list(metrics.items()))
+                        for name, (kind, help_text, metrics) in sorted(self.families.items())]
+        return families
+
+    def prometheus_text(self) -> str:
+        """
+        Prometheus文本格式
+        """
+        lines = []
+        for name, kind, help_text, metrics in self.items():
+            if help_text:
+                lines.append(f'# HELP {name} {help_text}')
+            lines.append(f'# TYPE {name} {kind}')
+            for key, metric in metrics:
+                if kind != 'histogram':
+                    lines.append(f'{name}{format_labels(key)} {metric.value}')
+                    continue
+                with metric.lock:
+                    counts, total, count = list(metric.counts), metric.sum, metric.count
+                acc = 0
+                for bound, n in zip(metric.buckets + ('+Inf',), counts):
+                    acc += n
+                    lines.append(f'{name}_bucket{format_labels(key + (("le", str(bound)),))} {acc}')
+                lines.append(f'{name}_sum{format_labels(key)} {total}')
+                lines.append(f'{name}_count{format_labels(key)} {count}')
+        return '\n'.join(lines) + '\n'
+
+    def snapshot(self) -> dict:
+        """
+        JSON格式的快照, 直方图只输出数量/总和/分桶
+        """
+        ret = {}
+        for name, kind, _, metrics in self.items():
+            values = []
+            for key, metric in metrics:
+                item = dict(labels=dict(key))
+                if kind == 'histogram':
+                    with metric.lock:
+                        item.update(count=metric.count, sum=metric.sum,
+                                    buckets=dict(zip(map(str, metric.buckets + ('+Inf',)), metric.counts)))
+                else:
+                    item['value'] = metric.value
+                values.append(item)
+            ret[name] = values
+        return ret
+
+    def json_line(self) -> str:
+        return json.dumps(dict(time=time(), metrics=self.snapshot()))
+
+
+def escape_label(value) -> str:
+    """
+    按prometheus文本格式转义标签值中的反斜杠/双引号/换行
+    """
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def format_labels(key: tuple) -> str:
+    if not key:
+        return ''
+    return '{' + ','.join(f'{k}="{escape_label(v)}"' for k, v in key) + '}'
+
+
+registry = Registry()
+counter = registry.counter
+gauge = registry.gauge
+histogram = registry.histogram
+
+
+class Tracer:
+    """
+    单个文件的处理阶段耗时记录, 以JSON lines追加写入
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.lock = Lock()
+        self.f = open(path, 'a', encoding='utf-8') if path else None
+
+    def emit(self, record: dict):
+        if self.f is None:
+            return
+        line = json.dumps(record, ensure_ascii=False)
+        with self.lock:
+            self.f.write(line + '\n')
+
+    def close(self):
+        if self.f is not None:
+            with self.lock:
+                self.f.close()
+                self.f = None
+
+
+_tracer: Tracer = None
+_tracer_lock = Lock()
+
+
+def get_tracer() -> Tracer:
+    global _tracer
+    if _tracer is None:
+        with _tracer_lock:
+            if _tracer is None:
+                _tracer = Tracer(config.metrics.trace_path if config.metrics.enable else '')
+    return _tracer
+
+
+@contextmanager
+def span(name: str, trace=None, **attrs):
+    """
+    记录一个处理阶段, 耗时计入stage_seconds, 开启trace_path时同时写入一条trace
+    :param name: 阶段名 list/size_probe/ranges/write/verify
+    :param trace: 所属的trace, 一般为图片id或搜索条件
+    :param attrs: 附加信息, 可在with内继续修改
+    """
+    begin_time, begin = time(), perf_counter()
+    error = None
+    try:
+        yield attrs
+    except BaseException as e:
+        error = repr(e)
+        raise
+    finally:
+        seconds = perf_counter() - begin
+        histogram('stage_seconds', '各处理阶段耗时', stage=name).observe(seconds)
+        tracer = get_tracer()
+        if tracer.f is not None:
+            tracer.emit(dict(trace=trace, span=name, start=begin_time, seconds=round(seconds, 6), error=error,
+                             **attrs))
+
+
+def dump(path: str = None, fmt: str = None):
+    """
+    输出当前指标, prometheus格式覆盖写入(可用于node_exporter textfile), json格式追加一行
+    """
+    path = path or config.metrics.path
+    fmt = fmt or config.metrics.format
+    if not path:
+        return
+    if fmt == 'json':
+        with open(path, 'a', encoding='utf-8') as f:
+            f.write(registry.json_line() + '\n')
+    else:
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.write(registry.prometheus_text())
+        os.replace(tmp_path, path)
+
+
+class Exporter:
+    """
+    后台定时输出指标, 退出时再输出一次
+    """
+
+    def __init__(self, interval: float = None):
+        self.interval = interval if interval is not None else config.metrics.interval
+        self.stop_event = Event()
+        self.thread = None
+
+    def run(self):
+        while not self.stop_event.wait(self.interval):
+            self.export()
+
+    def export(self):
+        try:
+            dump()
+        except Exception as e:
+            logger.warning(f'metrics export error: {e}')
+
+    def start(self):
+        if self.interval > 0:
+            self.thread = Thread(target=self.run, daemon=True, name='metrics')
+            self.thread.start()
+        atexit.register(self.stop)
+
+    def stop(self):
+        if self.stop_event.is_set():
+            return
+        self.stop_event.set()
+        self.export()
+        get_tracer().close()
+
+
+_exporter: Exporter = None
+
+
+def start_exporter():
+    """
+    按配置启动指标输出, 未配置metrics.path时不启动, 重复调用无效
+    """
+    global _exporter
+    if _exporter is not None or not (config.metrics.enable and config.metrics.path):
+        return
+    _exporter = Exporter()
+    _exporter.start()
@@ -0,0 +1,115 @@
+import sqlite3
+from pathlib import Path
+from threading import Lock
+
+from utils.constant import config, CONFIG_DIR
+from utils.items import YandePostView
+
+# 镜像保存的字段, 仅保留筛选与下载需要的列
+POST_COLUMNS = ('id', 'created_at', 'score', 'md5', 'file_size', 'file_ext', 'file_url', 'rating', 'width', 'height',
+                'sample_url', 'sample_width', 'sample_height', 'sample_file_size',
+                'jpeg_url', 'jpeg_width', 'jpeg_height', 'jpeg_file_size', 'parent_id', 'status')
+
+
+class MetaMirror:
+    """
+    post.json元数据的本地镜像(SQLite)
+    posts只保存窄列, 标签拆分为按tag聚簇的倒排表post_tags, 便于本地按tag筛选
+    """
+
+    def __init__(self, db_path: str = None):
+        self.db_path = db_path = self.resolve(db_path)
+        self.lock = Lock()
+        self.conn = sqlite3.connect(str(db_path), check_same_thread=False)
+        self.conn.executescript('''
+            CREATE TABLE IF NOT EXISTS posts (
+                id INTEGER PRIMARY KEY, created_at INTEGER, score INTEGER, md5 TEXT, file_size INTEGER,
+                file_ext TEXT, file_url TEXT, rating TEXT, width INTEGER, height INTEGER,
+                sample_url TEXT, sample_width INTEGER, sample_height INTEGER, sample_file_size INTEGER,
+                jpeg_url TEXT, jpeg_width INTEGER, jpeg_height INTEGER, jpeg_file_size INTEGER,
+                parent_id INTEGER, status TEXT);
+            CREATE TABLE IF NOT EXISTS tags (id INTEGER PRIMARY KEY, name TEXT NOT NULL UNIQUE);
+            CREATE TABLE IF NOT EXISTS post_tags (
+                tag_id INTEGER NOT NULL, post_id INTEGER NOT NULL, PRIMARY KEY (tag_id, post_id)) WITHOUT ROWID;
+            CREATE INDEX IF NOT EXISTS post_tags_post ON post_tags (post_id);
+            CREATE TABLE IF NOT EXISTS mirror_state (query TEXT PRIMARY KEY, max_id INTEGER NOT NULL);
+        ''')
+        self.conn.commit()
+        self.tag_ids = {name: _id for _id, name in self.conn.execute('SELECT id, name FROM tags')}
+
+    @staticmethod
+    def resolve(db_path: str = None) -> Path:
+        db_path = Path(db_path or config.mirror.path)
+        return db_path if db_path.is_absolute() else CONFIG_DIR / db_path
+
+    @classmethod
+    def exists(cls, db_path: str = None) -> bool:
+        return cls.resolve(db_path).exists()
+
+    def max_id(self, query: str = '') -> int:
+        """
+        该搜索条件已完整镜像到的最大id
+        """
+        with self.lock:
+            row = self.conn.execute('SELECT max_id FROM mirror_state WHERE query = ?', (query,)).fetchone()
+        return row[0] if row else 0
+
+    def set_max_id(self, query: str, max_id: int):
+        with self.lock:
+            self.conn.execute('INSERT OR REPLACE INTO mirror_state (query, max_id) VALUES (?, ?)', (query, max_id))
+            self.conn.commit()
+
+    def tag_id(self, name: str) -> int:
+        _id = self.tag_ids.get(name)
+        if _id is None:
+            self.conn.execute('INSERT OR IGNORE INTO tags (name) VALUES (?)', (name,))
+            _id = self.tag_ids[name] = self.conn.execute('SELECT id FROM tags WHERE name = ?', (name,)).fetchone()[0]
+        return _id
+
+    def add_page(self, items) -> int:
+        """
+        写入一页YandePostView或YandePostItem, 已存在的id覆盖更新
+        YandePostView直接读取原始dict, 不触发完整校验
+        :return: 写入的行数
+        """
+        rows = []
+        tag_rows = []
+        with self.lock:
+            for i in items:
+                if isinstance(i, YandePostView):
+                    row = [i.raw.get(c) for c in POST_COLUMNS]
+                    tags = i.raw.get('tags') or ''
+                else:
+                    row = [getattr(i, c) for c in POST_COLUMNS]
+                    row[1] = int(i.created_at.timestamp())
+                    row[7] = i.rating.value
+                    tags = i.tags
+                rows.append(row)
+                tag_rows.extend((self.tag_id(t), i.id) for t in tags.split())
+            ids = [(i.id,) for i in items]
+            self.conn.executemany('DELETE FROM post_tags WHERE post_id = ?', ids)
+            self.conn.executemany(f'INSERT OR REPLACE INTO posts ({", ".join(POST_COLUMNS)}) '
+                                  f'VALUES ({", ".join("?" * len(POST_COLUMNS))})', rows)
+            self.conn.executemany('INSERT OR IGNORE INTO post_tags (tag_id, post_id) VALUES (?, ?)', tag_rows)
+            self.conn.commit()
+        return len(rows)
+
+    def files(self, ids: list, batch_size: int = 500) -> list:
+        """
+        按id查询下载相关的字段
+        :return: [(id, file_size, md5, file_url), ...]
+        """
+        ret = []
+        with self.lock:
+            for n in range(0, len(ids), batch_size):
+                batch = ids[n:n + batch_size]
+                ret.extend(self.conn.execute(f'SELECT id, file_size, md5, file_url FROM posts '
+                                             f'WHERE id IN ({", ".join("?" * len(batch))})', batch))
+        return ret
+
+    def count(self) -> int:
+        with self.lock:
+            return self.conn.execute('SELECT COUNT(*) FROM posts').fetchone()[0]
+
+    def close(self):
+        self.conn.close()
@@ -0,0 +1,159 @@
+import sys
+from threading import Lock, Thread, Event
+
+from utils.constant import config
+
+
+class FileProgress:
+    """
+    单个文件的下载进度, 传输线程只累加计数, 由ProgressManager定时采样显示
+    """
+    __slots__ = ('description', 'total', 'done', 'lock', 'task_id')
+
+    def __init__(self, description: str, total: int, done: int = 0):
+        self.description = description
+        self.total = total
+        self.done = done
+        self.lock = Lock()
+        self.task_id = None
+
+    def advance(self, n: int):
+        """
+        :param n: 字节数, 重试时可为负数回退
+        """
+        with self.lock:
+            self.done += n
+
+
+class ProgressManager:
+    """
+    进程内唯一的进度显示: 一行总体进度(吞吐/剩余时间)加上正在传输的文件
+    刷新线程按固定频率读取各文件的计数, 没有进行中的文件时关闭显示; headless模式下只计数不启动刷新线程
+    """
+
+    def __init__(self, mode: str = None, refresh: float = None):
+        """
+        :param mode: rich 显示进度条, none 不显示, auto 标准输出为终端时显示
+        :param refresh: 每秒刷新次数
+        """
+        mode = mode or config.downloader.progress
+        if mode == 'auto':
+            mode = 'rich' if sys.stdout.isatty() else 'none'
+        self.enable = mode == 'rich'
+        self.interval = 1 / max(refresh or config.downloader.progress_refresh, 0.1)
+        self.lock = Lock()
+        self.files: list = []
+        # 已结束文件的大小与数量
+        self.finished_total = 0
+        self.finished_done = 0
+        self.finished_count = 0
+        self.stop_event: Event = None
+        self.thread: Thread = None
+        # 进度条只在刷新线程中操作
+        self.progress = None
+        self.total_task = None
+
+    def add_file(self, description: str, total: int, done: int = 0) -> FileProgress:
+        item = FileProgress(description, total, done)
+        with self.lock:
+            self.files.append(item)
+            if self.enable and self.thread is None:
+                self.stop_event = Event()
+                self.thread = Thread(target=self.run, args=(self.stop_event,), daemon=True, name='progress')
+                self.thread.start()
+        return item
+
+    def remove_file(self, item: FileProgress):
+        with self.lock:
+            self.files.remove(item)
+            self.finished_total += item.total
+            self.finished_done += item.done
+            self.finished_count += 1
+
+    def run(self, stop_event: Event):
+        while not stop_event.wait(self.interval):
+            self.sample()
+        self.sample(close=True)
+
+    def sample(self, close: bool = False):
+        """
+        按计数刷新进度条, 没有进行中的文件时关闭显示
+        """
+        with self.lock:
+            files = list(self.files)
+            total, done, count = self.finished_total, self.finished_done, self.finished_count
+            if not files:
+                self.finished_total = self.finished_done = self.finished_count = 0
+        if self.progress is None:
+            if not files:
+                return
+            self.progress = new_progress(auto_refresh=False)
+            self.total_task = self.progress.add_task('', total=0)
+            self.progress.start()
+        progress = self.progress
+        shown = set()
+        for item in files:
+            total += item.total
+            done += item.done
+            if item.task_id is None:
+                item.task_id = progress.add_task(item.description, total=item.total / 1024 / 1024)
+            progress.update(item.task_id, completed=item.done / 1024 / 1024)
+            shown.add(item.task_id)
+        for task_id in list(progress.task_ids):
+            if task_id != self.total_task and task_id not in shown:
+                progress.remove_task(task_id)
+        progress.update(self.total_task, description=f'[bold]total {count}/{count + len(files)} files',
+                        total=total / 1024 / 1024, completed=done / 1024 / 1024)
+        progress.refresh()
+        if not files or close:
+            progress.stop()
+            self.progress = self.total_task = None
+
+    def close(self):
+        """
+        停止刷新线程, 之后添加文件时重新启动
+        """
+        with self.lock:
+            thread, stop_event = self.thread, self.stop_event
+            self.thread = None
+        if thread is not None:
+            stop_event.set()
+            thread.join()
+
+
+_manager: ProgressManager = None
+_manager_lock = Lock()
+
+
+def get_progress() -> ProgressManager:
+    """
+    进程内共享的进度显示
+    """
+    global _manager
+    if _manager is None:
+        with _manager_lock:
+            if _manager is None:
+                _manager = ProgressManager()
+    return _manager
+
+
+def new_progress(auto_refresh: bool = True):
+    # rich导入较慢, 只在显示进度条时导入
+    from rich.progress import Progress, Task, TextColumn, BarColumn, TimeRemainingColumn, TimeElapsedColumn
+
+    class SpeedColumn(TextColumn):
+        def render(self, task: "Task") -> str:
+            if task.speed is None:
+                return 'NA'
+            elif task.speed is not None:
+                return f'{task.speed:.03f} MB/s'
+
+    return Progress(TextColumn('down file [progress.description] {task.description}'),
+                    BarColumn(),
+                    TextColumn("[progress.percentage]{task.percentage:>3.0f}%"),
+                    SpeedColumn(" {task.speed}"),
+                    TextColumn("{task.completed:>.03f}/{task.total:>.03f} MB"),
+                    TimeRemainingColumn(),
+                    TimeElapsedColumn(),
+                    auto_refresh=auto_refresh
+                    )
@@ -0,0 +1,234 @@
+import re
+import sys
+from array import array
+from threading import Lock
+
+from loguru import logger
+
+from utils.items import YandeFilterTags, Rating, LocalPostData
+from utils.mirror import MetaMirror, POST_COLUMNS
+
+RATING_ALIAS = {
+    's': Rating.S, 'safe': Rating.S,
+    'q': Rating.R15, 'questionable': Rating.R15,
+    'e': Rating.R18, 'explicit': Rating.R18,
+}
+# 支持比较的数值字段
+NUMERIC_FIELDS = ('id', 'width', 'height', 'score', 'file_size')
+# yande支持但本地镜像无法查询的条件, 作为普通tag时只会返回空结果
+UNSUPPORTED_META = ('order', 'user', 'vote', 'fav', 'pool', 'parent', 'source', 'md5', 'date', 'mpixels',
+                    'holds', 'approver', 'status', 'sub', 'commenter', 'noter', 'tagcount', 'limit')
+NUMERIC_RE = re.compile(r'^(>=|<=|>|<|=)?(\d+)$')
+RANGE_RE = re.compile(r'^(\d+)\.\.(\d+)$')
+
+
+def parse_query(expr: str) -> YandeFilterTags:
+    """
+    解析yande风格的搜索条件
+    支持: tag(AND), -tag, rating:s/q/e, ext:png, width/height/score/id/file_size:>=N / N / N..M
+    order:/user:等本地无法查询的条件抛出ValueError
+    """
+    ret = YandeFilterTags()
+    for token in expr.split():
+        negative = token.startswith('-')
+        if negative:
+            token = token[1:]
+        name, _, value = token.partition(':')
+        name = name.lower()
+        if value and name == 'rating':
+            rating = RATING_ALIAS.get(value.lower())
+            if rating is None:
+                raise ValueError(f'unknown rating: {value}')
+            (ret.exclude_ratings if negative else ret.ratings).append(rating)
+        elif value and name == 'ext':
+            (ret.exclude_exts if negative else ret.exts).append(value.lower())
+        elif value and name in UNSUPPORTED_META:
+            raise ValueError(f'unsupported search term: {token}')
+        elif value and name in NUMERIC_FIELDS:
+            if negative:
+                raise ValueError(f'negative numeric condition not supported: {token}')
+            if m := RANGE_RE.match(value):
+                ret.conditions.append((name, '>=', int(m[1])))
+                ret.conditions.append((name, '<=', int(m[2])))
+            elif m := NUMERIC_RE.match(value):
+                ret.conditions.append((name, m[1] or '=', int(m[2])))
+            else:
+                raise ValueError(f'bad numeric condition: {token}')
+        else:
+            (ret.exclude if negative else ret.include).append(token)
+    return ret
+
+
+def bitmap_from_ids(ids) -> int:
+    """
+    id列表转为以int表示的位图, 第id位对应该图片
+    """
+    ids = ids if isinstance(ids, list) else list(ids)
+    if not ids:
+        return 0
+    bits = bytearray(max(ids) // 8 + 1)
+    for _id in ids:
+        bits[_id >> 3] |= 1 << (_id & 7)
+    return int.from_bytes(bits, 'little')
+
+
+def ids_from_bitmap(bitmap: int):
+    """
+    按从大到小的顺序遍历位图中的id, 按64位字跳过为0的部分, 每个字内用bit_length取最高位
+    """
+    words = array('Q')
+    words.frombytes(bitmap.to_bytes((bitmap.bit_length() + 63) // 64 * 8, sys.byteorder))
+    for n in range(len(words) - 1, -1, -1):
+        word = words[n]
+        while word:
+            b = word.bit_length() - 1
+            yield n << 6 | b
+            word ^= 1 << b
+
+
+def id_range_mask(conditions: list, max_id: int) -> int:
+    """
+    id条件转为位图的连续区间
+    """
+    lo, hi = 0, max_id
+    for _, op, value in conditions:
+        if op in ('>=', '='):
+            lo = max(lo, value)
+        if op in ('<=', '='):
+            hi = min(hi, value)
+        if op == '>':
+            lo = max(lo, value + 1)
+        if op == '<':
+            hi = min(hi, value - 1)
+    if lo > hi:
+        return 0
+    return (1 << hi + 1) - (1 << lo)
+
+
+class LocalQuery:
+    """
+    基于本地镜像的标签查询
+    tag/rating/ext各自对应一个以id为位置的int位图, 查询时做位运算; id条件转为区间掩码, 其他数值条件在SQLite中过滤
+    """
+
+    def __init__(self, mirror: MetaMirror = None, cache_size: int = 1024, in_limit: int = 20000):
+        """
+        :param in_limit: 候选数量不超过该值时数值条件只查询候选id, 否则扫描整个posts表
+        """
+        self.mirror = mirror or MetaMirror()
+        self.cache_size = cache_size
+        self.in_limit = in_limit
+        self.lock = Lock()
+        self.load()
+
+    def load(self):
+        """
+        从镜像加载rating与ext位图, 镜像更新后需要重新加载
+        """
+        ratings = {}
+        exts = {}
+        with self.mirror.lock:
+            for _id, rating, ext in self.mirror.conn.execute('SELECT id, rating, file_ext FROM posts'):
+                ratings.setdefault(rating, []).append(_id)
+                exts.setdefault(ext, []).append(_id)
+        self.rating_bitmaps = {k: bitmap_from_ids(v) for k, v in ratings.items()}
+        self.ext_bitmaps = {k: bitmap_from_ids(v) for k, v in exts.items()}
+        self.all_bitmap = self.union(self.rating_bitmaps.values())
+        self.size = self.all_bitmap.bit_count()
+        self.tag_cache = {}
+        logger.debug(f'local query loaded {self.size} posts')
+
+    def tag_bitmap(self, name: str) -> int:
+        """
+        读取tag的倒排表转为位图, 结果缓存
+        """
+        with self.lock:
+            bitmap = self.tag_cache.get(name)
+        if bitmap is not None:
+            return bitmap
+        with self.mirror.lock:
+            post_ids = [r[0] for r in self.mirror.conn.execute(
+                'SELECT post_id FROM post_tags WHERE tag_id = (SELECT id FROM tags WHERE name = ?)', (name,))]
+        bitmap = bitmap_from_ids(post_ids)
+        with self.lock:
+            if len(self.tag_cache) >= self.cache_size:
+                self.tag_cache.pop(next(iter(self.tag_cache)))
+            self.tag_cache[name] = bitmap
+        return bitmap
+
+    def filter_numeric(self, bitmap: int, conditions: list) -> int:
+        """
+        在SQLite中按数值条件过滤候选位图
+        """
+        where = ' AND '.join(f'{name} {op} ?' for name, op, _ in conditions)
+        values = [value for _, _, value in conditions]
+        ret = []
+        with self.mirror.lock:
+            if bitmap.bit_count() <= self.in_limit:
+                ids = list(ids_from_bitmap(bitmap))
+                for n in range(0, len(ids), 500):
+                    batch = ids[n:n + 500]
+                    ret.extend(r[0] for r in self.mirror.conn.execute(
+                        f'SELECT id FROM posts WHERE id IN ({", ".join("?" * len(batch))}) AND {where}',
+                        batch + values))
+            else:
+                ret.extend(r[0] for r in self.mirror.conn.execute(f'SELECT id FROM posts WHERE {where}', values))
+        return bitmap & bitmap_from_ids(ret)
+
+    def search(self, expr, limit: int = None) -> list:
+        """
+        查询符合条件的图片id, 按id从大到小排列
+        :param expr: 搜索字符串或已解析的YandeFilterTags
+        :param limit:
+        :return:
+        """
+        query = parse_query(expr) if isinstance(expr, str) else expr
+        bitmap = self.all_bitmap
+        id_conditions = [c for c in query.conditions if c[0] == 'id']
+        if id_conditions:
+            bitmap &= id_range_mask(id_conditions, bitmap.bit_length())
+        # 先做选择性最强的tag交集
+        for bm in sorted((self.tag_bitmap(t) for t in query.include), key=int.bit_count):
+            bitmap &= bm
+            if not bitmap:
+                return []
+        for t in query.exclude:
+            bitmap &= ~self.tag_bitmap(t)
+        if query.ratings:
+            bitmap &= self.union(self.rating_bitmaps.get(r.value, 0) for r in query.ratings)
+        for r in query.exclude_ratings:
+            bitmap &= ~self.rating_bitmaps.get(r.value, 0)
+        if query.exts:
+            bitmap &= self.union(self.ext_bitmaps.get(e, 0) for e in query.exts)
+        for e in query.exclude_exts:
+            bitmap &= ~self.ext_bitmaps.get(e, 0)
+
+        conditions = [c for c in query.conditions if c[0] != 'id']
+        if conditions and bitmap:
+            bitmap = self.filter_numeric(bitmap, conditions)
+        ret = []
+        for _id in ids_from_bitmap(bitmap):
+            ret.append(_id)
+            if limit and len(ret) >= limit:
+                break
+        return ret
+
+    @staticmethod
+    def union(bitmaps) -> int:
+        ret = 0
+        for bm in bitmaps:
+            ret |= bm
+        return ret
+
+    def posts(self, ids: list, batch_size: int = 500) -> LocalPostData:
+        """
+        按id读取镜像中的图片信息, 顺序与ids一致
+        """
+        rows = {}
+        with self.mirror.lock:
+            for n in range(0, len(ids), batch_size):
+                batch = ids[n:n + batch_size]
+                for r in self.mirror.conn.execute(f'SELECT {", ".join(POST_COLUMNS)} FROM posts '
+                                                  f'WHERE id IN ({", ".join("?" * len(batch))})', batch):
+                    rows[r[0]] = dict(zip(POST_COLUMNS, r))
+        return LocalPostData.model_validate([rows[_id] for _id in ids if _id in rows])
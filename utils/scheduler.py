@@ -0,0 +1,106 @@
+from concurrent.futures import ThreadPoolExecutor, Future, wait
+from threading import BoundedSemaphore
+
+from loguru import logger
+
+from utils.constant import config
+from utils.downloader import MultiDown
+from utils.items import DownResult
+from utils.metrics import gauge
+from utils.progress import get_progress
+
+FILES_INFLIGHT = gauge('files_inflight', '已提交未完成的文件数')
+
+
+class DownScheduler:
+    """
+    跨文件下载调度, 所有文件的分段传输共享一个全局线程池或asyncio引擎
+    """
+
+    def __init__(self, transfer_num: int = None, engine: str = None):
+        self.transfer_num = transfer_num or config.downloader.transfer_num
+        self.engine = None
+        if (engine or config.downloader.engine) == 'async':
+            from utils.async_downloader import AsyncDownEngine
+            self.engine = AsyncDownEngine(self.transfer_num)
+            return
+        # 实际的分段传输都在transfer_executor中进行
+        self.transfer_executor = ThreadPoolExecutor(max_workers=self.transfer_num,
+                                                    thread_name_prefix='transfer')
+        # 文件任务只负责拆分分段与收尾, 数量与传输数一致保证传输池不空闲
+        self.file_executor = ThreadPoolExecutor(max_workers=self.transfer_num,
+                                                thread_name_prefix='file')
+
+    def _run(self, url, file_path, file_name, file_size, _md5, _id, callback) -> DownResult:
+        result = MultiDown(url, file_path, file_name, file_size, _md5, _id,
+                           executor=self.transfer_executor).result
+        if callback is not None:
+            callback(result)
+        return result
+
+    @staticmethod
+    def _task_done(_):
+        FILES_INFLIGHT.inc(-1)
+
+    def submit(self, url: str, file_path: str, file_name: str,
+               file_size: int = 0, _md5: str = None, _id: int = None, callback=None) -> Future:
+        """
+        提交一个文件下载任务, 返回结果为DownResult
+        :param callback: 下载结束后以DownResult调用, 在任务完成(future结束)之前执行
+        """
+        FILES_INFLIGHT.inc()
+        if self.engine is not None:
+            future = self.engine.submit(url, file_path, file_name, file_size, _md5, _id, callback)
+        else:
+            future = self.file_executor.submit(self._run, url, file_path, file_name, file_size, _md5, _id, callback)
+        future.add_done_callback(self._task_done)
+        return future
+
+    def group(self, limit: int = 0) -> 'DownGroup':
+        """
+        :param limit: 组内未完成的任务数上限, 0为不限制
+        """
+        return DownGroup(self, limit)
+
+    def shutdown(self):
+        if self.engine is not None:
+            self.engine.shutdown()
+        else:
+            self.file_executor.shutdown()
+            self.transfer_executor.shutdown()
+        get_progress().close()
+
+
+class DownGroup:
+    """
+    一次搜索(tag)提交的下载任务集合, 用于等待该批任务完成
+    """
+
+    def __init__(self, scheduler: DownScheduler, limit: int = 0):
+        self.scheduler = scheduler
+        self.futures = []
+        # 未完成的任务达到上限时submit阻塞, 使列表页的获取不会远远超前于下载
+        self.slots = BoundedSemaphore(limit) if limit > 0 else None
+
+    def submit(self, *args, **kwargs) -> Future:
+        if self.slots is not None:
+            self.slots.acquire()
+            try:
+                future = self.scheduler.submit(*args, **kwargs)
+            except BaseException:
+                self.slots.release()
+                raise
+            future.add_done_callback(lambda _: self.slots.release())
+        else:
+            future = self.scheduler.submit(*args, **kwargs)
+        future.add_done_callback(lambda x: logger.warning(x.exception()) if x.exception() else '')
+        self.futures.append(future)
+        return future
+
+    def wait(self) -> list:
+        """
+        等待全部任务结束
+        :return: 正常结束任务的DownResult列表
+        """
+        wait(self.futures)
+        return [t.result() for t in self.futures if t.exception() is None]
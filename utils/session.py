@@ -0,0 +1,38 @@
+from threading import Lock
+from typing import TYPE_CHECKING
+from urllib.parse import urlsplit
+
+if TYPE_CHECKING:
+    import requests
+
+_sessions: dict = {}
+_session_lock = Lock()
+
+
+def get_session(url: str, pool_size: int = 10) -> 'requests.Session':
+    """
+    按host获取共享的keep-alive连接池session, 多线程共用
+    :param url:
+    :param pool_size: 首次创建时该host的连接池大小
+    :return:
+    """
+    host = urlsplit(url).netloc
+    with _session_lock:
+        session = _sessions.get(host)
+        if session is None:
+            # requests导入较慢, 首次发起请求时才导入
+            import requests
+            from requests.adapters import HTTPAdapter
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            _sessions[host] = session
+    return session
+
+
+def close_sessions():
+    with _session_lock:
+        for session in _sessions.values():
+            session.close()
+        _sessions.clear()
@@ -0,0 +1,72 @@
+from typing import List
+
+from utils.constant import config
+from utils.items import FileVariant
+
+VARIANTS = ('original', 'jpeg', 'sample', 'smallest', 'original_under')
+
+
+def post_field(item, name: str):
+    """
+    读取图片字段, 延迟解析的YandePostView直接读取原始数据, 不触发完整校验
+    """
+    raw = getattr(item, 'raw', None)
+    if raw is not None:
+        return raw.get(name)
+    return getattr(item, name, None)
+
+
+def post_variants(item) -> List[FileVariant]:
+    """
+    图片的全部可下载版本, 按原图/jpeg/sample排列
+    与原图地址相同或没有地址的版本不列出(原图本身为jpg时没有单独的jpeg版本)
+    """
+    original = FileVariant(name='original', url=item.file_url, file_size=item.file_size,
+                           width=post_field(item, 'width') or 0, height=post_field(item, 'height') or 0, md5=item.md5)
+    ret = [original]
+    for name in ('jpeg', 'sample'):
+        url = post_field(item, f'{name}_url')
+        if not url or any(url == v.url for v in ret):
+            continue
+        ret.append(FileVariant(name=name, url=url, file_size=post_field(item, f'{name}_file_size') or 0,
+                               width=post_field(item, f'{name}_width') or 0,
+                               height=post_field(item, f'{name}_height') or 0))
+    return ret
+
+
+def select_variant(item, policy: str = None, min_width: int = None, min_height: int = None,
+                   max_size: int = None) -> FileVariant:
+    """
+    按策略选择下载的版本, 参数默认使用downloader.variant*配置
+    :param item: YandePostItem/YandePostView/LocalPostItem
+    :param policy: original/jpeg/sample/smallest/original_under
+    :param min_width: smallest策略的最小宽度
+    :param min_height: smallest策略的最小高度
+    :param max_size: original_under策略的原图大小上限, 超过时选择不超过上限的最大版本, 都超过时选择最小版本
+    :return:
+    """
+    policy = policy or config.downloader.variant
+    if policy == 'original':
+        return FileVariant(name='original', url=item.file_url, file_size=item.file_size, md5=item.md5)
+    variants = post_variants(item)
+    named = {v.name: v for v in variants}
+    if policy == 'jpeg':
+        return named.get('jpeg', variants[0])
+    if policy == 'sample':
+        return named.get('sample') or named.get('jpeg', variants[0])
+    # 大小未知的版本排在同尺寸原图之后
+    by_size = sorted(variants, key=lambda v: v.file_size or variants[0].file_size)
+    if policy == 'smallest':
+        min_width = config.downloader.variant_min_width if min_width is None else min_width
+        min_height = config.downloader.variant_min_height if min_height is None else min_height
+        for v in by_size:
+            if v.width >= min_width and v.height >= min_height:
+                return v
+        return variants[0]
+    if policy == 'original_under':
+        max_size = config.downloader.variant_max_size if max_size is None else max_size
+        if max_size <= 0 or variants[0].file_size <= max_size:
+            return variants[0]
+        fits = [v for v in by_size if v.file_size and v.file_size <= max_size]
+        return fits[-1] if fits else by_size[0]
+    raise ValueError(f'unknown variant policy: {policy}')
@@ -0,0 +1,228 @@
+import json
+import sqlite3
+from pathlib import Path
+from threading import Lock
+from time import time
+from typing import Optional
+
+from pydantic import BaseModel
+
+from utils.constant import config, CONFIG_DIR
+from utils.metrics import counter
+
+PENDING = 'pending'
+LEASED = 'leased'
+DONE = 'done'
+FAILED = 'failed'
+
+
+class QueueJob(BaseModel):
+    """
+    队列中的一个任务, kind为 tag 搜索或 file 下载
+    """
+    id: int
+    kind: str
+    key: str
+    payload: dict
+    state: dict = {}  # worker保存的执行进度, 租约过期后由下一个worker继续
+    attempts: int = 0
+    parent: Optional[int] = None  # file任务所属的tag任务
+
+
+class WorkQueue:
+    """
+    基于SQLite的持久化任务队列, 多个worker进程以租约领取任务并定时续约
+    租约过期的任务重新进入队列, 失败的任务延迟后重试, 超过最大次数后标记为失败
+    """
+
+    def __init__(self, db_path: str = None):
+        db_path = Path(db_path or config.queue.path)
+        if not db_path.is_absolute():
+            db_path = CONFIG_DIR / db_path
+        self.db_path = db_path
+        self.lock = Lock()
+        # 自行管理事务, 领取任务时使用BEGIN IMMEDIATE在进程间互斥
+        self.conn = sqlite3.connect(str(db_path), timeout=60, isolation_level=None, check_same_thread=False)
+        if config.queue.wal:
+            self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS jobs ('
+                          'id INTEGER PRIMARY KEY AUTOINCREMENT, kind TEXT NOT NULL, key TEXT NOT NULL UNIQUE, '
+                          'payload TEXT NOT NULL, state TEXT, result TEXT, error TEXT, '
+                          'status TEXT NOT NULL, attempts INTEGER NOT NULL DEFAULT 0, parent INTEGER, '
+                          'worker TEXT, lease_until REAL, not_before REAL NOT NULL DEFAULT 0, '
+                          'committed INTEGER NOT NULL DEFAULT 0, updated_at REAL NOT NULL)')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, kind)')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS jobs_parent ON jobs (parent)')
+
+    def put(self, kind: str, key: str, payload: dict, parent: int = None, reset: tuple = (FAILED,)) -> int:
+        """
+        加入任务, 同一key只保留一个任务
+        :param reset: key已存在且为这些状态时重新加入队列, 还有未结束或未汇总的子任务时不重新加入
+        :return: 任务id
+        """
+        now = time()
+        with self.lock:
+            self.conn.execute('BEGIN IMMEDIATE')
+            try:
+                row = self.conn.execute('SELECT id, status FROM jobs WHERE key = ?', (key,)).fetchone()
+                if row is None:
+                    job_id = self.conn.execute(
+                        'INSERT INTO jobs (kind, key, payload, status, parent, updated_at) VALUES (?, ?, ?, ?, ?, ?)',
+                        (kind, key, json.dumps(payload), PENDING, parent, now)).lastrowid
+                else:
+                    job_id = row[0]
+                    # 子任务的结果汇总前重新加入会使其不再计入, tag的进度会越过未下载的文件
+                    if row[1] in reset and not self._unsettled(job_id):
+                        self.conn.execute('UPDATE jobs SET payload = ?, state = NULL, result = NULL, error = NULL, '
+                                          'status = ?, attempts = 0, parent = ?, worker = NULL, not_before = 0, '
+                                          'committed = 0, updated_at = ? WHERE id = ?',
+                                          (json.dumps(payload), PENDING, parent, now, job_id))
+                        # 上一次执行产生的子任务均已汇总, 不再计入
+                        self.conn.execute('UPDATE jobs SET parent = NULL WHERE parent = ?', (job_id,))
+                self.conn.execute('COMMIT')
+            except BaseException:
+                self.conn.execute('ROLLBACK')
+                raise
+        return job_id
+
+    def lease(self, worker: str, kinds: tuple = None) -> Optional[QueueJob]:
+        """
+        领取最早的可执行任务
+        :param worker: worker名称, 续约与提交结果时校验
+        :param kinds: 只领取这些类型的任务, 默认全部
+        """
+        now = time()
+        kind_sql = f' AND kind IN ({",".join("?" * len(kinds))})' if kinds else ''
+        with self.lock:
+            self.conn.execute('BEGIN IMMEDIATE')
+            try:
+                # 超过最大次数且租约已过期的任务不再重试
+                self.conn.execute('UPDATE jobs SET status = ?, error = ?, updated_at = ? '
+                                  'WHERE status = ? AND lease_until < ? AND attempts >= ?',
+                                  (FAILED, 'lease expired', now, LEASED, now, config.queue.max_attempts))
+                row = self.conn.execute('SELECT id, kind, key, payload, state, attempts, parent FROM jobs '
+                                        'WHERE ((status = ? AND not_before <= ?) OR (status = ? AND lease_until < ?))'
+                                        + kind_sql + ' ORDER BY id LIMIT 1',
+                                        (PENDING, now, LEASED, now, *(kinds or ()))).fetchone()
+                if row is not None:
+                    self.conn.execute('UPDATE jobs SET status = ?, worker = ?, lease_until = ?, '
+                                      'attempts = attempts + 1, updated_at = ? WHERE id = ?',
+                                      (LEASED, worker, now + config.queue.lease, now, row[0]))
+                self.conn.execute('COMMIT')
+            except BaseException:
+                self.conn.execute('ROLLBACK')
+                raise
+        if row is None:
+            return None
+        counter('queue_leased_total', '领取的队列任务数', kind=row[1]).inc()
+        return QueueJob(id=row[0], kind=row[1], key=row[2], payload=json.loads(row[3]),
+                        state=json.loads(row[4]) if row[4] else {}, attempts=row[5] + 1, parent=row[6])
+
+    def heartbeat(self, job_ids: list, worker: str) -> list:
+        """
+        续约worker持有的任务
+        :return: 已失去租约的任务id
+        """
+        now = time()
+        lost = []
+        with self.lock:
+            for job_id in job_ids:
+                cur = self.conn.execute('UPDATE jobs SET lease_until = ?, updated_at = ? '
+                                        'WHERE id = ? AND worker = ? AND status = ?',
+                                        (now + config.queue.lease, now, job_id, worker, LEASED))
+                if cur.rowcount == 0:
+                    lost.append(job_id)
+        return lost
+
+    def save_state(self, job_id: int, worker: str, state: dict) -> bool:
+        """
+        保存执行进度并续约
+        """
+        now = time()
+        with self.lock:
+            cur = self.conn.execute('UPDATE jobs SET state = ?, lease_until = ?, updated_at = ? '
+                                    'WHERE id = ? AND worker = ? AND status = ?',
+                                    (json.dumps(state), now + config.queue.lease, now, job_id, worker, LEASED))
+        return cur.rowcount > 0
+
+    def complete(self, job_id: int, worker: str, result: dict = None) -> bool:
+        """
+        提交结果, 租约已被其他worker取得时忽略
+        """
+        with self.lock:
+            cur = self.conn.execute('UPDATE jobs SET status = ?, result = ?, error = NULL, updated_at = ? '
+                                    'WHERE id = ? AND worker = ? AND status = ?',
+                                    (DONE, json.dumps(result), time(), job_id, worker, LEASED))
+        return cur.rowcount > 0
+
+    def fail(self, job_id: int, worker: str, error: str) -> bool:
+        """
+        任务失败, 未超过最大次数时延迟后重试
+        """
+        now = time()
+        with self.lock:
+            cur = self.conn.execute('UPDATE jobs SET status = CASE WHEN attempts >= ? THEN ? ELSE ? END, '
+                                    'not_before = ? + ? * attempts, error = ?, updated_at = ? '
+                                    'WHERE id = ? AND worker = ? AND status = ?',
+                                    (config.queue.max_attempts, FAILED, PENDING, now, config.queue.retry_delay,
+                                     error, now, job_id, worker, LEASED))
+        return cur.rowcount > 0
+
+    def uncommitted(self, kind: str) -> list:
+        """
+        已结束但结果未被汇总的任务
+        :return: [(QueueJob, status, result), ...]
+        """
+        with self.lock:
+            rows = self.conn.execute('SELECT id, kind, key, payload, attempts, parent, status, result FROM jobs '
+                                     'WHERE kind = ? AND committed = 0 AND status IN (?, ?) ORDER BY id',
+                                     (kind, DONE, FAILED)).fetchall()
+        return [(QueueJob(id=r[0], kind=r[1], key=r[2], payload=json.loads(r[3]), attempts=r[4], parent=r[5]),
+                 r[6], json.loads(r[7]) if r[7] else None) for r in rows]
+
+    def _unsettled(self, job_id: int) -> int:
+        return self.conn.execute('SELECT COUNT(*) FROM jobs WHERE parent = ? AND (status IN (?, ?) OR committed = 0)',
+                                 (job_id, PENDING, LEASED)).fetchone()[0]
+
+    def unsettled(self, job_id: int) -> int:
+        """
+        未结束或结果未被汇总的子任务数
+        """
+        with self.lock:
+            return self._unsettled(job_id)
+
+    def children(self, job_id: int) -> dict:
+        """
+        tag任务下各状态的file任务数
+        """
+        with self.lock:
+            rows = self.conn.execute('SELECT status, COUNT(*) FROM jobs WHERE parent = ? GROUP BY status',
+                                     (job_id,)).fetchall()
+        return dict(rows)
+
+    def open_count(self, kinds: tuple = None) -> int:
+        """
+        未结束(等待或执行中)的任务数
+        """
+        kind_sql = f' AND kind IN ({",".join("?" * len(kinds))})' if kinds else ''
+        with self.lock:
+            return self.conn.execute('SELECT COUNT(*) FROM jobs WHERE status IN (?, ?)' + kind_sql,
+                                     (PENDING, LEASED, *(kinds or ()))).fetchone()[0]
+
+    def mark_committed(self, job_ids: list):
+        with self.lock:
+            self.conn.executemany('UPDATE jobs SET committed = 1 WHERE id = ?', [(i,) for i in job_ids])
+
+    def stats(self) -> dict:
+        """
+        :return: {kind: {status: 任务数}}
+        """
+        ret = {}
+        with self.lock:
+            for kind, status, count in self.conn.execute('SELECT kind, status, COUNT(*) FROM jobs '
+                                                         'GROUP BY kind, status'):
+                ret.setdefault(kind, {})[status] = count
+        return ret
+
+    def close(self):
+        self.conn.close()